@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+
+'''
+Microbenchmarks for the frame parse, escape and write hot paths of the STOMP
+modular input, plus its startup time (splunkd runs 'stomp.py --scheme' and
+'--validate-arguments' often), checked against a time budget.
+
+Usage:
+
+    $ python extras/benchmarks/benchmark.py run --output baseline.json
+    $ python extras/benchmarks/benchmark.py run --output candidate.json
+    $ python extras/benchmarks/benchmark.py compare baseline.json candidate.json --threshold 10
+    $ python extras/benchmarks/benchmark.py run --benchmarks startup.import,startup.scheme --startup-budget 75
+'''
+
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import timeit
+from optparse import OptionParser
+
+STOMP_BIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'stomp', 'bin')
+sys.path.insert(0, STOMP_BIN)
+
+import stomp
+import stomppy
+from stomppy import utils
+
+
+HEADER_COUNTS = (2, 10, 30)
+BODY_SIZES = (64, 4096, 262144)
+# Header count of the benchmarks whose cost doesn't depend on it.
+DEFAULT_HEADER_COUNTS = (10,)
+
+# Startup budget in ms: 'stomp.py --scheme' measured at 45-52ms (best of 5,
+# Python 2.7, single core), plus 50% headroom for slower hosts.
+STARTUP_BUDGET = 75.0
+
+
+def build_headers(header_count):
+    headers = {
+        'destination': '/queue/benchmark',
+        'subscription': 'splunk-stomp',
+    }
+    for i in range(len(headers), header_count):
+        headers['x-benchmark-header-%d' % i] = 'value-%d' % i
+    return headers
+
+
+def build_body(body_size):
+    line = 'lorem <ipsum> & dolor sit amet, consectetur adipiscing elit\n'
+    return (line * (body_size // len(line) + 1))[:body_size]
+
+
+def build_frame(header_count, body_size, message_id=0):
+    headers = build_headers(header_count)
+    headers['message-id'] = 'ID:benchmark-%d' % message_id
+    lines = ['MESSAGE']
+    for key, value in headers.items():
+        lines.append('%s:%s' % (key, value))
+    return '\n'.join(lines) + '\n\n' + build_body(body_size)
+
+
+def build_map_body(entry_count):
+    entries = ''.join([
+        '<entry><string>key-%d</string><string>value-%d</string></entry>' % (i, i)
+        for i in range(entry_count)])
+    return '<map>%s</map>' % entries
+
+
+class SocketpairConnection(object):
+    '''
+    A stomppy.Connection wired to one end of a socketpair, so the receive and
+    send paths can be exercised without a broker.
+    '''
+    def __init__(self):
+        self.peer, local = socket.socketpair()
+        self.connection = stomppy.Connection()
+        self.connection._Connection__socket = local
+        self.connection._Connection__running = True
+
+    def read(self):
+        return self.connection._Connection__read()
+
+    def send_frame(self, command, headers, payload):
+        self.connection._Connection__send_frame(command, headers, payload)
+
+    def close(self):
+        self.connection._Connection__running = False
+        self.connection._Connection__socket.close()
+        self.peer.close()
+
+
+def bench_parse_frame(header_count, body_size):
+    frame = build_frame(header_count, body_size)
+    return lambda: utils.parse_frame(frame)
+
+
+def bench_parse_headers(header_count, body_size):
+    # Only the header lines are parsed, so this runs for a single body size
+    # (see BENCHMARKS).
+    lines = build_frame(header_count, body_size).split('\n\n', 1)[0].split('\n')
+    return lambda: utils.parse_headers(lines, 1)
+
+
+def bench_format_headers(header_count, body_size):
+    # Header lines of a STOMP 1.2 SEND frame, escaped (only the headers
+    # count, see BENCHMARKS).
+    connection = stomppy.Connection(version=1.2)
+    headers = build_headers(header_count)
+    headers['x-benchmark-escaped'] = 'a:b\nc'
+    return lambda: connection._Connection__format_headers('SEND', headers)
+
+
+def bench_read(header_count, body_size):
+    # A single writer thread keeps the socket full (large bodies would
+    # otherwise fill the socket buffer before anything gets read), and every
+    # iteration consumes one frame, reading more data once the frames already
+    # read are used up: the result is the amortized cost of reading a frame.
+    pair = SocketpairConnection()
+    data = build_frame(header_count, body_size) + '\x00'
+
+    def write():
+        try:
+            while True:
+                pair.peer.sendall(data)
+        except socket.error:
+            pass
+    writer = threading.Thread(target=write)
+    writer.daemon = True
+    writer.start()
+
+    pending = [0]
+
+    def run():
+        while not pending[0]:
+            pending[0] = len(pair.read())
+        pending[0] -= 1
+    run.close = pair.close
+    return run
+
+
+def bench_send_frame(header_count, body_size):
+    # The peer end is drained from a separate thread: large frames would
+    # otherwise block on a full socket buffer.
+    pair = SocketpairConnection()
+    headers = build_headers(header_count)
+    body = build_body(body_size)
+
+    def drain():
+        try:
+            while pair.peer.recv(1048576):
+                pass
+        except socket.error:
+            pass
+    drainer = threading.Thread(target=drain)
+    drainer.daemon = True
+    drainer.start()
+
+    def run():
+        pair.send_frame('SEND', dict(headers), body)
+    run.close = pair.close
+    return run
+
+
+def bench_transform(header_count, body_size):
+    body = build_map_body(max(1, body_size // 64))
+    return lambda: utils.transform(body, 'jms-map-xml')
+
+
+def bench_stream_data(header_count, body_size):
+    body = build_body(body_size)
+    devnull = open(os.devnull, 'w')
+
+    def run():
+        stdout = sys.stdout
+        sys.stdout = devnull
+        try:
+            stomp.SplunkHelper.stream_data(body)
+        finally:
+            sys.stdout = stdout
+    run.close = devnull.close
+    return run
+
+
+#
+# (name, factory, header counts, body sizes): only the parse and escape
+# benchmarks run for every header count.
+#
+BENCHMARKS = [
+    ('utils.parse_frame', bench_parse_frame, HEADER_COUNTS, BODY_SIZES),
+    ('utils.parse_headers', bench_parse_headers, HEADER_COUNTS, (0,)),
+    ('Connection.__format_headers', bench_format_headers, HEADER_COUNTS, (0,)),
+    ('Connection.__read', bench_read, HEADER_COUNTS, BODY_SIZES),
+    ('Connection.__send_frame', bench_send_frame, DEFAULT_HEADER_COUNTS, BODY_SIZES),
+    ('utils.transform', bench_transform, DEFAULT_HEADER_COUNTS, BODY_SIZES),
+    ('SplunkHelper.stream_data', bench_stream_data, DEFAULT_HEADER_COUNTS, BODY_SIZES),
+]
+
+
+STARTUP_BENCHMARKS = [
+    ('startup.import', ['-c', 'import stomp']),
+    ('startup.scheme', ['stomp.py', '--scheme']),
+]
+
+
+def bench_startup(args):
+    # Every sample runs a fresh interpreter, so module imports (and anything
+    # done at import time, such as DNS lookups) are measured.
+    devnull = open(os.devnull, 'w')
+    command = [sys.executable] + args
+
+    def run():
+        subprocess.check_call(command, cwd=STOMP_BIN, stdout=devnull)
+    run.close = devnull.close
+    return run
+
+
+def measure(func, min_time, repeat):
+    # Calibrate the number of loops so each sample takes at least min_time
+    # seconds, then keep the best of several samples (timeit style).
+    number = 1
+    while True:
+        elapsed = timeit.Timer(func).timeit(number)
+        if elapsed >= min_time or number >= 1000000:
+            break
+        number *= 10
+    samples = [timeit.Timer(func).timeit(number) / number for i in range(repeat)]
+    return {
+        'loops': number,
+        'best': min(samples),
+        'mean': sum(samples) / len(samples),
+    }
+
+
+def run(options):
+    names = options.benchmarks.split(',') if options.benchmarks else None
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'benchmarks': {},
+    }
+    for name, factory, header_counts, body_sizes in BENCHMARKS:
+        if names and name not in names:
+            continue
+        for header_count in header_counts:
+            for body_size in body_sizes:
+                key = '%s[headers=%d,body=%d]' % (name, header_count, body_size)
+                func = factory(header_count, body_size)
+                try:
+                    result = measure(func, options.min_time, options.repeat)
+                finally:
+                    if hasattr(func, 'close'):
+                        func.close()
+                results['benchmarks'][key] = result
+                sys.stdout.write('%-60s %12.2f us\n' % (key, result['best'] * 1e6))
+                sys.stdout.flush()
+
+    over_budget = 0
+    for name, args in STARTUP_BENCHMARKS:
+        if names and name not in names:
+            continue
+        func = bench_startup(args)
+        try:
+            result = measure(func, options.min_time, options.repeat)
+        finally:
+            func.close()
+        results['benchmarks'][name] = result
+        flag = ''
+        if options.startup_budget and result['best'] * 1000 > options.startup_budget:
+            flag = '  <== OVER BUDGET'
+            over_budget += 1
+        sys.stdout.write('%-60s %12.2f us%s\n' % (name, result['best'] * 1e6, flag))
+        sys.stdout.flush()
+
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    return 1 if over_budget else 0
+
+
+def compare(options, baseline_file, candidate_file):
+    with open(baseline_file) as input:
+        baseline = json.load(input)['benchmarks']
+    with open(candidate_file) as input:
+        candidate = json.load(input)['benchmarks']
+
+    regressions = 0
+    for key in sorted(set(baseline) & set(candidate)):
+        before = baseline[key]['best']
+        after = candidate[key]['best']
+        change = (after - before) / before * 100.0
+        flag = ''
+        if change > options.threshold:
+            flag = '  <== REGRESSION'
+            regressions += 1
+        sys.stdout.write('%-60s %12.2f us %12.2f us %+8.1f%%%s\n' % (
+            key, before * 1e6, after * 1e6, change, flag))
+
+    sys.stdout.write('%d regression(s) above %.1f%%\n' % (regressions, options.threshold))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog run [options] | %prog compare [options] BASELINE CANDIDATE')
+    parser.add_option(
+        '--output',
+        dest='output',
+        help='JSON file where results will be saved (run only)',
+        metavar='FILE')
+    parser.add_option(
+        '--benchmarks',
+        dest='benchmarks',
+        help='Comma separated list of benchmarks to run (defaults to all)',
+        metavar='NAMES')
+    parser.add_option(
+        '--min-time',
+        dest='min_time',
+        default=0.2,
+        type='float',
+        help='Minimum duration in seconds of each sample (defaults to 0.2)',
+        metavar='SECONDS')
+    parser.add_option(
+        '--repeat',
+        dest='repeat',
+        default=3,
+        type='int',
+        help='Number of samples per benchmark (defaults to 3)',
+        metavar='N')
+    parser.add_option(
+        '--threshold',
+        dest='threshold',
+        default=10.0,
+        type='float',
+        help='Slowdown percentage flagged as a regression (defaults to 10)',
+        metavar='PERCENT')
+
+    parser.add_option(
+        '--startup-budget',
+        dest='startup_budget',
+        default=STARTUP_BUDGET,
+        type='float',
+        help='Maximum startup time in ms, 0 to disable (defaults to %d, run only)' % STARTUP_BUDGET,
+        metavar='MS')
+
+    (options, args) = parser.parse_args()
+    if args and args[0] == 'run':
+        sys.exit(run(options))
+    elif len(args) == 3 and args[0] == 'compare':
+        sys.exit(compare(options, args[1], args[2]))
+    else:
+        parser.print_help()
+        sys.exit(2)
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+
+'''
+Helpers shared by the producer and consumer clients.
+'''
+
+# Send timestamp header, used by consumer.py --benchmark to measure
+# end-to-end latency.
+SENT_TIMESTAMP_HEADER = 'x-sent-timestamp'
+
+
+def percentile(values, fraction):
+    '''
+    Return the given fraction (e.g. 0.99) percentile of sorted values.
+    '''
+    return values[min(len(values) - 1, int(len(values) * fraction))]
@@ -2,8 +2,16 @@
 
 from __future__ import absolute_import
 from optparse import OptionParser
+import os
+import sys
+import threading
 import time
-import stomp
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', '..', 'stomp', 'bin'))
+
+import stomppy
+from common import SENT_TIMESTAMP_HEADER, percentile
 
 
 class SimpleListener(object):
@@ -14,15 +22,64 @@ class SimpleListener(object):
         print '=> Received a message: %s' % message
 
 
+class BenchmarkListener(object):
+    '''
+    Counts received messages and records end-to-end latencies using the send
+    timestamp embedded by producer.py.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.errors = 0
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.messages = 0
+            self.latencies = []
+            self.start = time.time()
+
+    def on_error(self, headers, message):
+        self.errors += 1
+
+    def on_message(self, headers, message):
+        now = time.time()
+        with self._lock:
+            self.messages += 1
+            if SENT_TIMESTAMP_HEADER in headers:
+                self.latencies.append(now - float(headers[SENT_TIMESTAMP_HEADER]))
+
+    def report(self):
+        with self._lock:
+            elapsed = time.time() - self.start
+            latencies = sorted(self.latencies)
+            line = '=> Received %d messages in %.1f seconds (%.1f messages/s, %d errors)' % (
+                self.messages, elapsed, self.messages / elapsed, self.errors)
+            if latencies:
+                line += ', end-to-end latency: p50=%.3fms p99=%.3fms max=%.3fms' % (
+                    percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000,
+                    latencies[-1] * 1000)
+        print line
+        sys.stdout.flush()
+        self.reset()
+
+
 def consume(options):
-    connection = stomp.Connection(host_and_ports=[(options.host, options.port)])
+    connection = stomppy.Connection(
+        host_and_ports=[(options.host, options.port)],
+        user=options.username,
+        passcode=options.password)
     try:
-        connection.set_listener('', SimpleListener())
+        listener = BenchmarkListener() if options.benchmark else SimpleListener()
+        connection.set_listener('', listener)
         connection.start()
         connection.connect()
         connection.subscribe(destination=options.destination, ack='auto')
         while True:
-            time.sleep(60)
+            if options.benchmark:
+                time.sleep(options.interval)
+                listener.report()
+            else:
+                time.sleep(60)
     finally:
         connection.disconnect()
 
@@ -40,14 +97,37 @@ if __name__ == '__main__':
         dest='port',
         default=61613,
         type='int',
-        help='Queue server host (defaults to 61613)',
-        metavar='POST')
+        help='Queue server port (defaults to 61613)',
+        metavar='PORT')
+    parser.add_option(
+        '--username',
+        dest='username',
+        help='Username for authenticated connections',
+        metavar='USERNAME')
+    parser.add_option(
+        '--password',
+        dest='password',
+        help='Password for authenticated connections',
+        metavar='PASSWORD')
     parser.add_option(
         '--destination',
         dest='destination',
         default='/queue/whatever',
         help='Destination name (defaults to /queue/whatever)',
         metavar='QUEUE NAME')
+    parser.add_option(
+        '--benchmark',
+        dest='benchmark',
+        action='store_true',
+        default=False,
+        help='Report receive rate and end-to-end latency instead of printing messages')
+    parser.add_option(
+        '--interval',
+        dest='interval',
+        default=10.0,
+        type='float',
+        help='Seconds between benchmark reports (defaults to 10)',
+        metavar='SECONDS')
 
     (options, args) = parser.parse_args()
     consume(options)
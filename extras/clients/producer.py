@@ -1,20 +1,182 @@
 # -*- coding: utf-8 -*-
 
+'''
+STOMP producer / load generator. Sends a single message by default, or
+--count messages from --workers threads (or processes) at a target --rate,
+reporting the achieved rate and send latency percentiles (per send call, so
+per batch when --batch-size is used). Every message carries its send
+timestamp in the SENT_TIMESTAMP_HEADER header, so consumer.py --benchmark can
+measure end-to-end latency. With --receipt-window, every send requests a
+receipt, and up to N of them are awaited in a pipelined way (instead of one
+blocking round trip per send).
+'''
+
 from __future__ import absolute_import
 from optparse import OptionParser
-import stomp
+import collections
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
 
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', '..', 'stomp', 'bin'))
 
-def produce(options):
-    connection = stomp.Connection(host_and_ports=[(options.host, options.port)])
+import stomppy
+from common import SENT_TIMESTAMP_HEADER, percentile
+
+
+class TokenBucket(object):
+    '''
+    Classic token bucket: tokens are added at 'rate' per second up to
+    'burst', and consume() blocks until a token is available.
+    '''
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst if burst is not None else max(1.0, self.rate / 10.0)
+        self._tokens = self.burst
+        self._last = time.time()
+
+    def consume(self):
+        while True:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return
+            time.sleep((1.0 - self._tokens) / self.rate)
+
+
+class Payloads(object):
+    '''
+    Fixed, random size or file-sourced (one payload per line) message bodies.
+    Binary payloads include NUL bytes, so they are sent with content-length.
+    '''
+    def __init__(self, options):
+        if options.message is not None:
+            self._payloads = [options.message]
+        elif options.payload_file:
+            with open(options.payload_file) as payload_file:
+                self._payloads = [line.rstrip('\r\n') for line in payload_file]
+        else:
+            self._payloads = None
+        self._min = options.payload_size
+        self._max = options.payload_max_size or options.payload_size
+        self._binary = options.binary
+        self._random = random.Random()
+        self._index = 0
+        self._filler = ''.join([chr(32 + i % 95) for i in range(self._max)])
+
+    def next(self):
+        if self._payloads is not None:
+            payload = self._payloads[self._index % len(self._payloads)]
+            self._index += 1
+        else:
+            size = self._random.randint(self._min, self._max)
+            payload = self._filler[:size]
+        if self._binary:
+            payload = '\x00' + payload
+        return payload
+
+
+def produce_worker(options, count, results):
+    connection = stomppy.Connection(
+        host_and_ports=[(options.host, options.port)],
+        user=options.username,
+        passcode=options.password)
+    payloads = Payloads(options)
+    bucket = TokenBucket(options.rate / options.workers) if options.rate else None
+    latencies = []
+    receipts = collections.deque()
     try:
         connection.start()
-        connection.connect()
-        connection.send(options.message, destination=options.destination)
+        connection.connect(wait=True)
+        transaction = None
+        sent = 0
+        while sent < count:
+            batch_size = min(options.batch_size, count - sent)
+            if bucket is not None:
+                for i in range(batch_size):
+                    bucket.consume()
+            if options.transaction_size and transaction is None:
+                transaction = connection.begin()
+            headers = {
+                'destination': options.destination,
+                SENT_TIMESTAMP_HEADER: '%.6f' % time.time(),
+            }
+            if transaction is not None:
+                headers['transaction'] = transaction
+            start = time.time()
+            if options.receipt_window:
+                receipt_id = 'producer-%d' % sent
+                if batch_size > 1:
+                    receipts.append(connection.send_many(
+                        options.destination, [payloads.next() for i in range(batch_size)], headers,
+                        receipt=receipt_id, wait_on_receipt=False))
+                else:
+                    headers['receipt'] = receipt_id
+                    receipts.append(connection.send(payloads.next(), headers))
+                while len(receipts) > options.receipt_window:
+                    receipts.popleft().wait()
+            elif batch_size > 1:
+                connection.send_many(
+                    options.destination, [payloads.next() for i in range(batch_size)], headers)
+            else:
+                connection.send(payloads.next(), headers)
+            latencies.append(time.time() - start)
+            sent += batch_size
+            if transaction is not None and sent % options.transaction_size < batch_size:
+                connection.commit(transaction=transaction)
+                transaction = None
+        if transaction is not None:
+            connection.commit(transaction=transaction)
+        connection.wait_for_receipts(receipts)
     finally:
+        results.put(latencies)
         connection.disconnect()
 
 
+def produce(options):
+    if options.processes:
+        results = multiprocessing.Queue()
+        worker_factory = multiprocessing.Process
+    else:
+        import Queue
+        results = Queue.Queue()
+        worker_factory = threading.Thread
+
+    counts = [options.count // options.workers] * options.workers
+    for i in range(options.count % options.workers):
+        counts[i] += 1
+
+    start = time.time()
+    workers = [
+        worker_factory(target=produce_worker, args=(options, count, results))
+        for count in counts]
+    for worker in workers:
+        worker.start()
+    latencies = []
+    for worker in workers:
+        latencies.extend(results.get())
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start
+
+    if options.count > 1:
+        if not latencies:
+            print '=> No messages sent'
+            return
+        latencies.sort()
+        print '=> Sent %d messages in %.3f seconds (%.1f messages/s)' % (
+            options.count, elapsed, options.count / elapsed)
+        print '=> Send latency: p50=%.3fms p90=%.3fms p99=%.3fms max=%.3fms' % (
+            percentile(latencies, 0.5) * 1000, percentile(latencies, 0.9) * 1000,
+            percentile(latencies, 0.99) * 1000, latencies[-1] * 1000)
+
+
 if __name__ == '__main__':
     parser = OptionParser()
     parser.add_option(
@@ -28,8 +190,18 @@ if __name__ == '__main__':
         dest='port',
         default=61613,
         type='int',
-        help='Queue server host (defaults to 61613)',
-        metavar='POST')
+        help='Queue server port (defaults to 61613)',
+        metavar='PORT')
+    parser.add_option(
+        '--username',
+        dest='username',
+        help='Username for authenticated connections',
+        metavar='USERNAME')
+    parser.add_option(
+        '--password',
+        dest='password',
+        help='Password for authenticated connections',
+        metavar='PASSWORD')
     parser.add_option(
         '--destination',
         dest='destination',
@@ -39,11 +211,85 @@ if __name__ == '__main__':
     parser.add_option(
         '--message',
         dest='message',
-        help='Message contents (required)',
+        help='Fixed message contents',
         metavar='MESSAGE')
+    parser.add_option(
+        '--payload-size',
+        dest='payload_size',
+        default=0,
+        type='int',
+        help='Size of generated payloads in bytes (minimum size if --payload-max-size is set)',
+        metavar='BYTES')
+    parser.add_option(
+        '--payload-max-size',
+        dest='payload_max_size',
+        default=0,
+        type='int',
+        help='Maximum size of randomly sized generated payloads',
+        metavar='BYTES')
+    parser.add_option(
+        '--payload-file',
+        dest='payload_file',
+        help='File with one payload per line, used in turn',
+        metavar='FILE')
+    parser.add_option(
+        '--binary',
+        dest='binary',
+        action='store_true',
+        default=False,
+        help='Prepend a NUL byte to payloads, so they are sent with content-length')
+    parser.add_option(
+        '--count',
+        dest='count',
+        default=1,
+        type='int',
+        help='Number of messages to send (defaults to 1)',
+        metavar='N')
+    parser.add_option(
+        '--rate',
+        dest='rate',
+        default=0.0,
+        type='float',
+        help='Target messages per second across all workers (defaults to 0, unlimited)',
+        metavar='RATE')
+    parser.add_option(
+        '--workers',
+        dest='workers',
+        default=1,
+        type='int',
+        help='Number of concurrent connections (defaults to 1)',
+        metavar='N')
+    parser.add_option(
+        '--processes',
+        dest='processes',
+        action='store_true',
+        default=False,
+        help='Run workers as processes instead of threads')
+    parser.add_option(
+        '--batch-size',
+        dest='batch_size',
+        default=1,
+        type='int',
+        help='Send messages in batches of N frames with a single socket write (defaults to 1)',
+        metavar='N')
+    parser.add_option(
+        '--transaction-size',
+        dest='transaction_size',
+        default=0,
+        type='int',
+        help='Send messages in BEGIN/COMMIT transactions of N messages (defaults to 0, disabled)',
+        metavar='N')
+
+    parser.add_option(
+        '--receipt-window',
+        dest='receipt_window',
+        default=0,
+        type='int',
+        help='Request a receipt for every send, keeping up to N of them outstanding (defaults to 0, no receipts)',
+        metavar='N')
 
     (options, args) = parser.parse_args()
-    if options.message:
+    if options.message is not None or options.payload_size or options.payload_file:
         produce(options)
     else:
         parser.print_help()
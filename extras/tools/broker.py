@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+
+'''
+Minimal in-memory STOMP broker stand-in, good enough to drive the input and
+the tooling in this folder without a real message broker. Supports
+CONNECT/STOMP (negotiating STOMP 1.0 to 1.2), SUBSCRIBE, UNSUBSCRIBE, SEND,
+ACK, NACK, BEGIN, COMMIT, ABORT, DISCONNECT, receipts, server heartbeats,
+queue (round robin, with redelivery of unacked messages on disconnection) and
+topic destinations.
+
+Usage:
+
+    $ python extras/tools/broker.py --port 61613
+'''
+
+import itertools
+import logging
+import os
+import Queue
+import socket
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', '..', 'stomp', 'bin'))
+
+from stomppy import utils
+
+
+class FrameReader(object):
+    '''
+    Splits the incoming byte stream into frames, honouring content-length.
+    '''
+    def __init__(self, sock):
+        self._socket = sock
+        self._buffer = ''
+        # Set once a STOMP 1.1+ connection is negotiated.
+        self.version = 1.0
+
+    def frames(self):
+        while True:
+            data = self._socket.recv(65536)
+            if not data:
+                return
+            self._buffer += data
+            while True:
+                # Skip heartbeats / EOLs between frames.
+                self._buffer = self._buffer.lstrip('\r\n')
+                preamble_end, body_start = utils.find_preamble_end(self._buffer)
+                if preamble_end < 0:
+                    break
+                headers = utils.parse_headers(self._buffer[:preamble_end].split('\n'), 1)
+                if 'content-length' in headers:
+                    end = body_start + int(headers['content-length'])
+                    if len(self._buffer) <= end:
+                        break
+                else:
+                    end = self._buffer.find('\x00', preamble_end)
+                    if end < 0:
+                        break
+                frame = self._buffer[:end]
+                self._buffer = self._buffer[end + 1:]
+                yield utils.parse_frame(frame, True, self.version)
+
+
+class Client(object):
+    def __init__(self, broker, sock, address):
+        self.broker = broker
+        self.socket = sock
+        self.address = address
+        self.subscriptions = {}
+        self.unacked = {}
+        self.transactions = {}
+        self.connected = True
+        self.version = '1.0'
+        self.reader = FrameReader(sock)
+        self.closed = threading.Event()
+        self.threads = []
+        # Outgoing data is written from a dedicated thread, so a slow client
+        # never blocks the broker (or other clients). None stops it.
+        self.outgoing = Queue.Queue()
+        self.start_thread(self.writer_loop)
+
+    def start_thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    def close(self):
+        '''
+        Stop sending data, and stop the writer and heartbeat threads.
+        '''
+        self.connected = False
+        self.closed.set()
+        self.outgoing.put(None)
+
+    def join(self, timeout):
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def send_frame(self, command, headers, body=''):
+        frame = [command + '\n']
+        escape = self.version != '1.0' and command != 'CONNECTED'
+        for key, value in headers.items():
+            if escape:
+                version = float(self.version)
+                key, value = utils.escape_header(str(key), version), utils.escape_header(str(value), version)
+            frame.append('%s:%s\n' % (key, value))
+        frame.append('\n')
+        frame.append(body)
+        frame.append('\x00')
+        self.send_raw(''.join(frame))
+
+    def send_raw(self, data):
+        if self.connected:
+            self.outgoing.put(data)
+
+    def writer_loop(self):
+        while True:
+            data = self.outgoing.get()
+            if data is None:
+                return
+            try:
+                self.socket.sendall(data)
+            except socket.error:
+                self.connected = False
+                return
+
+    def heartbeat_loop(self, interval):
+        while not self.closed.wait(interval):
+            self.send_raw('\n')
+
+    def serve(self):
+        try:
+            for command, headers, body in self.reader.frames():
+                if not self.handle(command, headers, body):
+                    break
+        except socket.error:
+            pass
+        finally:
+            self.close()
+            try:
+                self.socket.close()
+            except socket.error:
+                pass
+            self.broker.remove_client(self)
+
+    def handle(self, command, headers, body):
+        if command in ('CONNECT', 'STOMP'):
+            response = {'session': '%s:%s' % self.address}
+            accepted = headers.get('accept-version', '').split(',')
+            for version in ('1.2', '1.1'):
+                if version in accepted:
+                    self.version = version
+                    self.reader.version = float(version)
+                    break
+            if self.version != '1.0':
+                response['version'] = self.version
+                cx, cy = [int(x) for x in headers.get('heart-beat', '0,0').split(',')]
+                heartbeat = self.broker.heartbeat if cy else 0
+                response['heart-beat'] = '%d,0' % heartbeat
+                if heartbeat:
+                    self.start_thread(self.heartbeat_loop, heartbeat / 1000.0)
+            self.send_frame('CONNECTED', response)
+        elif command == 'SUBSCRIBE':
+            self.broker.subscribe(self, headers.get('id', headers['destination']), headers)
+        elif command == 'UNSUBSCRIBE':
+            self.broker.unsubscribe(self, headers.get('id', headers.get('destination')))
+        elif command == 'SEND':
+            if 'transaction' in headers:
+                self.transactions[headers['transaction']].append((headers, body))
+            else:
+                self.broker.publish(headers, body)
+        elif command == 'BEGIN':
+            self.transactions[headers['transaction']] = []
+        elif command == 'COMMIT':
+            for message_headers, message_body in self.transactions.pop(headers['transaction']):
+                self.broker.publish(message_headers, message_body)
+        elif command == 'ABORT':
+            self.transactions.pop(headers['transaction'], None)
+        elif command in ('ACK', 'NACK'):
+            self.broker.ack(self, headers.get('id', headers.get('message-id')), command == 'NACK')
+        elif command == 'DISCONNECT':
+            if 'receipt' in headers:
+                self.send_frame('RECEIPT', {'receipt-id': headers['receipt']})
+            return False
+        else:
+            self.send_frame('ERROR', {'message': 'Unknown command %s' % command})
+            return False
+
+        if 'receipt' in headers:
+            self.send_frame('RECEIPT', {'receipt-id': headers['receipt']})
+        return True
+
+
+class Broker(object):
+    def __init__(self, host='127.0.0.1', port=0, heartbeat=0):
+        self.heartbeat = heartbeat
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((host, port))
+        self._server.listen(128)
+        self._lock = threading.RLock()
+        self._clients = set()
+        self._queues = {}
+        self._round_robin = {}
+        self._message_ids = itertools.count(1)
+        self._running = False
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._server.getsockname()
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=5):
+        '''
+        Stop accepting connections, disconnect clients and wait (at most
+        timeout seconds per thread) for the broker threads to end.
+        '''
+        with self._lock:
+            self._running = False
+            clients = list(self._clients)
+        try:
+            # Unlike close(), shutdown() wakes a blocked accept().
+            self._server.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        try:
+            self._server.close()
+        except socket.error:
+            pass
+        for client in clients:
+            client.close()
+            try:
+                client.socket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        if self._thread is not None:
+            self._thread.join(timeout)
+        for client in clients:
+            client.join(timeout)
+
+    def serve_forever(self):
+        while self._running:
+            try:
+                sock, address = self._server.accept()
+            except socket.error:
+                break
+            with self._lock:
+                if not self._running:
+                    sock.close()
+                    break
+                client = Client(self, sock, address)
+                self._clients.add(client)
+                client.start_thread(client.serve)
+
+    def remove_client(self, client):
+        with self._lock:
+            self._clients.discard(client)
+            # Requeue anything the client did not acknowledge (queues only).
+            for message_id, (destination, headers, body) in sorted(client.unacked.items()):
+                if destination.startswith('/topic/'):
+                    continue
+                headers = dict(headers, redelivered='true')
+                self._queues.setdefault(destination, []).append((headers, body))
+            client.unacked.clear()
+            client.subscriptions.clear()
+            self._deliver_all()
+
+    def subscribe(self, client, id, headers):
+        with self._lock:
+            client.subscriptions[id] = headers
+            self._deliver_all()
+
+    def unsubscribe(self, client, id):
+        with self._lock:
+            client.subscriptions.pop(id, None)
+
+    def publish(self, headers, body):
+        headers = dict([
+            (key, value) for key, value in headers.items()
+            if key not in ('receipt', 'transaction')])
+        with self._lock:
+            headers['message-id'] = 'ID:broker-%d' % next(self._message_ids)
+            if headers['destination'].startswith('/topic/'):
+                for client, id, subscription in self._subscribers(headers['destination']):
+                    self._deliver(client, id, subscription, headers, body)
+            else:
+                self._queues.setdefault(headers['destination'], []).append((headers, body))
+                self._deliver_all()
+
+    def ack(self, client, message_id, nack):
+        with self._lock:
+            message = client.unacked.pop(message_id, None)
+            if message is not None and nack:
+                destination, headers, body = message
+                self._queues.setdefault(destination, []).append((headers, body))
+                self._deliver_all()
+
+    def _subscribers(self, destination):
+        return [
+            (client, id, subscription)
+            for client in self._clients if client.connected
+            for id, subscription in client.subscriptions.items()
+            if subscription['destination'] == destination]
+
+    def _deliver_all(self):
+        for destination, messages in self._queues.items():
+            subscribers = self._subscribers(destination)
+            while messages and subscribers:
+                index = self._round_robin.get(destination, 0) % len(subscribers)
+                self._round_robin[destination] = index + 1
+                client, id, subscription = subscribers[index]
+                headers, body = messages.pop(0)
+                self._deliver(client, id, subscription, headers, body)
+
+    def _deliver(self, client, id, subscription, headers, body):
+        headers = dict(headers, subscription=id)
+        if client.version == '1.2':
+            headers['ack'] = headers['message-id']
+        if subscription.get('ack', 'auto') != 'auto':
+            client.unacked[headers['message-id']] = (headers['destination'], headers, body)
+        client.send_frame('MESSAGE', headers, body)
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option(
+        '--host',
+        dest='host',
+        default='127.0.0.1',
+        help='Address to listen on (defaults to 127.0.0.1)',
+        metavar='HOST')
+    parser.add_option(
+        '--port',
+        dest='port',
+        default=61613,
+        type='int',
+        help='Port to listen on (defaults to 61613)',
+        metavar='PORT')
+    parser.add_option(
+        '--heartbeat',
+        dest='heartbeat',
+        default=0,
+        type='int',
+        help='Server heartbeat interval in ms offered to 1.1 clients (defaults to 0)',
+        metavar='MS')
+
+    (options, args) = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    broker = Broker(options.host, options.port, options.heartbeat).start()
+    logging.info('Listening on %s:%d', *broker.address)
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        broker.stop()
@@ -0,0 +1,554 @@
+# -*- coding: utf-8 -*-
+
+'''
+Fault-injection proxy and soak harness. A TCP proxy sits in front of the
+broker (the in-memory stand-in from broker.py by default) and injects
+latency, connection drops and resets, read stalls, frames split at arbitrary
+byte boundaries and withheld heartbeats, while a consumer mimicking the
+modular input reconnect loop reads a sequence-numbered stream through it.
+
+A JSON summary is written at the end (time-to-recover, messages lost or
+duplicated, thread count and RSS growth, per-connection state sizes) and the
+exit status is non-zero if any of the --max-* limits is exceeded, so it can
+be used for CI gating.
+
+Usage:
+
+    $ python extras/tools/chaos.py --duration 600 --drop-rate 0.05 --split --report report.json
+    $ python extras/tools/chaos.py --broker 127.0.0.1:61613 --duration 14400 --reset-rate 0.01
+'''
+
+import json
+import logging
+import os
+import random
+import resource
+import socket
+import struct
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', '..', 'stomp', 'bin'))
+
+import stomppy
+import broker
+
+
+class FaultProxy(object):
+    '''
+    TCP proxy injecting faults in the broker -> client direction (and latency
+    in both directions).
+    '''
+    def __init__(self, upstream, options):
+        self.upstream = upstream
+        self.options = options
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(('127.0.0.1', 0))
+        self._server.listen(16)
+        self._lock = threading.Lock()
+        self._pairs = []
+        self._running = False
+        self.faults = {'drops': 0, 'resets': 0, 'stalls': 0, 'heartbeats_withheld': 0}
+
+    @property
+    def address(self):
+        return self._server.getsockname()
+
+    def start(self):
+        self._running = True
+        for target in (self._accept_loop, self._chaos_loop):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        self._server.close()
+        with self._lock:
+            pairs = list(self._pairs)
+        for pair in pairs:
+            self._close(pair, reset=False)
+
+    def _accept_loop(self):
+        while self._running:
+            try:
+                client, address = self._server.accept()
+            except socket.error:
+                break
+            try:
+                upstream = socket.create_connection(self.upstream)
+            except socket.error:
+                client.close()
+                continue
+            pair = {'client': client, 'upstream': upstream, 'stalled_until': 0}
+            with self._lock:
+                self._pairs.append(pair)
+            for source, sink, faulty in ((upstream, client, True), (client, upstream, False)):
+                thread = threading.Thread(target=self._pump, args=(pair, source, sink, faulty))
+                thread.daemon = True
+                thread.start()
+
+    def _chaos_loop(self):
+        # Once per second, roll the dice for every proxied connection.
+        while self._running:
+            time.sleep(1)
+            with self._lock:
+                pairs = list(self._pairs)
+            for pair in pairs:
+                roll = random.random()
+                if roll < self.options.reset_rate:
+                    self.faults['resets'] += 1
+                    self._close(pair, reset=True)
+                elif roll < self.options.reset_rate + self.options.drop_rate:
+                    self.faults['drops'] += 1
+                    self._close(pair, reset=False)
+                elif random.random() < self.options.stall_rate:
+                    self.faults['stalls'] += 1
+                    pair['stalled_until'] = time.time() + self.options.stall_time
+
+    def _close(self, pair, reset):
+        with self._lock:
+            if pair in self._pairs:
+                self._pairs.remove(pair)
+        for sock in (pair['client'], pair['upstream']):
+            try:
+                if reset:
+                    # SO_LINGER with a zero timeout makes close() send a RST.
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+                else:
+                    sock.shutdown(socket.SHUT_RDWR)
+                sock.close()
+            except socket.error:
+                pass
+
+    def _withhold_heartbeats(self, pair, data):
+        # Drop EOLs found between frames. Bodies containing NUL bytes
+        # (content-length frames) may confuse this simple tracking.
+        result = []
+        between_frames = pair.get('between_frames', True)
+        for c in data:
+            if between_frames and c == '\n':
+                self.faults['heartbeats_withheld'] += 1
+                continue
+            between_frames = c == '\x00'
+            result.append(c)
+        pair['between_frames'] = between_frames
+        return ''.join(result)
+
+    def _pump(self, pair, source, sink, faulty):
+        try:
+            while True:
+                data = source.recv(65536)
+                if not data:
+                    break
+                if self.options.latency:
+                    time.sleep(self.options.latency / 1000.0)
+                if faulty:
+                    while time.time() < pair['stalled_until']:
+                        time.sleep(0.05)
+                    if self.options.withhold_heartbeats:
+                        data = self._withhold_heartbeats(pair, data)
+                    if self.options.split:
+                        while len(data) > 1:
+                            cut = random.randint(1, len(data))
+                            sink.sendall(data[:cut])
+                            data = data[cut:]
+                            time.sleep(0.001)
+                if data:
+                    sink.sendall(data)
+        except socket.error:
+            pass
+        finally:
+            self._close(pair, reset=False)
+
+
+class Producer(object):
+    '''
+    Sends sequence-numbered messages straight to the broker at a fixed rate.
+    '''
+    def __init__(self, address, destination, rate):
+        self.address = address
+        self.destination = destination
+        self.rate = rate
+        self.sent = 0
+        self._running = False
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        self._thread.join(10)
+
+    def _loop(self):
+        connection = stomppy.Connection(host_and_ports=[self.address])
+        connection.start()
+        connection.connect(wait=True)
+        try:
+            interval = 1.0 / self.rate
+            next_send = time.time()
+            while self._running:
+                connection.send('seq=%d' % self.sent, destination=self.destination)
+                self.sent += 1
+                next_send += interval
+                delay = next_send - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+        finally:
+            connection.disconnect()
+
+
+class Consumer(object):
+    '''
+    Consumes through the proxy, mimicking the modular input run() loop: a new
+    stomppy.Connection after every drop, explicit ACKs, one second back-off.
+    '''
+    def __init__(self, address, destination):
+        self.address = address
+        self.destination = destination
+        self.received = {}
+        self.reconnects = 0
+        self.connect_timeouts = 0
+        self.recovery_times = []
+        self.lost_at = None
+        self.connection = None
+        self._running = False
+
+    def on_message(self, headers, message):
+        seq = int(message.split('=', 1)[1])
+        self.received[seq] = self.received.get(seq, 0) + 1
+        self.connection.ack(**{
+            'message-id': headers['message-id'],
+            'subscription': headers['subscription'],
+        })
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        self._thread.join(10)
+
+    def _wait_connected(self, connection, timeout):
+        # Unlike connect(wait=True), give up if the connection is lost before
+        # the CONNECTED frame arrives.
+        end = time.time() + timeout
+        while not connection.is_connected():
+            if time.time() > end:
+                self.connect_timeouts += 1
+                raise Exception('Timed out waiting for CONNECTED frame')
+            time.sleep(0.05)
+
+    def _loop(self):
+        while self._running:
+            connection = None
+            try:
+                connection = stomppy.Connection(
+                    host_and_ports=[self.address], version=1.1, heartbeats=(0, 1000))
+                self.connection = connection
+                connection.set_listener('', self)
+                connection.start()
+                connection.connect()
+                self._wait_connected(connection, 10)
+                connection.subscribe(**{
+                    'destination': self.destination,
+                    'ack': 'client',
+                    'id': 'splunk-stomp-chaos',
+                    'receipt': 'subscribe-%d' % self.reconnects,
+                })
+                if self.lost_at is not None:
+                    self.recovery_times.append(time.time() - self.lost_at)
+                    self.lost_at = None
+                while self._running and connection.is_connected():
+                    time.sleep(0.1)
+            except Exception as e:
+                logging.debug('Consumer got exception: %s', e)
+            finally:
+                if connection is not None:
+                    try:
+                        connection.disconnect()
+                    except Exception:
+                        pass
+            if self._running:
+                if self.lost_at is None:
+                    self.lost_at = time.time()
+                    self.reconnects += 1
+                time.sleep(1)
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        # Peak RSS: KB on Linux, bytes on OS X.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def connection_state_sizes(connection):
+    '''
+    Sizes of per-connection containers that could grow without bound.
+    '''
+    sizes = {}
+    if connection is not None:
+        for name in ('receipts', 'listeners', 'recvbuf'):
+            value = getattr(connection, '_Connection__%s' % name, None)
+            if value is not None:
+                sizes[name] = len(value)
+    return sizes
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def soak(options):
+    stand_in = None
+    if options.broker:
+        host, port = options.broker.rsplit(':', 1)
+        upstream = (host, int(port))
+    else:
+        stand_in = broker.Broker(heartbeat=options.heartbeat).start()
+        upstream = stand_in.address
+
+    proxy = FaultProxy(upstream, options).start()
+    consumer = Consumer(proxy.address, options.destination).start()
+    producer = Producer(upstream, options.destination, options.rate).start()
+
+    samples = []
+    start = time.time()
+    try:
+        while time.time() - start < options.duration:
+            time.sleep(options.sample_interval)
+            sample = {
+                'elapsed': time.time() - start,
+                'threads': threading.active_count(),
+                'rss': rss_bytes(),
+                'connection': connection_state_sizes(consumer.connection),
+            }
+            samples.append(sample)
+            logging.info('Soak sample: %s', json.dumps(sample, sort_keys=True))
+    finally:
+        producer.stop()
+
+    # Give the consumer some time to drain what is left in the broker.
+    rates = {'drop': options.drop_rate, 'reset': options.reset_rate, 'stall': options.stall_rate}
+    options.drop_rate = options.reset_rate = options.stall_rate = 0
+    drain_end = time.time() + options.drain_time
+    while time.time() < drain_end and len(consumer.received) < producer.sent:
+        time.sleep(0.5)
+    consumer.stop()
+    proxy.stop()
+    if stand_in is not None:
+        stand_in.stop()
+
+    received = consumer.received
+    report = {
+        'duration': options.duration,
+        'faults': dict(proxy.faults, rates=rates),
+        'messages': {
+            'sent': producer.sent,
+            'received': sum(received.values()),
+            'lost': len([seq for seq in range(producer.sent) if seq not in received]),
+            'duplicated': sum([count - 1 for count in received.values() if count > 1]),
+        },
+        'reconnects': consumer.reconnects,
+        'connect_timeouts': consumer.connect_timeouts,
+        'unrecovered': consumer.lost_at is not None,
+        'recovery_time': {
+            'min': min(consumer.recovery_times) if consumer.recovery_times else None,
+            'p95': percentile(consumer.recovery_times, 0.95),
+            'max': max(consumer.recovery_times) if consumer.recovery_times else None,
+        },
+        'threads': {
+            'first': samples[0]['threads'] if samples else None,
+            'last': samples[-1]['threads'] if samples else None,
+            'max': max([sample['threads'] for sample in samples]) if samples else None,
+        },
+        'rss': {
+            'first': samples[0]['rss'] if samples else None,
+            'last': samples[-1]['rss'] if samples else None,
+            'growth': samples[-1]['rss'] - samples[0]['rss'] if samples else None,
+        },
+        'connection': samples[-1]['connection'] if samples else {},
+    }
+
+    failures = []
+    if report['unrecovered']:
+        failures.append('consumer did not recover from the last connection loss')
+    if options.max_lost is not None and report['messages']['lost'] > options.max_lost:
+        failures.append('lost messages %d > %d' % (report['messages']['lost'], options.max_lost))
+    if options.max_duplicated is not None and report['messages']['duplicated'] > options.max_duplicated:
+        failures.append('duplicated messages %d > %d' % (report['messages']['duplicated'], options.max_duplicated))
+    if options.max_recovery is not None and report['recovery_time']['max'] is not None and \
+       report['recovery_time']['max'] > options.max_recovery:
+        failures.append('recovery time %.1fs > %.1fs' % (report['recovery_time']['max'], options.max_recovery))
+    if options.max_rss_growth is not None and report['rss']['growth'] is not None and \
+       report['rss']['growth'] > options.max_rss_growth * 1048576:
+        failures.append('RSS growth %d bytes > %d MB' % (report['rss']['growth'], options.max_rss_growth))
+    if options.max_thread_growth is not None and samples and \
+       report['threads']['last'] - report['threads']['first'] > options.max_thread_growth:
+        failures.append('thread growth %d > %d' % (
+            report['threads']['last'] - report['threads']['first'], options.max_thread_growth))
+    report['failures'] = failures
+    report['passed'] = not failures
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.report:
+        with open(options.report, 'w') as report_file:
+            report_file.write(output)
+    sys.stdout.write(output + '\n')
+    return 0 if not failures else 1
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option(
+        '--broker',
+        dest='broker',
+        help='Real broker to put the proxy in front of (defaults to an in-memory stand-in)',
+        metavar='HOST:PORT')
+    parser.add_option(
+        '--destination',
+        dest='destination',
+        default='/queue/chaos',
+        help='Destination name (defaults to /queue/chaos)',
+        metavar='DESTINATION')
+    parser.add_option(
+        '--duration',
+        dest='duration',
+        default=60.0,
+        type='float',
+        help='Soak duration in seconds (defaults to 60)',
+        metavar='SECONDS')
+    parser.add_option(
+        '--rate',
+        dest='rate',
+        default=100.0,
+        type='float',
+        help='Messages produced per second (defaults to 100)',
+        metavar='RATE')
+    parser.add_option(
+        '--heartbeat',
+        dest='heartbeat',
+        default=500,
+        type='int',
+        help='Stand-in broker heartbeat interval in ms (defaults to 500)',
+        metavar='MS')
+    parser.add_option(
+        '--latency',
+        dest='latency',
+        default=0,
+        type='int',
+        help='Latency in ms added to every proxied chunk (defaults to 0)',
+        metavar='MS')
+    parser.add_option(
+        '--drop-rate',
+        dest='drop_rate',
+        default=0.0,
+        type='float',
+        help='Per second probability of closing a proxied connection (defaults to 0)',
+        metavar='P')
+    parser.add_option(
+        '--reset-rate',
+        dest='reset_rate',
+        default=0.0,
+        type='float',
+        help='Per second probability of resetting a proxied connection (defaults to 0)',
+        metavar='P')
+    parser.add_option(
+        '--stall-rate',
+        dest='stall_rate',
+        default=0.0,
+        type='float',
+        help='Per second probability of stalling reads on a proxied connection (defaults to 0)',
+        metavar='P')
+    parser.add_option(
+        '--stall-time',
+        dest='stall_time',
+        default=5.0,
+        type='float',
+        help='Duration in seconds of read stalls (defaults to 5)',
+        metavar='SECONDS')
+    parser.add_option(
+        '--split',
+        dest='split',
+        action='store_true',
+        default=False,
+        help='Split frames at random byte boundaries')
+    parser.add_option(
+        '--withhold-heartbeats',
+        dest='withhold_heartbeats',
+        action='store_true',
+        default=False,
+        help='Drop broker heartbeats')
+    parser.add_option(
+        '--sample-interval',
+        dest='sample_interval',
+        default=5.0,
+        type='float',
+        help='Seconds between resource usage samples (defaults to 5)',
+        metavar='SECONDS')
+    parser.add_option(
+        '--drain-time',
+        dest='drain_time',
+        default=30.0,
+        type='float',
+        help='Seconds allowed to consume pending messages at the end (defaults to 30)',
+        metavar='SECONDS')
+    parser.add_option(
+        '--report',
+        dest='report',
+        help='JSON file where the summary report will be saved',
+        metavar='FILE')
+    parser.add_option(
+        '--max-lost',
+        dest='max_lost',
+        type='int',
+        help='Fail if more than N messages are lost',
+        metavar='N')
+    parser.add_option(
+        '--max-duplicated',
+        dest='max_duplicated',
+        type='int',
+        help='Fail if more than N messages are received more than once',
+        metavar='N')
+    parser.add_option(
+        '--max-recovery',
+        dest='max_recovery',
+        type='float',
+        help='Fail if any reconnection takes longer than SECONDS',
+        metavar='SECONDS')
+    parser.add_option(
+        '--max-rss-growth',
+        dest='max_rss_growth',
+        type='int',
+        help='Fail if RSS grows more than MB megabytes',
+        metavar='MB')
+    parser.add_option(
+        '--max-thread-growth',
+        dest='max_thread_growth',
+        type='int',
+        help='Fail if the thread count grows by more than N',
+        metavar='N')
+
+    (options, args) = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger('stomp.py').setLevel(logging.WARNING)
+    sys.exit(soak(options))
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+
+'''
+Records the raw byte stream received from a STOMP broker (including timing)
+and replays it into stomppy.Connection, at recorded speed or as fast as
+possible, for deterministic performance testing without a live broker.
+
+Usage:
+
+    $ python extras/tools/wiretap.py record --destination /queue/whatever --duration 60 capture.wiretap
+    $ python extras/tools/wiretap.py replay --speed 0 --splunk capture.wiretap
+'''
+
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', '..', 'stomp', 'bin'))
+
+import stomppy
+
+
+MAGIC = 'STOMP-WIRETAP 1\n'
+RECORD_HEADER = struct.Struct('!dI')
+
+
+class WiretapWriter(object):
+    '''
+    Appends (elapsed seconds, raw data) records to a capture file. Used as a
+    stomppy.Connection receive tap.
+    '''
+    def __init__(self, path):
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC)
+        self._start = time.time()
+        self._lock = threading.Lock()
+        self.records = 0
+        self.bytes = 0
+
+    def __call__(self, data):
+        with self._lock:
+            self._file.write(RECORD_HEADER.pack(time.time() - self._start, len(data)))
+            self._file.write(data)
+            self.records += 1
+            self.bytes += len(data)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read_records(path):
+    '''
+    Yield (elapsed seconds, raw data) records from a capture file.
+    '''
+    with open(path, 'rb') as input:
+        if input.read(len(MAGIC)) != MAGIC:
+            raise Exception("'%s' is not a wiretap capture file." % path)
+        while True:
+            header = input.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            elapsed, length = RECORD_HEADER.unpack(header)
+            yield elapsed, input.read(length)
+
+
+class CountingListener(object):
+    def __init__(self):
+        self.messages = 0
+        self.errors = 0
+        self.disconnected = threading.Event()
+
+    def on_message(self, headers, message):
+        self.messages += 1
+
+    def on_error(self, headers, message):
+        self.errors += 1
+
+    def on_disconnected(self):
+        self.disconnected.set()
+
+
+def record(options, path):
+    writer = WiretapWriter(path)
+    connection = stomppy.Connection(
+        host_and_ports=[(options.host, options.port)],
+        user=options.username,
+        passcode=options.password,
+        version=1.1,
+        heartbeats=(0, options.heartbeats))
+    connection.set_receive_tap(writer)
+    try:
+        connection.start()
+        connection.connect(wait=True)
+        connection.subscribe(**{
+            'destination': options.destination,
+            'ack': 'auto',
+            'id': 'splunk-stomp-wiretap',
+        })
+        end = time.time() + options.duration
+        while time.time() < end and connection.is_connected():
+            time.sleep(0.2)
+    finally:
+        try:
+            connection.disconnect()
+        except Exception:
+            pass
+        writer.close()
+
+    sys.stderr.write('Recorded %d chunks, %d bytes\n' % (writer.records, writer.bytes))
+    return 0
+
+
+def serve_capture(server, path, speed):
+    '''
+    Accept a single client and stream the capture to it. Whatever the client
+    sends (CONNECT, SUBSCRIBE, ACK frames, etc.) is read and discarded.
+    '''
+    client, address = server.accept()
+    server.close()
+
+    def drain():
+        try:
+            while client.recv(65536):
+                pass
+        except socket.error:
+            pass
+    drainer = threading.Thread(target=drain)
+    drainer.daemon = True
+    drainer.start()
+
+    try:
+        start = time.time()
+        for elapsed, data in read_records(path):
+            if speed > 0:
+                delay = start + elapsed / speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            client.sendall(data)
+    finally:
+        client.shutdown(socket.SHUT_RDWR)
+        client.close()
+
+
+def replay(options, path):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    server_thread = threading.Thread(
+        target=serve_capture, args=(server, path, options.speed))
+    server_thread.daemon = True
+    server_thread.start()
+
+    connection = stomppy.Connection(host_and_ports=[server.getsockname()])
+    listener = CountingListener()
+    connection.set_listener('counter', listener)
+
+    # Optionally run the full Splunk output path (with output sent to
+    # /dev/null), so output changes can also be measured.
+    devnull = None
+    stdout = sys.stdout
+    if options.splunk:
+        import stomp
+        devnull = open(os.devnull, 'w')
+        sys.stdout = devnull
+        connection.set_listener('splunk', stomp.SplunkListener(connection, False))
+
+    try:
+        start = time.time()
+        connection.start()
+        connection.connect()
+        listener.disconnected.wait()
+        elapsed = time.time() - start
+    finally:
+        sys.stdout = stdout
+        if devnull is not None:
+            devnull.close()
+
+    total = sum([len(data) for elapsed_, data in read_records(path)])
+    sys.stdout.write('Replayed %d messages (%d errors), %d bytes in %.3f seconds\n' % (
+        listener.messages, listener.errors, total, elapsed))
+    sys.stdout.write('%.1f messages/s, %.2f MB/s\n' % (
+        listener.messages / elapsed, total / elapsed / 1048576.0))
+    return 0
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog record [options] FILE | %prog replay [options] FILE')
+    parser.add_option(
+        '--host',
+        dest='host',
+        default='localhost',
+        help='Queue server host (defaults to localhost, record only)',
+        metavar='HOST')
+    parser.add_option(
+        '--port',
+        dest='port',
+        default=61613,
+        type='int',
+        help='Queue server port (defaults to 61613, record only)',
+        metavar='PORT')
+    parser.add_option(
+        '--username',
+        dest='username',
+        help='Username for authenticated connections (record only)',
+        metavar='USERNAME')
+    parser.add_option(
+        '--password',
+        dest='password',
+        help='Password for authenticated connections (record only)',
+        metavar='PASSWORD')
+    parser.add_option(
+        '--destination',
+        dest='destination',
+        default='/queue/whatever',
+        help='Destination name (defaults to /queue/whatever, record only)',
+        metavar='DESTINATION')
+    parser.add_option(
+        '--duration',
+        dest='duration',
+        default=60.0,
+        type='float',
+        help='Recording duration in seconds (defaults to 60, record only)',
+        metavar='SECONDS')
+    parser.add_option(
+        '--heartbeats',
+        dest='heartbeats',
+        default=0,
+        type='int',
+        help='Heartbeat interval in ms requested to the broker (defaults to 0, record only)',
+        metavar='MS')
+    parser.add_option(
+        '--speed',
+        dest='speed',
+        default=1.0,
+        type='float',
+        help='Replay speed factor, 0 means as fast as possible (defaults to 1, replay only)',
+        metavar='FACTOR')
+    parser.add_option(
+        '--splunk',
+        dest='splunk',
+        action='store_true',
+        default=False,
+        help='Also run the Splunk output path, writing to /dev/null (replay only)')
+
+    (options, args) = parser.parse_args()
+    if len(args) == 2 and args[0] == 'record':
+        sys.exit(record(options, args[1]))
+    elif len(args) == 2 and args[0] == 'replay':
+        sys.exit(replay(options, args[1]))
+    else:
+        parser.print_help()
+        sys.exit(2)
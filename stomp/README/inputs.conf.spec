@@ -5,3 +5,178 @@ password = <value>
 use_explicit_acks = <value>
 use_persistent_subscription = <value>
 subscription_id = <value>
+strip_newlines = <bool>
+* Replace line breaks (CRLF, CR or LF) in message bodies with a space.
+collapse_crlf = <bool>
+* Replace CRLF line endings in message bodies with LF.
+strip_trailing_whitespace = <bool>
+* Remove trailing whitespace from every line and from the end of message
+  bodies.
+index_headers = <value>
+* Comma separated list of message header names or glob patterns (e.g.
+  message-id, destination, JMSX*) to be indexed with each event.
+index_headers_format = kv|json
+* How indexed headers are rendered: key="value" pairs before the message body
+  (kv, default), or a JSON envelope with 'headers' and 'body' keys (json).
+  In JSON envelopes, bodies which are not UTF-8 text are base64 encoded and
+  flagged with an 'encoding' key.
+source_header = <value>
+* Message header whose value is used as the event source.
+host_header = <value>
+* Message header whose value is used as the event host.
+body_encoding = gzip|deflate|auto|none
+* Encoding of message bodies without an encoding header. 'auto' detects gzip
+  and zlib compressed bodies, 'none' disables decompression (also ignoring the
+  encoding header). Defaults to plain bodies.
+encoding_header = <value>
+* Message header declaring the body encoding (gzip, deflate or identity).
+  Bodies with any other encoding (e.g. a charset) are indexed as is.
+  Defaults to content-encoding.
+max_inflated_size = <value>
+* Maximum size in bytes of decompressed message bodies (defaults to
+  104857600). Larger messages, like corrupt compressed ones, are logged and
+  dropped (ACKed when using explicit ACKs, so they are not redelivered).
+large_body_threshold = <value>
+* Message bodies of at least this many bytes (as declared by their
+  content-length header) are spooled to a temporary file while received and
+  streamed into Splunk in bounded chunks, instead of being held in memory as
+  a whole (defaults to 1048576, 0 disables spooling). Their events are
+  assembled in a temporary file too, so a read error never leaves a
+  truncated event.
+split_mode = delimiter|json_array|length_prefixed|none
+* Split multi-record message bodies into separate events, written as a single
+  batch (the message is still ACKed once): by delimiter (see split_delimiter),
+  one event per JSON array element, or length prefixed records (4 bytes, big
+  endian length before every record). Bodies that can't be split are indexed
+  as a single event. Spooled (see large_body_threshold) and compressed bodies
+  are split in a single pass as they are read, never held whole in memory, and
+  written in batches of about 1MB: if they can't be split past the first
+  batch, the written records are kept and the rest of the message is dropped
+  (and logged). Defaults to none.
+split_delimiter = <value>
+* Record delimiter for the delimiter split mode. Backslash escapes (e.g. \r\n)
+  are allowed. Defaults to \n.
+time_header = <value>
+* Message header holding the event time (e.g. timestamp or JMSTimestamp), as
+  epoch seconds, milliseconds or microseconds (guessed from the magnitude) or
+  as an ISO 8601 date. Events are sent with an explicit time, so timestamp
+  extraction can be disabled (DATETIME_CONFIG = NONE) in their sourcetype.
+time_json_field = <value>
+* JSON body field holding the event time (used if time_header is not set or
+  missing), in the same formats as time_header. The field is looked up
+  without parsing the body (only in its first 64KB for large or compressed
+  bodies).
+time_fallback = arrival|none
+* Event time used when it can't be extracted: the message arrival time
+  (arrival) or none, leaving it to Splunk (default).
+routing_header = <value>
+* Message header (e.g. type) whose value selects the routing rule applied to
+  each message (defaults to destination, see destinations).
+routing_rules = <value>
+* Semicolon separated rules mapping routing header values or glob patterns to
+  event fields, tried in order, e.g.:
+    order => index=sales, sourcetype=order; audit* => sourcetype=audit
+  Supported fields: index, sourcetype, source and host. They override the
+  stanza settings (and source_header / host_header) for matching messages.
+selector = <value>
+* Broker-side message selector sent with the subscription (e.g. a JMS SQL92
+  selector for ActiveMQ: type = 'order').
+filter = <value>
+* Comma separated header predicates, all of them required for a message to be
+  indexed: name=value, name!=value (values may be glob patterns), name (header
+  present) or !name (header missing). Filtered out messages are dropped
+  before any processing, but still ACKed.
+sample_rate = <value>
+* Index only 1 in N messages, deterministically chosen by a hash (CRC32) of
+  their message-id. Skipped messages are still ACKed. Defaults to 1 (all
+  messages).
+dedup = <bool>
+* Remember the message-id of indexed messages, so messages redelivered by the
+  broker (e.g. un-ACKed messages after a reconnection when using explicit ACKs
+  and persistent subscriptions) are not indexed twice. Messages flagged as not
+  redelivered (redelivered:false) are never dropped. Remembered ids are saved
+  to the checkpoint directory every 30 seconds (and on shutdown), together
+  with hit rate and memory usage stats in the log.
+dedup_capacity = <value>
+* Number of remembered message ids, the oldest ones being forgotten first
+  (defaults to 100000). Memory usage is 16 to 24 bytes per id.
+validation_timeout = <value>
+* Seconds allowed to the broker to accept a TCP connection and answer a STOMP
+  CONNECT frame when the input is validated (defaults to 5). Successful
+  checks are cached in the checkpoint directory for 60 seconds, by broker and
+  username (a password change within that time is not checked again).
+use_ssl = <bool>
+* Connect to the broker using TLS. The TLS context (and its CA certificates)
+  is built once per input and reused when reconnecting. TLS sessions are not
+  resumed (python 2 can't), so every reconnection does a full handshake.
+ssl_min_version = 1.2|1.3
+* Oldest TLS version accepted (defaults to 1.2).
+ssl_verify = <bool>
+* Verify the broker certificate (defaults to true).
+ssl_check_hostname = <bool>
+* Check the broker certificate matches its host name (defaults to true).
+ssl_ca_certs = <value>
+* File with the CA certificates (PEM) used to verify the broker certificate
+  (defaults to the system CA certificates).
+ssl_cert_file = <value>
+* Client certificate file (PEM), for brokers requiring client authentication.
+ssl_key_file = <value>
+* Private key of the client certificate (if not included in ssl_cert_file).
+ssl_ciphers = <value>
+* OpenSSL cipher list (defaults to the python defaults).
+tcp_nodelay = <bool>
+* Disable Nagle's algorithm (TCP_NODELAY), so small frames (e.g. ACKs) are
+  sent straight away instead of waiting for outstanding data to be
+  acknowledged by the broker.
+tcp_quickack = <bool>
+* Acknowledge received data straight away instead of delaying TCP ACKs
+  (TCP_QUICKACK, Linux only). Together with tcp_nodelay, this avoids ~40ms
+  stalls per round trip with explicit ACKs on some brokers. The kernel leaves
+  quickack mode on its own, so it is set again after every socket read.
+tcp_keepalive = <value>
+* Enable TCP keepalive probes, with the system defaults (true) or the given
+  idle,interval,count times in seconds (e.g. 60,10,5; Linux only).
+receive_buffer_size = <value>
+* Socket receive buffer size in bytes (SO_RCVBUF). Defaults to the system
+  default (auto tuned on Linux).
+ack_coalesce_ms = <value>
+* When using explicit ACKs, queue ACK / NACK frames for up to this many
+  milliseconds and write all the queued ones with a single socket write,
+  instead of one packet per ACK (defaults to 0, disabled). Queued frames are
+  also written before any other frame, so the order of frames is kept (and
+  they are written before DISCONNECT when the input stops).
+stomp_version = 1.0|1.1|1.2
+* Highest STOMP protocol version to negotiate with the broker (defaults to
+  1.2). With 1.1+, header values are escaped, so they can contain colons and
+  newlines. With 1.2, messages are ACKed by their 'ack' header (cheaper for
+  brokers like RabbitMQ) and CRLF line endings are accepted.
+dispatch_workers = <value>
+* Process messages on this many worker threads instead of the connection
+  receiver thread, so slow processing (decompression, splitting) doesn't
+  stop receipts and heartbeats from being read (defaults to 0, disabled).
+  Messages of the same subscription are processed by the same worker, in
+  order: set dispatch_group_header to process a single subscription in
+  parallel. With explicit ACKs and several workers, messages are ACKed
+  individually: the subscription ack mode switches from client to
+  client-individual (on STOMP 1.1+ connections), which brokers without STOMP
+  1.1 ack modes reject. Use a single worker, or stomp_version = 1.0, with
+  them.
+dispatch_queue_size = <value>
+* Maximum number of messages waiting for every dispatch worker (defaults to
+  100). Once a worker's queue is full, the connection stops reading until
+  the worker catches up.
+dispatch_group_header = <value>
+* Header grouping messages (e.g. JMSXGroupID). Messages of different groups
+  are processed in parallel by the dispatch workers, messages of the same
+  group keep their order.
+destinations = <value>
+* Comma separated list of destinations subscribed over the same connection,
+  after the one in the stanza name, e.g. destinations = /topic/app.> for
+  [stomp://localhost:61613/queue/orders]. The stanza name destination is
+  always a single subscription (a comma separated name stays one ActiveMQ
+  composite destination). Broker wildcards (e.g. /topic/app.> on ActiveMQ)
+  are passed through untouched. The stanza name destination is subscribed
+  with subscription_id, the next ones with <subscription_id>-2,
+  <subscription_id>-3... Messages can be routed to per-destination
+  sourcetypes by destination header (the default routing_header), e.g.:
+    routing_rules = /queue/orders => sourcetype=order; /topic/app.* => sourcetype=app
@@ -6,14 +6,15 @@
 """
 
 import sys
-import platform
 import time
 import logging
 import re
 import os
+import itertools
+import cStringIO
+import threading
+import socket
 import stomppy
-import xml.dom.minidom
-import xml.sax.saxutils
 
 
 # Splunk scheme for introspection.
@@ -27,7 +28,7 @@ SCHEME = '''<scheme>
         <args>
             <arg name="name">
                 <title>STOMP endpoint</title>
-                <description>STOMP endpoint including hostname/IP address, port number and destination (e.g. 127.0.0.1:61613/queue/whatever).</description>
+                <description>STOMP endpoint including hostname/IP address, port number and destination (e.g. 127.0.0.1:61613/queue/whatever). Several comma separated destinations or broker wildcards can be subscribed over the same connection (e.g. 127.0.0.1:61613/queue/orders,/topic/app.&gt;).</description>
                 <data_type>string</data_type>
                 <required_on_create>true</required_on_create>
                 <required_on_edit>true</required_on_edit>
@@ -63,7 +64,301 @@ SCHEME = '''<scheme>
 
             <arg name="subscription_id">
                 <title>Subscription id</title>
-                <description>Subscription id to be used in MQM connections (defaults to 'splunk-stomp').</description>
+                <description>Subscription id to be used in MQM connections (defaults to 'splunk-stomp'). With several destinations, the second and later ones are subscribed as &lt;id&gt;-2, &lt;id&gt;-3...</description>
+                <data_type>string</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="strip_newlines">
+                <title>Strip newlines</title>
+                <description>If enabled, replace line breaks (CRLF, CR or LF) in message bodies with a space.</description>
+                <data_type>boolean</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="collapse_crlf">
+                <title>Collapse CRLF</title>
+                <description>If enabled, replace CRLF line endings in message bodies with LF.</description>
+                <data_type>boolean</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="strip_trailing_whitespace">
+                <title>Strip trailing whitespace</title>
+                <description>If enabled, remove trailing whitespace from every line and from the end of message bodies.</description>
+                <data_type>boolean</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="index_headers">
+                <title>Indexed headers</title>
+                <description>Comma separated list of message header names or glob patterns (e.g. message-id, JMSX*) to be indexed with each event.</description>
+                <data_type>string</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="index_headers_format">
+                <title>Indexed headers format</title>
+                <description>How indexed headers are rendered: 'kv' (key="value" pairs before the body, default) or 'json' (JSON envelope with headers and body).</description>
+                <data_type>string</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="source_header">
+                <title>Source header</title>
+                <description>Message header whose value is used as the event source (e.g. destination).</description>
+                <data_type>string</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="host_header">
+                <title>Host header</title>
+                <description>Message header whose value is used as the event host.</description>
+                <data_type>string</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="body_encoding">
+                <title>Body encoding</title>
+                <description>Encoding of message bodies without an encoding header: 'gzip', 'deflate', 'auto' (detect compressed bodies) or 'none' (also ignore the encoding header). Defaults to plain bodies.</description>
+                <data_type>string</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="encoding_header">
+                <title>Encoding header</title>
+                <description>Message header declaring the body encoding (defaults to 'content-encoding').</description>
+                <data_type>string</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="max_inflated_size">
+                <title>Maximum inflated size</title>
+                <description>Maximum size in bytes of decompressed message bodies (defaults to 104857600). Larger messages are rejected.</description>
+                <data_type>number</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="split_mode">
+                <title>Split mode</title>
+                <description>Split multi-record message bodies into separate events: 'delimiter' (e.g. NDJSON, see split_delimiter), 'json_array' (one event per element) or 'length_prefixed' (records prefixed by their length, 4 bytes, big endian). Disabled by default.</description>
+                <data_type>string</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="split_delimiter">
+                <title>Split delimiter</title>
+                <description>Record delimiter for the 'delimiter' split mode, backslash escapes allowed (defaults to \\n).</description>
+                <data_type>string</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="time_header">
+                <title>Time header</title>
+                <description>Message header holding the event time (e.g. timestamp or JMSTimestamp), as epoch seconds, milliseconds or microseconds, or as an ISO 8601 date.</description>
+                <data_type>string</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="time_json_field">
+                <title>Time JSON field</title>
+                <description>JSON body field holding the event time (used when time_header is not set or missing), in the same formats as time_header.</description>
+                <data_type>string</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="time_fallback">
+                <title>Time fallback</title>
+                <description>Event time used when it can't be extracted: 'arrival' (message arrival time) or 'none' (leave it to Splunk, default).</description>
+                <data_type>string</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="routing_header">
+                <title>Routing header</title>
+                <description>Message header (e.g. type) whose value selects the routing rule applied to each message (defaults to destination).</description>
+                <data_type>string</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="routing_rules">
+                <title>Routing rules</title>
+                <description>Semicolon separated rules mapping routing header values or glob patterns to event fields, tried in order (e.g. order => index=sales, sourcetype=order; audit* => sourcetype=audit). Supported fields: index, sourcetype, source and host.</description>
+                <data_type>string</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="selector">
+                <title>Selector</title>
+                <description>Broker-side message selector sent with the subscription (e.g. JMS SQL92 selectors for ActiveMQ: type = 'order').</description>
+                <data_type>string</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="filter">
+                <title>Filter</title>
+                <description>Comma separated header predicates, all of them required for a message to be indexed: name=value, name!=value (values may be glob patterns), name (header present) or !name (header missing). Filtered out messages are still ACKed.</description>
+                <data_type>string</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="sample_rate">
+                <title>Sample rate</title>
+                <description>Index only 1 in N messages, deterministically chosen by a hash of their message-id (defaults to 1, all messages).</description>
+                <data_type>number</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="dedup">
+                <title>Deduplicate messages</title>
+                <description>If enabled, remember the message-id of indexed messages (persisted in the checkpoint directory), so redelivered messages are not indexed twice.</description>
+                <data_type>boolean</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="dedup_capacity">
+                <title>Deduplication capacity</title>
+                <description>Maximum number of remembered message ids (defaults to 100000).</description>
+                <data_type>number</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="large_body_threshold">
+                <title>Large body threshold</title>
+                <description>Message bodies of at least this many bytes (as declared by their content-length header) are spooled to a temporary file and streamed into Splunk in bounded chunks (defaults to 1048576, 0 disables spooling).</description>
+                <data_type>number</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="validation_timeout">
+                <title>Validation timeout</title>
+                <description>Seconds allowed to the brokers to answer a STOMP CONNECT frame when the input is validated (defaults to 5).</description>
+                <data_type>number</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="use_ssl">
+                <title>Use SSL/TLS</title>
+                <description>If enabled, connect to the broker using TLS.</description>
+                <data_type>boolean</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="ssl_min_version">
+                <title>Minimum TLS version</title>
+                <description>Oldest TLS version accepted: 1.2 (default) or 1.3.</description>
+                <data_type>string</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="ssl_verify">
+                <title>Verify certificates</title>
+                <description>If enabled (default), verify the broker certificate.</description>
+                <data_type>boolean</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="ssl_check_hostname">
+                <title>Check host name</title>
+                <description>If enabled (default), check the broker certificate matches its host name.</description>
+                <data_type>boolean</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="ssl_ca_certs">
+                <title>CA certificates</title>
+                <description>Path to a file with the CA certificates used to verify the broker (defaults to the system CA certificates).</description>
+                <data_type>string</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="ssl_cert_file">
+                <title>Client certificate</title>
+                <description>Path to a X509 client certificate (PEM), for brokers requiring client authentication.</description>
+                <data_type>string</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="ssl_key_file">
+                <title>Client key</title>
+                <description>Path to the private key of the client certificate (if not included in the certificate file).</description>
+                <data_type>string</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="ssl_ciphers">
+                <title>Ciphers</title>
+                <description>OpenSSL cipher list (defaults to the python defaults).</description>
+                <data_type>string</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="tcp_nodelay">
+                <title>TCP no delay</title>
+                <description>If enabled, disable Nagle's algorithm (TCP_NODELAY), so small frames like ACKs are sent straight away.</description>
+                <data_type>boolean</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="tcp_quickack">
+                <title>TCP quick ACK</title>
+                <description>If enabled, acknowledge received data straight away instead of delaying TCP ACKs (TCP_QUICKACK, Linux only).</description>
+                <data_type>boolean</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="tcp_keepalive">
+                <title>TCP keepalive</title>
+                <description>Enable TCP keepalive probes: true (system defaults) or idle,interval,count seconds (Linux only).</description>
+                <data_type>string</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="receive_buffer_size">
+                <title>Receive buffer size</title>
+                <description>Socket receive buffer size in bytes (SO_RCVBUF, defaults to the system default).</description>
+                <data_type>number</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="ack_coalesce_ms">
+                <title>ACK coalescing interval</title>
+                <description>When using explicit ACKs, queue ACK frames for up to this many milliseconds and write them together (defaults to 0, disabled).</description>
+                <data_type>number</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="stomp_version">
+                <title>STOMP version</title>
+                <description>Highest STOMP protocol version to negotiate with the broker: 1.0, 1.1 or 1.2 (default).</description>
+                <data_type>string</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="destinations">
+                <title>Additional destinations</title>
+                <description>Comma separated list of destinations or broker wildcards subscribed over the same connection, after the one in the stanza name.</description>
+                <data_type>string</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="dispatch_workers">
+                <title>Dispatch workers</title>
+                <description>Process messages on this many worker threads instead of the connection receiver thread (defaults to 0, disabled). Messages of the same subscription (or group, see dispatch_group_header) keep their order. With explicit ACKs and several workers, subscriptions use the client-individual ack mode (STOMP 1.1+).</description>
+                <data_type>number</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="dispatch_queue_size">
+                <title>Dispatch queue size</title>
+                <description>Maximum number of messages waiting for every dispatch worker before the connection stops reading (defaults to 100).</description>
+                <data_type>number</data_type>
+                <required_on_create>false</required_on_create>
+                <required_on_edit>false</required_on_edit>
+            </arg>
+            <arg name="dispatch_group_header">
+                <title>Dispatch group header</title>
+                <description>Header grouping messages (e.g. JMSXGroupID): messages of different groups are processed in parallel, messages of the same group keep their order.</description>
                 <data_type>string</data_type>
                 <required_on_create>false</required_on_create>
                 <required_on_edit>false</required_on_edit>
@@ -78,6 +373,9 @@ SCHEME = '''<scheme>
 class SplunkHelper(object):
     PID = None
     IS_WINDOWS = None
+    # Serializes event writes when messages are processed by several
+    # dispatch workers (see dispatch_workers).
+    STREAM_LOCK = threading.Lock()
 
     @classmethod
     def init(cls):
@@ -95,7 +393,7 @@ class SplunkHelper(object):
         # Fetch current process PID. Required to implement dirty workarounds
         # due to issues when restarting/stopping Splunk (see is_splunkd_running).
         cls.PID = os.getpid()
-        cls.IS_WINDOWS = platform.system().lower() == 'windows'
+        cls.IS_WINDOWS = sys.platform.startswith('win')
 
     @classmethod
     def is_splunkd_running(cls):
@@ -120,14 +418,68 @@ class SplunkHelper(object):
         sys.stdout.flush()
 
     @classmethod
-    def stream_data(self, data):
+    def stream_data(self, data, source=None, host=None, escaper=None, buffered=True, timestamp=None,
+                    index=None, sourcetype=None):
         '''
         See http://docs.splunk.com/Documentation/Splunk/latest/AdvancedDev/ModInputsStream
         '''
-        sys.stdout.write('<event unbroken="1"><data>')
-        sys.stdout.write(xml.sax.saxutils.escape(data))
-        sys.stdout.write('</data><done/></event>\n')
-        sys.stdout.flush()
+        # The event is assembled in a buffer and written at once, so bodies
+        # failing half way (e.g. while being decompressed or read back from
+        # their spool file) never leave a truncated event in the stream.
+        # Large (spooled) bodies are buffered in a temporary file instead of
+        # memory, and copied to the stream in chunks.
+        if buffered:
+            buffer = cStringIO.StringIO()
+            self.write_event(buffer, data, source, host, escaper, timestamp, index, sourcetype)
+            with self.STREAM_LOCK:
+                sys.stdout.write(buffer.getvalue())
+                sys.stdout.flush()
+        else:
+            import tempfile
+            buffer = tempfile.TemporaryFile()
+            try:
+                self.write_event(buffer, data, source, host, escaper, timestamp, index, sourcetype)
+                buffer.seek(0)
+                with self.STREAM_LOCK:
+                    for chunk in read_chunks(buffer):
+                        sys.stdout.write(chunk)
+                    sys.stdout.flush()
+            finally:
+                buffer.close()
+
+    @classmethod
+    def stream_batch(self, datas, source=None, host=None, escaper=None, timestamps=None,
+                     index=None, sourcetype=None):
+        '''
+        Stream a list of events sharing the same fields as a single write.
+        '''
+        buffer = cStringIO.StringIO()
+        for i, data in enumerate(datas):
+            self.write_event(
+                buffer, data, source, host, escaper,
+                timestamps[i] if timestamps is not None else None, index, sourcetype)
+        with self.STREAM_LOCK:
+            sys.stdout.write(buffer.getvalue())
+            sys.stdout.flush()
+
+    @classmethod
+    def write_event(self, out, data, source=None, host=None, escaper=None, timestamp=None,
+                    index=None, sourcetype=None):
+        if timestamp is not None:
+            out.write('<event unbroken="1"><time>%s</time><data>' % timestamp)
+        else:
+            out.write('<event unbroken="1"><data>')
+        (escaper or DEFAULT_BODY_ESCAPER).write(out, data)
+        out.write('</data>')
+        if source is not None:
+            out.write('<source>%s</source>' % escape_xml(source))
+        if host is not None:
+            out.write('<host>%s</host>' % escape_xml(host))
+        if index is not None:
+            out.write('<index>%s</index>' % escape_xml(index))
+        if sourcetype is not None:
+            out.write('<sourcetype>%s</sourcetype>' % escape_xml(sourcetype))
+        out.write('<done/></event>\n')
 
     @classmethod
     def close_stream(self):
@@ -143,44 +495,1282 @@ class SplunkHelper(object):
         Prints XML error data to be consumed by Splunk.
         '''
         sys.stdout.write('<error><message>')
-        sys.stdout.write(xml.sax.saxutils.escape(message))
+        sys.stdout.write(escape_xml(message))
         sys.stdout.write('</message></error>')
         sys.stdout.flush()
 
 
+# Splunk XML parser class.
+class SplunkXMLParser(object):
+    '''
+    Streaming (expat based) parser for the configuration / validation XML
+    passed from Splunk. Collects the name and params of the first stanza
+    (or item, for validation) and the checkpoint directory, without
+    building a DOM.
+    '''
+    def __init__(self, stanza_tag):
+        self.name = None
+        self.params = {}
+        self.checkpoint_dir = None
+        self._stanza_tag = stanza_tag
+        self._in_stanza = False
+        self._param = None
+        self._text = None
+
+    def parse(self, data):
+        import xml.parsers.expat
+        parser = xml.parsers.expat.ParserCreate()
+        parser.StartElementHandler = self._start_element
+        parser.EndElementHandler = self._end_element
+        parser.CharacterDataHandler = self._character_data
+        parser.Parse(data, True)
+        return self
+
+    def _start_element(self, tag, attributes):
+        if tag == self._stanza_tag and self.name is None:
+            self.name = attributes.get('name', '')
+            self._in_stanza = True
+        elif tag == 'param' and self._in_stanza:
+            self._param = attributes.get('name', None)
+            self._text = []
+        elif tag == 'checkpoint_dir':
+            self._text = []
+
+    def _end_element(self, tag):
+        if tag == self._stanza_tag:
+            self._in_stanza = False
+        elif tag == 'param' and self._text is not None:
+            value = ''.join(self._text)
+            if self._param and value:
+                self.params[self._param] = value
+            self._param = self._text = None
+        elif tag == 'checkpoint_dir' and self._text is not None:
+            self.checkpoint_dir = ''.join(self._text) or None
+            self._text = None
+
+    def _character_data(self, data):
+        if self._text is not None:
+            self._text.append(data)
+
+
+# Body escaper class.
+class BodyEscaper(object):
+    '''
+    Escapes message bodies for the XML event stream, optionally normalizing
+    them on the way (newline stripping, CRLF collapsing, trailing whitespace
+    trimming). Normalization and XML escaping are compiled once per stanza
+    into a single regular expression, whose matches are replaced by a dict
+    lookup, so every chunk is copied once (bodies which aren't normalized
+    are only escaped). Large bodies are streamed in bounded chunks instead of
+    being copied whole.
+    '''
+    CHUNK_SIZE = 65536
+    XML_ESCAPES = {'&': '&amp;', '<': '&lt;', '>': '&gt;'}
+
+    def __init__(self, strip_newlines=False, collapse_crlf=False, strip_trailing_whitespace=False):
+        replacements = dict(self.XML_ESCAPES)
+        patterns = []
+        if strip_trailing_whitespace:
+            # Whitespace runs have no replacement, so they're removed.
+            patterns.append(r'[ \t]+(?=\r?\n)')
+        if strip_newlines:
+            replacements.update({'\r\n': ' ', '\r': ' ', '\n': ' '})
+            patterns.append(r'\r\n?|\n')
+        elif collapse_crlf:
+            replacements['\r\n'] = '\n'
+            patterns.append(r'\r\n')
+        self._strip_trailing_whitespace = strip_trailing_whitespace
+        if not patterns:
+            # Plain XML escaping: escape_xml's C level replace calls are
+            # several times faster than a regular expression with a callback.
+            self._regex = None
+            return
+        patterns.append('[&<>]')
+        self._regex = re.compile('|'.join(patterns))
+        self._replace = lambda match, get=replacements.get: get(match.group(), '')
+
+    def write(self, out, body):
+        '''
+        Write the normalized and escaped body, either a string or an iterator
+        of string chunks (see BodyDecoder), to the 'out' file-like object.
+        '''
+        if is_chunked(body):
+            self._write_chunks(out, body)
+            return
+
+        end = len(body)
+        if self._strip_trailing_whitespace:
+            while end and body[end - 1] in ' \t\r\n':
+                end -= 1
+
+        start = 0
+        while start < end:
+            # Never cut a chunk right after a space, tab or CR, so CRLF pairs
+            # and trailing whitespace runs are always seen whole.
+            stop = min(start + self.CHUNK_SIZE, end)
+            while stop < end and body[stop - 1] in ' \t\r':
+                stop += 1
+            if start == 0 and stop == len(body):
+                chunk = body
+            else:
+                chunk = body[start:stop]
+            out.write(self.escape(chunk))
+            start = stop
+
+    def _write_chunks(self, out, chunks):
+        # Trailing spaces, tabs and CRs (and newlines, when trimming the end
+        # of the body) are held back until the next chunk, so CRLF pairs and
+        # trailing whitespace runs are always seen whole.
+        held = ' \t\r\n' if self._strip_trailing_whitespace else ' \t\r'
+        pending = ''
+        for chunk in chunks:
+            if pending:
+                chunk = pending + chunk
+            stop = len(chunk)
+            while stop and chunk[stop - 1] in held:
+                stop -= 1
+            pending = chunk[stop:]
+            if stop:
+                out.write(self.escape(chunk[:stop] if pending else chunk))
+        if pending and not self._strip_trailing_whitespace:
+            out.write(self.escape(pending))
+
+    def escape(self, chunk):
+        if self._regex is None:
+            return escape_xml(chunk)
+        return self._regex.sub(self._replace, chunk)
+
+
+DEFAULT_BODY_ESCAPER = BodyEscaper()
+DEFAULT_LARGE_BODY_THRESHOLD = 1048576
+DEFAULT_DEDUP_CAPACITY = 100000
+DEFAULT_VALIDATION_TIMEOUT = 5
+DEFAULT_STOMP_VERSION = '1.2'
+DEFAULT_DISPATCH_QUEUE_SIZE = 100
+
+
+# Body decoding error class.
+class UndecodableBodyError(Exception):
+    '''
+    Raised for message bodies which will never be decoded (corrupt or too
+    large once inflated): redelivering them would fail again, so they are
+    dropped (and ACKed) instead of NACKed.
+    '''
+    pass
+
+
+# Body decoder class.
+class BodyDecoder(object):
+    '''
+    Detects compressed (gzip / deflate) message bodies, using the encoding
+    header or the per-stanza declared encoding, and inflates them lazily in
+    bounded chunks, so they can be streamed straight into the event buffer.
+    The inflated size is limited to protect against decompression bombs.
+    Bodies declaring an unknown (or non compression) encoding, e.g. a
+    charset, are passed through untouched.
+    '''
+    CHUNK_SIZE = 65536
+    ENCODINGS = ('gzip', 'deflate', 'auto', 'none')
+    DEFAULT_MAX_INFLATED_SIZE = 104857600
+
+    def __init__(self, encoding=None, header='content-encoding', max_inflated_size=None):
+        if encoding is not None and encoding not in self.ENCODINGS:
+            raise Exception("Unknown body encoding '%s' (expected one of: %s)." % (
+                encoding, ', '.join(self.ENCODINGS)))
+        self._encoding = encoding
+        self._header = header
+        self._max_inflated_size = max_inflated_size or self.DEFAULT_MAX_INFLATED_SIZE
+
+    def decode(self, headers, body):
+        '''
+        Return the body (a string or an iterator of string chunks) untouched
+        if it is not compressed, or an iterator of inflated chunks otherwise.
+        '''
+        encoding = (headers.get(self._header, None) or self._encoding or '').strip().lower()
+        if encoding in ('', 'identity'):
+            return body
+        import zlib
+
+        # Detection only needs the first bytes of the body.
+        if is_chunked(body):
+            head = next(body, '')
+            body = itertools.chain((head,), body)
+        else:
+            head = body
+            body = (body,)
+
+        if encoding in ('gzip', 'x-gzip'):
+            wbits = 16 + zlib.MAX_WBITS
+        elif encoding == 'deflate':
+            # Both zlib wrapped and raw deflate streams are found in the wild.
+            wbits = zlib.MAX_WBITS if self._is_zlib(head) else -zlib.MAX_WBITS
+        elif encoding == 'auto':
+            if head.startswith('\x1f\x8b'):
+                wbits = 16 + zlib.MAX_WBITS
+            elif self._is_zlib(head):
+                wbits = zlib.MAX_WBITS
+            elif isinstance(body, tuple):
+                return head
+            else:
+                return body
+        else:
+            logging.debug("Indexing STOMP message with unsupported body encoding '%s' as is", encoding)
+            return head if isinstance(body, tuple) else body
+        return self._inflate(body, wbits)
+
+    def _is_zlib(self, body):
+        return len(body) >= 2 and ord(body[0]) & 0x0f == 8 and \
+            (ord(body[0]) * 256 + ord(body[1])) % 31 == 0
+
+    def _inflate(self, chunks, wbits):
+        import zlib
+        decompressor = zlib.decompressobj(wbits)
+        size = 0
+        try:
+            for data in chunks:
+                while data:
+                    chunk = decompressor.decompress(data, self.CHUNK_SIZE)
+                    data = decompressor.unconsumed_tail
+                    size += len(chunk)
+                    if size > self._max_inflated_size:
+                        raise UndecodableBodyError(
+                            'Inflated message body exceeds %d bytes.' % self._max_inflated_size)
+                    if chunk:
+                        yield chunk
+            chunk = decompressor.flush()
+        except zlib.error as e:
+            raise UndecodableBodyError('Corrupt compressed message body: %s.' % e)
+        if size + len(chunk) > self._max_inflated_size:
+            raise UndecodableBodyError('Inflated message body exceeds %d bytes.' % self._max_inflated_size)
+        if chunk:
+            yield chunk
+
+
+# Chunk stream class.
+class ChunkStream(object):
+    '''
+    Buffers an iterator of string chunks (e.g. a body read back from its
+    spool file), so it can be scanned like a string: 'data' holds the
+    buffered bytes and 'pos' the scan position. Consumed bytes are dropped
+    whenever more data is buffered, and the buffer at least doubles every
+    time it grows, so memory is bounded by the largest item scanned and
+    scanning stays linear.
+    '''
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._eof = False
+        self._consumed = 0
+        self.data = ''
+        self.pos = 0
+
+    def offset(self):
+        '''
+        Return the scan position, as an offset from the start of the stream.
+        '''
+        return self._consumed + self.pos
+
+    def fill(self, size=1):
+        '''
+        Buffer at least size unread bytes, unless the stream ends first.
+        Returns true if they are available.
+        '''
+        pieces = [self.data[self.pos:]]
+        available = len(pieces[0])
+        if available >= size:
+            return True
+        while available < size and not self._eof:
+            try:
+                chunk = next(self._chunks)
+            except StopIteration:
+                self._eof = True
+            else:
+                pieces.append(chunk)
+                available += len(chunk)
+        self._consumed += self.pos
+        self.data = ''.join(pieces)
+        self.pos = 0
+        return available >= size
+
+    def grow(self):
+        '''
+        Buffer (at least) as many bytes again as are unread. Returns false if
+        the stream ended without any more data.
+        '''
+        unread = len(self.data) - self.pos
+        self.fill(2 * unread or 1)
+        return len(self.data) - self.pos > unread
+
+    def read(self, size):
+        self.fill(size)
+        data = self.data[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def peek(self):
+        self.fill(1)
+        return self.data[self.pos:self.pos + 1]
+
+    def skip(self, regex):
+        '''
+        Skip the bytes matching a (single character repetition) regular
+        expression.
+        '''
+        while True:
+            self.pos = regex.match(self.data, self.pos).end()
+            if self.pos < len(self.data) or not self.grow():
+                return
+
+
+# Record splitter class.
+class RecordSplitter(object):
+    '''
+    Splits multi-record message bodies into separate events in a single
+    scan: by delimiter (e.g. NDJSON or newline delimited logs), JSON array
+    (every element, sliced verbatim from the body) or length prefixed
+    framing (4 bytes, big endian, before every record). Large (spooled)
+    bodies are split as they are read, see iter_split.
+    '''
+    MODES = ('delimiter', 'json_array', 'length_prefixed')
+    JSON_WHITESPACE_RE = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, mode, delimiter='\n'):
+        if mode not in self.MODES:
+            raise Exception("Unknown split mode '%s' (expected one of: %s)." % (
+                mode, ', '.join(self.MODES)))
+        if not delimiter:
+            raise Exception('Empty split delimiter.')
+        self.split = getattr(self, '_split_%s' % mode)
+        self._iter_split = getattr(self, '_iter_split_%s' % mode)
+        self._delimiter = delimiter
+        if mode == 'json_array':
+            import json
+            self._json_decoder = json.JSONDecoder()
+        elif mode == 'length_prefixed':
+            import struct
+            self._length_prefix = struct.Struct('!I')
+
+    def iter_split(self, chunks):
+        '''
+        Return an iterator of the records of a body given as an iterator of
+        string chunks, holding a single record (and chunk) in memory. Raises
+        the same exceptions as split, once the malformed data is reached.
+        '''
+        return self._iter_split(ChunkStream(chunks))
+
+    def _split_delimiter(self, body):
+        return [record for record in body.split(self._delimiter) if record.strip()]
+
+    def _split_json_array(self, body):
+        skip = self.JSON_WHITESPACE_RE.match
+        raw_decode = self._json_decoder.raw_decode
+        pos = skip(body).end()
+        if body[pos:pos + 1] != '[':
+            raise Exception('Message body is not a JSON array.')
+        pos = skip(body, pos + 1).end()
+        records = []
+        if body[pos:pos + 1] == ']':
+            return records
+        while True:
+            # Elements are parsed only to find where they end.
+            end = raw_decode(body, pos)[1]
+            records.append(body[pos:end])
+            pos = skip(body, end).end()
+            separator = body[pos:pos + 1]
+            if separator == ']':
+                return records
+            elif separator != ',':
+                raise Exception('Malformed JSON array at offset %d.' % pos)
+            pos = skip(body, pos + 1).end()
+
+    def _split_length_prefixed(self, body):
+        unpack_from = self._length_prefix.unpack_from
+        prefix_size = self._length_prefix.size
+        records = []
+        pos = 0
+        while pos < len(body):
+            start = pos + prefix_size
+            end = start + unpack_from(body, pos)[0]
+            if end > len(body):
+                raise Exception('Truncated length prefixed record at offset %d.' % pos)
+            if end > start:
+                records.append(body[start:end])
+            pos = end
+        return records
+
+    def _iter_split_delimiter(self, stream):
+        delimiter = self._delimiter
+        search = 0
+        while True:
+            end = stream.data.find(delimiter, stream.pos + search)
+            if end < 0:
+                # The delimiter may straddle the end of the buffered data.
+                search = max(0, len(stream.data) - stream.pos - len(delimiter) + 1)
+                if not stream.grow():
+                    record = stream.data[stream.pos:]
+                    if record.strip():
+                        yield record
+                    return
+                continue
+            record = stream.data[stream.pos:end]
+            stream.pos = end + len(delimiter)
+            search = 0
+            if record.strip():
+                yield record
+
+    def _iter_split_json_array(self, stream):
+        raw_decode = self._json_decoder.raw_decode
+        stream.skip(self.JSON_WHITESPACE_RE)
+        if stream.peek() != '[':
+            raise Exception('Message body is not a JSON array.')
+        stream.pos += 1
+        stream.skip(self.JSON_WHITESPACE_RE)
+        if stream.peek() == ']':
+            return
+        while True:
+            # Elements are parsed only to find where they end. Incomplete
+            # ones (and numbers ending with the buffered data) are parsed
+            # again once more data is buffered.
+            while True:
+                try:
+                    size = raw_decode(stream.data, stream.pos)[1] - stream.pos
+                except ValueError:
+                    if not stream.grow():
+                        raise
+                    continue
+                if stream.pos + size < len(stream.data) or not stream.grow():
+                    break
+            yield stream.data[stream.pos:stream.pos + size]
+            stream.pos += size
+            stream.skip(self.JSON_WHITESPACE_RE)
+            separator = stream.peek()
+            if separator == ']':
+                return
+            elif separator != ',':
+                raise Exception('Malformed JSON array at offset %d.' % stream.offset())
+            stream.pos += 1
+            stream.skip(self.JSON_WHITESPACE_RE)
+
+    def _iter_split_length_prefixed(self, stream):
+        prefix_size = self._length_prefix.size
+        while stream.fill(1):
+            offset = stream.offset()
+            prefix = stream.read(prefix_size)
+            size = self._length_prefix.unpack(prefix)[0] if len(prefix) == prefix_size else -1
+            record = stream.read(size) if size > 0 else ''
+            if size < 0 or len(record) < size:
+                raise Exception('Truncated length prefixed record at offset %d.' % offset)
+            if record:
+                yield record
+
+
+# Time extractor class.
+class TimeExtractor(object):
+    '''
+    Extracts event times, as epoch seconds, from a message header (e.g.
+    timestamp or JMSTimestamp) or a JSON body field, falling back to the
+    arrival time if configured, so Splunk can skip timestamp recognition.
+    Numeric values in seconds, milliseconds or microseconds (guessed from
+    their magnitude) and ISO 8601 dates are supported. JSON fields are
+    located with a regular expression, not by parsing the body (only in
+    its first chunk for large or compressed bodies).
+    '''
+    FALLBACKS = ('none', 'arrival')
+    ISO_8601_RE = re.compile(
+        r'(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})(\.\d+)?'
+        r'(?:Z|([+-])(\d{2}):?(\d{2}))?$')
+
+    def __init__(self, header=None, json_field=None, fallback=None):
+        if fallback is not None and fallback not in self.FALLBACKS:
+            raise Exception("Unknown time fallback '%s' (expected one of: %s)." % (
+                fallback, ', '.join(self.FALLBACKS)))
+        self._header = header
+        self._json_field = json_field
+        self._json_field_re = re.compile(
+            r'"%s"\s*:\s*(?:"([^"]*)"|([-+0-9.eE]+))' % re.escape(json_field)) \
+            if json_field else None
+        self._arrival = fallback == 'arrival'
+        self.uses_body = json_field is not None
+
+    def extract(self, headers, body, arrival):
+        '''
+        Return the event time of a message (or record) as a string, or None.
+        '''
+        if self._header is not None and self._header in headers:
+            timestamp = self._to_epoch(headers[self._header])
+            if timestamp is not None:
+                return timestamp
+        if self._json_field is not None:
+            if isinstance(body, dict):
+                value = body.get(self._json_field, None)
+            elif isinstance(body, basestring):
+                match = self._json_field_re.search(body)
+                value = match and (match.group(1) or match.group(2))
+            else:
+                value = None
+            if value:
+                timestamp = self._to_epoch(value)
+                if timestamp is not None:
+                    return timestamp
+        if self._arrival:
+            return '%.3f' % arrival
+        return None
+
+    def extract_records(self, headers, records, arrival):
+        '''
+        Return the list of event times of records split from the same message.
+        '''
+        if self._json_field is None:
+            return [self.extract(headers, None, arrival)] * len(records)
+        else:
+            return [self.extract(headers, record, arrival) for record in records]
+
+    def _to_epoch(self, value):
+        # Unparseable values (including non ASCII and non finite ones) return
+        # None, so the next source or the index time is used instead.
+        try:
+            timestamp = float(value)
+        except (TypeError, ValueError):
+            try:
+                match = self.ISO_8601_RE.match(unicode(value).strip())
+            except UnicodeDecodeError:
+                return None
+            if match is None:
+                return None
+            groups = match.groups()
+            import calendar
+            try:
+                timestamp = calendar.timegm([int(group) for group in groups[:6]]) + \
+                    float(groups[6] or 0)
+            except ValueError:
+                return None
+            if groups[7] is not None:
+                offset = int(groups[8]) * 3600 + int(groups[9]) * 60
+                timestamp += -offset if groups[7] == '+' else offset
+        else:
+            import math
+            if math.isinf(timestamp) or math.isnan(timestamp):
+                return None
+            if timestamp > 1e14:
+                timestamp /= 1e6
+            elif timestamp > 1e11:
+                timestamp /= 1e3
+        return '%.3f' % timestamp
+
+
+# Router class.
+class Router(object):
+    '''
+    Routes messages to an index / sourcetype / source / host depending on
+    the value of a header. Rules ('value => key=value, ...', separated by
+    ';') are tried in order: exact values before the first glob pattern are
+    looked up in a dictionary, and the remaining rules are compiled into
+    combined regular expressions (of less than 100 rules each, the limit of
+    groups in a Python 2 expression). Decisions are cached per header value.
+    '''
+    FIELDS = ('index', 'sourcetype', 'source', 'host')
+    MAX_CACHED_VALUES = 1024
+    MAX_PATTERNS_PER_EXPRESSION = 90
+
+    def __init__(self, header, rules):
+        self._header = header
+        self._exact = {}
+        self._patterns = []
+        patterns = []
+        for rule in rules.split(';'):
+            if not rule.strip():
+                continue
+            if '=>' not in rule:
+                raise Exception("Wrong routing rule format: '%s'." % rule.strip())
+            value, assignments = rule.split('=>', 1)
+            value = value.strip()
+            fields = {}
+            for assignment in split_list(assignments):
+                key, _, field = assignment.partition('=')
+                key = key.strip()
+                if key not in self.FIELDS or not field.strip():
+                    raise Exception("Wrong routing rule assignment: '%s' (expected one of: %s)." % (
+                        assignment, ', '.join(self.FIELDS)))
+                fields[key] = field.strip()
+            if '*' in value or '?' in value:
+                patterns.append(glob_to_regex(value))
+                self._patterns.append(fields)
+            elif patterns:
+                # Exact values after a glob pattern must not take precedence
+                # over it.
+                patterns.append(re.escape(value))
+                self._patterns.append(fields)
+            else:
+                self._exact.setdefault(value, fields)
+        self._expressions = []
+        for start in xrange(0, len(patterns), self.MAX_PATTERNS_PER_EXPRESSION):
+            chunk = patterns[start:start + self.MAX_PATTERNS_PER_EXPRESSION]
+            self._expressions.append((start, re.compile('(?:%s)$' % '|'.join([
+                '(?P<r%d>%s)' % (i, pattern) for i, pattern in enumerate(chunk)]))))
+        self._routes = {}
+
+    def route(self, headers):
+        '''
+        Return a (shared, not to be modified) dictionary of event-level
+        fields for the message, or None if no rule matches.
+        '''
+        value = headers.get(self._header, None)
+        if value is None:
+            return None
+        try:
+            return self._routes[value]
+        except KeyError:
+            fields = self._exact.get(value, None)
+            if fields is None:
+                for start, expression in self._expressions:
+                    match = expression.match(value)
+                    if match is not None:
+                        fields = self._patterns[start + int(match.lastgroup[1:])]
+                        break
+            if len(self._routes) >= self.MAX_CACHED_VALUES:
+                self._routes.clear()
+            self._routes[value] = fields
+            return fields
+
+
+# Message filter class.
+class MessageFilter(object):
+    '''
+    Drops messages before any processing, using header predicates (all of
+    them must hold) and/or deterministic sampling (1 in N messages, chosen
+    by a hash of their message-id). Predicates are comma separated:
+    'name=value' and 'name!=value' (values may be glob patterns), 'name'
+    (header present) and '!name' (header missing).
+    '''
+    PREDICATE_RE = re.compile(r'^(!)?\s*([^=!\s]+)\s*(?:(!?=)\s*(.*))?$')
+
+    def __init__(self, predicates=(), sample_rate=1):
+        self._predicates = []
+        for predicate in predicates:
+            match = self.PREDICATE_RE.match(predicate)
+            if match is None or (match.group(1) and match.group(3)):
+                raise Exception("Wrong filter predicate: '%s'." % predicate)
+            missing, name, operator, value = match.groups()
+            if operator is None:
+                self._predicates.append((name, None, bool(missing)))
+            else:
+                value = value.strip()
+                if '*' in value or '?' in value:
+                    value = re.compile(glob_to_regex(value) + '$')
+                self._predicates.append((name, value, operator == '!='))
+        if sample_rate < 1:
+            raise Exception('Wrong sample rate: %d.' % sample_rate)
+        self._sample_rate = sample_rate
+
+    def accept(self, headers):
+        for name, value, negate in self._predicates:
+            actual = headers.get(name, None)
+            if value is None:
+                matches = actual is not None
+            elif actual is None:
+                matches = False
+            elif isinstance(value, basestring):
+                matches = actual == value
+            else:
+                matches = value.match(actual) is not None
+            if matches == negate:
+                return False
+        if self._sample_rate > 1:
+            import zlib
+            return (zlib.crc32(headers.get('message-id', '')) & 0xffffffff) % self._sample_rate == 0
+        return True
+
+
+# Deduplicator class.
+class Deduplicator(object):
+    '''
+    Remembers the message-id of indexed messages, so messages redelivered
+    by the broker (e.g. un-ACKed messages after a reconnection) are not
+    indexed twice. Memory is bounded and compact (16 to 24 bytes per id):
+    the 64 bit fingerprints of the last `capacity` ids are kept in a ring
+    of 32 bit (high, low) pairs, whose oldest entry is overwritten once it
+    is full, indexed by an open addressing (linear probing) table of ring
+    positions kept at most half full. Messages flagged as not redelivered
+    (redelivered:false) are not looked up. The fingerprints are
+    periodically saved to (and restored from) the checkpoint file.
+    '''
+    MAGIC = 'STOMP-DEDUP 1\n'
+    CHECKPOINT_INTERVAL = 30
+    EMPTY = -1
+
+    def __init__(self, capacity, checkpoint_path=None):
+        import array
+        import hashlib
+        import struct
+        self._md5 = hashlib.md5
+        # Big endian pairs, so checkpoints hold 64 bit big endian integers.
+        self._fingerprint_struct = struct.Struct('!II')
+        self._capacity = max(1, capacity)
+        self._ring = array.array('I', [0]) * (2 * self._capacity)
+        self._next = 0
+        self._size = 0
+        table_size = 2
+        while table_size < 2 * self._capacity:
+            table_size *= 2
+        self._mask = table_size - 1
+        self._table = array.array('i', [self.EMPTY]) * table_size
+        self._checkpoint_path = checkpoint_path
+        self._lock = threading.Lock()
+        self._lookups = 0
+        self._hits = 0
+        self._last_checkpoint = time.time()
+        if checkpoint_path is not None and os.path.exists(checkpoint_path):
+            self.load()
+
+    def _fingerprint(self, message_id):
+        return self._fingerprint_struct.unpack_from(self._md5(message_id).digest())
+
+    def _find(self, high, low):
+        '''
+        Return the table slot of a fingerprint, or -1.
+        '''
+        ring, table, mask = self._ring, self._table, self._mask
+        slot = low & mask
+        position = table[slot]
+        while position != self.EMPTY:
+            if ring[2 * position + 1] == low and ring[2 * position] == high:
+                return slot
+            slot = (slot + 1) & mask
+            position = table[slot]
+        return -1
+
+    def _add(self, high, low):
+        ring, table, mask = self._ring, self._table, self._mask
+        position = self._next
+        if self._size == self._capacity:
+            self._remove(position)
+        else:
+            self._size += 1
+        ring[2 * position] = high
+        ring[2 * position + 1] = low
+        slot = low & mask
+        while table[slot] != self.EMPTY:
+            slot = (slot + 1) & mask
+        table[slot] = position
+        self._next = (position + 1) % self._capacity
+
+    def _remove(self, position):
+        ring, table, mask = self._ring, self._table, self._mask
+        slot = ring[2 * position + 1] & mask
+        while table[slot] != position:
+            slot = (slot + 1) & mask
+        # Backward shift deletion: move following entries of the probe
+        # sequence into the hole, unless their home slot is past the hole.
+        table[slot] = self.EMPTY
+        hole = slot
+        slot = (slot + 1) & mask
+        while table[slot] != self.EMPTY:
+            home = ring[2 * table[slot] + 1] & mask
+            if (slot - home) & mask >= (slot - hole) & mask:
+                table[hole] = table[slot]
+                table[slot] = self.EMPTY
+                hole = slot
+            slot = (slot + 1) & mask
+
+    def is_duplicate(self, headers):
+        message_id = headers.get('message-id', None)
+        if message_id is None or headers.get('redelivered', None) == 'false':
+            return False
+        high, low = self._fingerprint(message_id)
+        with self._lock:
+            self._lookups += 1
+            if self._find(high, low) != -1:
+                self._hits += 1
+                return True
+        return False
+
+    def remember(self, headers):
+        message_id = headers.get('message-id', None)
+        if message_id is None:
+            return
+        high, low = self._fingerprint(message_id)
+        with self._lock:
+            if self._find(high, low) == -1:
+                self._add(high, low)
+
+    def stats(self):
+        '''
+        Return a (lookups, hits, fingerprints, memory in bytes) tuple.
+        '''
+        with self._lock:
+            memory = len(self._ring) * self._ring.itemsize + len(self._table) * self._table.itemsize
+            return self._lookups, self._hits, self._size, memory
+
+    def checkpoint(self):
+        '''
+        Save fingerprints (and log stats) if the checkpoint interval elapsed.
+        '''
+        if time.time() - self._last_checkpoint >= self.CHECKPOINT_INTERVAL:
+            self.save()
+
+    def save(self):
+        '''
+        Save fingerprints to the checkpoint file. Failures are logged, not
+        raised: they must not be mistaken for broker failures (or hide the
+        reason of a shutdown), and the next checkpoint will try again.
+        '''
+        self._last_checkpoint = time.time()
+        lookups, hits, fingerprints, memory = self.stats()
+        logging.info(
+            'Deduplication: %d hits in %d lookups (%.2f%%), %d fingerprints, ~%d KB',
+            hits, lookups, hits * 100.0 / lookups if lookups else 0.0, fingerprints, memory // 1024)
+        if self._checkpoint_path is None:
+            return
+        with self._lock:
+            # Oldest first, so they are also the oldest once loaded.
+            if self._size < self._capacity:
+                pairs = self._ring[:2 * self._size]
+            else:
+                pairs = self._ring[2 * self._next:] + self._ring[:2 * self._next]
+        if sys.byteorder == 'little':
+            pairs.byteswap()
+        temporary_path = self._checkpoint_path + '.tmp'
+        try:
+            with open(temporary_path, 'wb') as output:
+                output.write(self.MAGIC)
+                output.write(pairs.tostring())
+            if SplunkHelper.IS_WINDOWS and os.path.exists(self._checkpoint_path):
+                os.remove(self._checkpoint_path)
+            os.rename(temporary_path, self._checkpoint_path)
+        except Exception as e:
+            logging.warning("Unable to save deduplication checkpoint '%s': %s", self._checkpoint_path, e)
+
+    def load(self):
+        import array
+        try:
+            with open(self._checkpoint_path, 'rb') as input:
+                if input.read(len(self.MAGIC)) != self.MAGIC:
+                    raise Exception('unknown file format')
+                data = input.read()
+        except Exception as e:
+            logging.warning("Ignoring deduplication checkpoint '%s': %s", self._checkpoint_path, e)
+            return
+        pairs = array.array('I')
+        pairs.fromstring(data[:len(data) - len(data) % self._fingerprint_struct.size])
+        if sys.byteorder == 'little':
+            pairs.byteswap()
+        # Only the newest fingerprints are kept if the capacity was lowered.
+        count = len(pairs) // 2
+        with self._lock:
+            for index in xrange(max(0, count - self._capacity), count):
+                high, low = pairs[2 * index], pairs[2 * index + 1]
+                if self._find(high, low) == -1:
+                    self._add(high, low)
+
+
+# Header formatter class.
+class HeaderFormatter(object):
+    '''
+    Selects message headers by name or glob pattern and renders them with
+    each event. Selection rules are compiled once per stanza and decisions
+    are cached per header name, so formatting a message is a single pass
+    over its headers.
+    '''
+    FORMATS = ('kv', 'json')
+    MAX_CACHED_NAMES = 1024
+
+    def __init__(self, names, format='kv', source_header=None, host_header=None):
+        if format not in self.FORMATS:
+            raise Exception("Unknown headers format '%s' (expected one of: %s)." % (
+                format, ', '.join(self.FORMATS)))
+        self._names, self._pattern = compile_patterns(names)
+        self._render = getattr(self, '_render_%s' % format)
+        self._source_header = source_header
+        self._host_header = host_header
+        self._selected = {}
+
+    def _is_selected(self, name):
+        try:
+            return self._selected[name]
+        except KeyError:
+            selected = name in self._names or \
+                (self._pattern is not None and self._pattern.match(name) is not None)
+            if len(self._selected) >= self.MAX_CACHED_NAMES:
+                self._selected.clear()
+            self._selected[name] = selected
+            return selected
+
+    def format(self, headers, body):
+        '''
+        Return a (data, fields) tuple, where data is the event data and
+        fields a dictionary of event-level fields (source, host).
+        '''
+        datas, fields = self.format_records(headers, (body,))
+        return datas[0], fields
+
+    def format_records(self, headers, bodies):
+        '''
+        Return a (datas, fields) tuple for a list of records split from the
+        same message (see format). Headers are selected only once.
+        '''
+        is_selected = self._is_selected
+        selected = [(key, value) for key, value in headers.iteritems() if is_selected(key)]
+        if selected:
+            render = self._render
+            datas = [render(selected, body) for body in bodies]
+        else:
+            datas = bodies
+
+        fields = {}
+        if self._source_header is not None and self._source_header in headers:
+            fields['source'] = headers[self._source_header]
+        if self._host_header is not None and self._host_header in headers:
+            fields['host'] = headers[self._host_header]
+        return datas, fields
+
+    def _render_kv(self, selected, body):
+        prefix = ' '.join([
+            '%s="%s"' % (key, value.replace('\\', '\\\\').replace('"', '\\"'))
+            for key, value in selected])
+        if is_chunked(body):
+            return itertools.chain((prefix, ' '), body)
+        else:
+            return '%s %s' % (prefix, to_text(body))
+
+    def _render_json(self, selected, body):
+        # Bodies which are not UTF-8 text (e.g. latin-1 or binary) are
+        # base64 encoded, so they can't break (or be lost by) the envelope.
+        if is_chunked(body):
+            body = ''.join(body)
+        envelope = {
+            'headers': dict([
+                (key, value.decode('utf-8', 'replace') if isinstance(value, str) else value)
+                for key, value in selected]),
+        }
+        if isinstance(body, str):
+            try:
+                envelope['body'] = body.decode('utf-8')
+            except UnicodeDecodeError:
+                import base64
+                envelope['body'] = base64.b64encode(body)
+                envelope['encoding'] = 'base64'
+        else:
+            envelope['body'] = body
+        import json
+        return json.dumps(envelope, separators=(',', ':'))
+
+
 # Splunk listener class.
 class SplunkListener(object):
-    def __init__(self, connection, use_explicit_acks):
+    RECORDS_BATCH_SIZE = 1048576
+
+    def __init__(self, connection, use_explicit_acks, header_formatter=None, body_escaper=None,
+                 body_decoder=None, record_splitter=None, time_extractor=None, router=None,
+                 message_filter=None, deduplicator=None):
         self._connection = connection
         self._use_explicit_acks = use_explicit_acks
+        self._header_formatter = header_formatter
+        self._body_escaper = body_escaper
+        self._body_decoder = body_decoder
+        self._record_splitter = record_splitter
+        self._time_extractor = time_extractor
+        self._router = router
+        self._message_filter = message_filter
+        self._deduplicator = deduplicator
 
     def on_message(self, headers, message):
+        arrival = time.time()
         try:
-            # Handle message.
-            SplunkHelper.stream_data(message)
+            # Drop duplicated and filtered out messages (still ACKed below).
+            if self._deduplicator is not None and self._deduplicator.is_duplicate(headers):
+                logging.debug('Dropping duplicated STOMP message %s', headers['message-id'])
+            elif self._message_filter is None or self._message_filter.accept(headers):
+                self._process(headers, message, arrival)
+                if self._deduplicator is not None:
+                    self._deduplicator.remember(headers)
+        except UndecodableBodyError as e:
+            # Drop the message: if NACKed, it would be redelivered and fail again.
+            logging.error('Dropping undecodable STOMP message %s: %s', headers.get('message-id', None), e)
+            if self._use_explicit_acks:
+                self._connection.ack(self._connection.get_ack_headers(headers))
         except Exception as e:
             # NACK message.
             if self._use_explicit_acks:
-                self._connection.nack(**{
-                    'message-id': headers['message-id'],
-                    'subscription': headers['subscription'],
-                })
+                self._connection.nack(self._connection.get_ack_headers(headers))
 
             # Log.
             logging.warning('Got exception while processing STOMP message: %s', e)
         else:
             # ACK message.
             if self._use_explicit_acks:
-                self._connection.ack(**{
-                    'message-id': headers['message-id'],
-                    'subscription': headers['subscription'],
-                })
+                self._connection.ack(self._connection.get_ack_headers(headers))
+
+    def _process(self, headers, message, arrival):
+        # Multi-record bodies read back from their spool file and / or
+        # decompressed are split as they are read (see _split_chunked).
+        split = self._record_splitter is not None
+        if split and 'transformation' not in headers:
+            chunked = self._split_chunked(headers, message, arrival)
+            if chunked:
+                return
+            split = chunked is None
+
+        # Large bodies are spooled to a file by the connection: read them
+        # back in bounded chunks.
+        spooled = hasattr(message, 'read')
+        if spooled:
+            message.seek(0)
+            message = read_chunks(message)
+
+        # Decompress the body (lazily, while it is being written).
+        if self._body_decoder is not None:
+            decoded = self._body_decoder.decode(headers, message)
+            spooled = spooled and decoded is message
+            message = decoded
+
+        # Transform the body (deferred by the connection until now).
+        if 'transformation' in headers:
+            if is_chunked(message):
+                message = ''.join(message)
+            message = stomppy.utils.transform(message, headers['transformation'])
+
+        # Split multi-record bodies.
+        records = None
+        if split and not isinstance(message, dict):
+            if is_chunked(message):
+                message = ''.join(message)
+            try:
+                records = self._record_splitter.split(message)
+            except Exception as e:
+                logging.warning('Unable to split STOMP message, indexing it as a single event: %s', e)
+
+        # Handle message.
+        if records is not None:
+            self._write_records(headers, records, arrival)
+        else:
+            timestamp = None
+            if self._time_extractor is not None:
+                head = message
+                if is_chunked(message) and self._time_extractor.uses_body:
+                    head = next(message, '')
+                    message = itertools.chain((head,), message)
+                timestamp = self._time_extractor.extract(headers, head, arrival)
+            fields = {}
+            if self._header_formatter is not None:
+                message, fields = self._header_formatter.format(headers, message)
+            if self._router is not None:
+                fields = self._route(headers, fields)
+            SplunkHelper.stream_data(
+                to_text(message), escaper=self._body_escaper, buffered=not spooled,
+                timestamp=timestamp, **fields)
+
+    def _split_chunked(self, headers, message, arrival):
+        '''
+        Split a body read back from its spool file and / or decompressed in
+        a single pass, without holding it whole in memory, writing its
+        records in batches of bounded size. Returns true if written, false if
+        the body can't be split (found before any record was written, so it
+        can still be indexed as a single event), and None if the body is a
+        plain string (split as usual).
+        '''
+        body = self._read_body(headers, message)
+        if not is_chunked(body):
+            return None
+
+        records = self._record_splitter.iter_split(body)
+        batch = []
+        size = 0
+        written = 0
+        while True:
+            try:
+                record = next(records, None)
+            except UndecodableBodyError:
+                raise
+            except Exception as e:
+                if not written:
+                    logging.warning('Unable to split STOMP message, indexing it as a single event: %s', e)
+                    return False
+                # Written records can't be taken back, and a redelivered
+                # message would fail the same way: drop the rest.
+                raise UndecodableBodyError('Unable to split the body after %d records: %s' % (written, e))
+            if record is None:
+                break
+            batch.append(record)
+            size += len(record)
+            if size >= self.RECORDS_BATCH_SIZE:
+                self._write_records(headers, batch, arrival)
+                written += len(batch)
+                batch = []
+                size = 0
+        if batch:
+            self._write_records(headers, batch, arrival)
+        return True
+
+    def _read_body(self, headers, message):
+        '''
+        Return the (decoded) body, read from the start of its spool file in
+        bounded chunks if spooled.
+        '''
+        if hasattr(message, 'read'):
+            message.seek(0)
+            message = read_chunks(message)
+        if self._body_decoder is not None:
+            message = self._body_decoder.decode(headers, message)
+        return message
+
+    def _write_records(self, headers, records, arrival):
+        # Records are written as a single batch of events (the message is
+        # still ACKed once).
+        timestamps = None
+        if self._time_extractor is not None:
+            timestamps = self._time_extractor.extract_records(headers, records, arrival)
+        fields = {}
+        if self._header_formatter is not None:
+            records, fields = self._header_formatter.format_records(headers, records)
+        if self._router is not None:
+            fields = self._route(headers, fields)
+        SplunkHelper.stream_batch(
+            records, escaper=self._body_escaper, timestamps=timestamps, **fields)
+
+    def _route(self, headers, fields):
+        routed = self._router.route(headers)
+        if routed is not None:
+            fields = dict(fields, **routed)
+        return fields
 
     def on_error(self, headers, message):
         # Log.
         logging.error('Got unexpected STOMP error message: %s', message)
 
 
+# Broker probe class.
+class BrokerProbe(object):
+    '''
+    Lightweight reachability check used by --validate-arguments: a TCP
+    connect plus a STOMP CONNECT / CONNECTED exchange, run against every
+    broker in parallel within a hard deadline (a full stomppy.Connection
+    retries with backoff and has no timeout). Successful checks are cached
+    in the checkpoint directory for CACHE_TTL seconds, so saving an input
+    several times in a row doesn't probe its brokers again. Failures are
+    never cached, and cache keys don't include the password (the cache file
+    would otherwise hold an unsalted hash of it). TLS brokers are probed
+    through the stanza TLS configuration, so certificate problems are
+    reported too.
+    '''
+    CACHE_TTL = 60
+    JOIN_GRACE = 0.1
+
+    def __init__(self, timeout, username=None, password=None, cache_path=None, tls=None, version=None):
+        self._timeout = timeout
+        self._username = username
+        self._password = password
+        self._cache_path = cache_path
+        self._tls = tls
+        self._version = version or float(DEFAULT_STOMP_VERSION)
+
+    def check(self, brokers):
+        '''
+        Probe a list of (host, port) brokers, raising an exception listing
+        the ones which didn't answer CONNECTED before the deadline.
+        '''
+        import hashlib
+        key = hashlib.md5(repr((
+            sorted(brokers), self._username, self._tls is not None, self._version))).hexdigest()
+        cache = self._load_cache()
+        if time.time() - cache.get(key, 0) < self.CACHE_TTL:
+            logging.debug('Skipping broker probe, cached as reachable')
+            return
+
+        # Probe in parallel, waiting for the deadline at most (plus a short
+        # grace period, so probes timing out at the deadline report it).
+        deadline = time.time() + self._timeout
+        results = {}
+        threads = []
+        for broker in brokers:
+            thread = threading.Thread(target=self._run, args=(broker, deadline, results))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join(max(0, deadline - time.time()) + self.JOIN_GRACE)
+
+        errors = []
+        for broker in brokers:
+            error = results.get(broker, 'no answer in %g seconds' % self._timeout)
+            if error is not None:
+                errors.append('%s:%d (%s)' % (broker[0], broker[1], error))
+        if errors:
+            raise Exception('Unable to connect to %s.' % ', '.join(errors))
+
+        cache[key] = time.time()
+        self._save_cache(cache)
+
+    def _run(self, broker, deadline, results):
+        try:
+            results[broker] = self.probe(broker[0], broker[1], deadline)
+        except Exception as e:
+            results[broker] = str(e) or e.__class__.__name__
+
+    def probe(self, host, port, deadline):
+        '''
+        Return None if the broker answered the CONNECT frame with CONNECTED
+        before the deadline, or a description of the problem.
+        '''
+        # Offer the versions run() negotiates.
+        accept_version = ','.join([
+            version for version in stomppy.connect.SUPPORTED_VERSIONS if float(version) <= self._version])
+        headers = ['CONNECT', 'accept-version:%s' % accept_version, 'host:%s' % host]
+        if self._username is not None:
+            headers.append('login:%s' % self._username)
+        if self._password is not None:
+            headers.append('passcode:%s' % self._password)
+        sock = socket.create_connection((host, port), max(0.001, deadline - time.time()))
+        try:
+            if self._tls is not None:
+                sock = self._tls.wrap(sock, (host, port))[0]
+            sock.sendall('\n'.join(headers) + '\n\n\x00')
+            data = ''
+            while '\x00' not in data.lstrip('\r\n'):
+                sock.settimeout(max(0.001, deadline - time.time()))
+                chunk = sock.recv(4096)
+                if not chunk:
+                    return 'connection closed by the broker'
+                data += chunk
+            data = data.lstrip('\r\n')
+            command, headers, body = stomppy.utils.parse_frame(data[:data.index('\x00')], False)
+            if command == 'CONNECTED':
+                sock.sendall('DISCONNECT\n\n\x00')
+                return None
+            elif command == 'ERROR':
+                return headers.get('message', None) or body.strip() or 'ERROR frame'
+            else:
+                return "unexpected '%s' frame" % command
+        finally:
+            sock.close()
+
+    def _load_cache(self):
+        if self._cache_path is not None:
+            import json
+            try:
+                with open(self._cache_path, 'rb') as input:
+                    return json.load(input)
+            except Exception:
+                pass
+        return {}
+
+    def _save_cache(self, cache):
+        if self._cache_path is None:
+            return
+        now = time.time()
+        cache = dict([
+            (key, checked) for key, checked in cache.iteritems()
+            if now - checked < self.CACHE_TTL])
+        import json
+        try:
+            temporary_path = self._cache_path + '.tmp'
+            with open(temporary_path, 'wb') as output:
+                json.dump(cache, output)
+            if SplunkHelper.IS_WINDOWS and os.path.exists(self._cache_path):
+                os.remove(self._cache_path)
+            os.rename(temporary_path, self._cache_path)
+        except Exception as e:
+            logging.warning("Unable to save broker probe cache '%s': %s", self._cache_path, e)
+
+
 def parse_name(name):
     match = re.\
         compile(r'^(?:stomp://)?(?P<host>[^\:]+)\:(?P<port>\d+)(?P<destination>/.*)$').\
@@ -196,34 +1786,337 @@ def parse_name(name):
         return None
 
 
+def stanza_name(config):
+    '''
+    Return the full stanza name (stomp://...), from the configuration (when
+    running) or from the validation data (when validating arguments, where
+    the scheme is missing).
+    '''
+    name = config.get('name', None) or config['stanza']
+    return name if name.startswith('stomp://') else 'stomp://' + name
+
+
+def parse_destinations(config, destination):
+    '''
+    Return the list of (subscription id, destination) tuples subscribed by a
+    stanza: the destination in its name (used as is, so a comma separated
+    name is still a single composite destination on ActiveMQ), followed by
+    the additional ones in the destinations option. The first one keeps the
+    configured subscription id, so existing (persistent) subscriptions are
+    not affected.
+    '''
+    destinations = [destination] + split_list(config.get('destinations', None) or '')
+    for destination in destinations:
+        if not destination.startswith('/'):
+            raise Exception("Wrong destination: '%s' (expected /queue/..., /topic/...)." % destination)
+    if len(set(destinations)) != len(destinations):
+        raise Exception('Duplicated destinations: %s.' % ', '.join(destinations))
+    subscription_id = config.get('subscription_id', None) or 'splunk-stomp'
+    return [
+        (subscription_id if i == 0 else '%s-%d' % (subscription_id, i + 1), destination)
+        for i, destination in enumerate(destinations)]
+
+
+def escape_xml(data):
+    '''
+    Escape '&', '<' and '>' in a string of data (as xml.sax.saxutils.escape,
+    which is slow to import).
+    '''
+    return data.replace('&', '&amp;').replace('>', '&gt;').replace('<', '&lt;')
+
+
+def is_chunked(body):
+    '''
+    Check if the body is an iterator of string chunks (see BodyDecoder).
+    '''
+    return hasattr(body, 'next')
+
+
+def read_chunks(file, size=65536):
+    '''
+    Iterate over the contents of a file-like object in chunks of 'size'
+    bytes.
+    '''
+    while True:
+        chunk = file.read(size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def to_text(body):
+    '''
+    Render transformed (i.e. non string) message bodies as compact JSON.
+    '''
+    if isinstance(body, basestring) or is_chunked(body):
+        return body
+    else:
+        import json
+        return json.dumps(body, separators=(',', ':'))
+
+
+def glob_to_regex(pattern):
+    '''
+    Translate a glob pattern ('*' and '?' wildcards) into a regular
+    expression.
+    '''
+    return ''.join([
+        '.*' if c == '*' else '.' if c == '?' else re.escape(c)
+        for c in pattern])
+
+
+def compile_patterns(patterns):
+    '''
+    Compile a list of names, possibly including glob patterns ('*' and '?'
+    wildcards), into a (set of exact names, compiled regular expression or
+    None) tuple.
+    '''
+    names = set()
+    globs = []
+    for pattern in patterns:
+        if '*' in pattern or '?' in pattern:
+            globs.append(glob_to_regex(pattern))
+        else:
+            names.add(pattern)
+    if globs:
+        return names, re.compile('(?:%s)$' % '|'.join(globs))
+    else:
+        return names, None
+
+
+def parse_boolean(value, default=False):
+    '''
+    Parse a Splunk boolean configuration value.
+    '''
+    if value is None or value == '':
+        return default
+    return str(value).strip().lower() in ('1', 't', 'true', 'y', 'yes', 'on')
+
+
+def parse_stomp_version(config):
+    '''
+    Parse the highest STOMP protocol version to negotiate (defaults to 1.2).
+    '''
+    version = (config.get('stomp_version', None) or DEFAULT_STOMP_VERSION).strip()
+    if version not in stomppy.connect.SUPPORTED_VERSIONS:
+        raise Exception("Unsupported STOMP version '%s' (expected one of %s)" % (
+            version, ', '.join(stomppy.connect.SUPPORTED_VERSIONS)))
+    return float(version)
+
+
+def split_list(value):
+    '''
+    Split a comma separated configuration value into a list of non-empty,
+    stripped items.
+    '''
+    if not value:
+        return []
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def build_header_formatter(config):
+    '''
+    Build the per-stanza HeaderFormatter, or None if headers are neither
+    indexed nor mapped to event fields.
+    '''
+    names = split_list(config.get('index_headers', None))
+    source_header = config.get('source_header', None) or None
+    host_header = config.get('host_header', None) or None
+    if names or source_header or host_header:
+        return HeaderFormatter(
+            names,
+            config.get('index_headers_format', None) or 'kv',
+            source_header,
+            host_header)
+    else:
+        return None
+
+
+def build_body_escaper(config):
+    '''
+    Build the per-stanza BodyEscaper, or None if no normalization is enabled.
+    '''
+    options = dict([
+        (key, parse_boolean(config.get(key, None)))
+        for key in ('strip_newlines', 'collapse_crlf', 'strip_trailing_whitespace')])
+    if any(options.values()):
+        return BodyEscaper(**options)
+    else:
+        return None
+
+
+def build_record_splitter(config):
+    '''
+    Build the per-stanza RecordSplitter, or None if bodies are not split.
+    '''
+    mode = (config.get('split_mode', None) or '').strip().lower()
+    if mode in ('', 'none'):
+        return None
+    else:
+        delimiter = config.get('split_delimiter', None)
+        return RecordSplitter(
+            mode,
+            delimiter.decode('string_escape') if delimiter else '\n')
+
+
+def build_time_extractor(config):
+    '''
+    Build the per-stanza TimeExtractor, or None if event times are left to
+    Splunk.
+    '''
+    header = config.get('time_header', None) or None
+    json_field = config.get('time_json_field', None) or None
+    fallback = (config.get('time_fallback', None) or '').strip().lower() or None
+    if header or json_field or fallback not in (None, 'none'):
+        return TimeExtractor(header, json_field, fallback)
+    else:
+        return None
+
+
+def build_router(config):
+    '''
+    Build the per-stanza Router, or None if messages are not routed. Rules
+    match the destination header unless routing_header is set.
+    '''
+    header = config.get('routing_header', None) or None
+    rules = config.get('routing_rules', None) or ''
+    if rules.strip():
+        return Router(header or 'destination', rules)
+    elif header is not None:
+        raise Exception('routing_rules are required for routing.')
+    else:
+        return None
+
+
+def build_message_filter(config):
+    '''
+    Build the per-stanza MessageFilter, or None if all messages are indexed.
+    '''
+    predicates = split_list(config.get('filter', None))
+    try:
+        sample_rate = int(config.get('sample_rate', None) or 1)
+    except ValueError:
+        raise Exception("Wrong sample rate: '%s' (expected a whole number N, to index 1 in N messages)." % (
+            config['sample_rate']))
+    if predicates or sample_rate != 1:
+        return MessageFilter(predicates, sample_rate)
+    else:
+        return None
+
+
+def parse_dedup_options(config):
+    '''
+    Return the per-stanza (capacity, checkpoint path) Deduplicator options,
+    or None if deduplication is disabled.
+    '''
+    if parse_boolean(config.get('dedup', None)):
+        try:
+            capacity = int(config.get('dedup_capacity', None) or DEFAULT_DEDUP_CAPACITY)
+        except ValueError:
+            capacity = 0
+        if capacity < 1:
+            raise Exception("Wrong deduplication capacity: '%s'." % config['dedup_capacity'])
+        checkpoint_path = None
+        if config.get('checkpoint_dir', None):
+            import hashlib
+            checkpoint_path = os.path.join(
+                config['checkpoint_dir'],
+                'dedup-%s' % hashlib.md5(stanza_name(config).encode('utf-8')).hexdigest())
+        return capacity, checkpoint_path
+    else:
+        return None
+
+
+def build_deduplicator(config):
+    '''
+    Build the per-stanza Deduplicator (loading its checkpoint), or None if
+    deduplication is disabled.
+    '''
+    options = parse_dedup_options(config)
+    if options is not None:
+        return Deduplicator(*options)
+    else:
+        return None
+
+
+def build_tls_config(config):
+    '''
+    Build the per-stanza TLS configuration, shared by every connection to the
+    broker (so its SSLContext is built and its CA certificates are loaded
+    once), or None if TLS is disabled.
+    '''
+    if parse_boolean(config.get('use_ssl', None)):
+        return stomppy.connector.create_tls_config(
+            min_version=(config.get('ssl_min_version', None) or '1.2').strip(),
+            ca_certs=config.get('ssl_ca_certs', None) or None,
+            verify=parse_boolean(config.get('ssl_verify', None), True),
+            check_hostname=parse_boolean(config.get('ssl_check_hostname', None), True),
+            cert_file=config.get('ssl_cert_file', None) or None,
+            key_file=config.get('ssl_key_file', None) or None,
+            ciphers=config.get('ssl_ciphers', None) or None)
+    else:
+        return None
+
+
+def build_socket_options(config):
+    '''
+    Build the per-stanza socket tuning options, as stomppy.Connection keyword
+    arguments.
+    '''
+    options = {
+        'tcp_nodelay': parse_boolean(config.get('tcp_nodelay', None)),
+        'tcp_quickack': parse_boolean(config.get('tcp_quickack', None)),
+        'receive_buffer_size': int(config.get('receive_buffer_size', None) or 0) or None,
+        'ack_coalesce_interval': float(config.get('ack_coalesce_ms', None) or 0) / 1000 or None,
+        'dispatch_workers': int(config.get('dispatch_workers', None) or 0),
+        'dispatch_queue_size': int(config.get('dispatch_queue_size', None) or DEFAULT_DISPATCH_QUEUE_SIZE),
+        'dispatch_group_header': config.get('dispatch_group_header', None) or None,
+    }
+    if options['dispatch_workers'] < 0 or options['dispatch_queue_size'] < 1:
+        raise Exception('Wrong dispatch_workers / dispatch_queue_size (expected positive numbers).')
+    keepalive = (config.get('tcp_keepalive', None) or '').strip()
+    if ',' in keepalive:
+        values = [int(value) for value in split_list(keepalive)]
+        if len(values) != 3:
+            raise Exception("Invalid tcp_keepalive '%s' (expected idle,interval,count)" % keepalive)
+        options['keepalive'] = tuple(['linux'] + values)
+    else:
+        options['keepalive'] = parse_boolean(keepalive) or None
+    return options
+
+
+def build_body_decoder(config):
+    '''
+    Build the per-stanza BodyDecoder, or None if body decoding is disabled.
+    '''
+    encoding = (config.get('body_encoding', None) or '').strip().lower() or None
+    if encoding == 'none':
+        return None
+    else:
+        max_inflated_size = config.get('max_inflated_size', None)
+        return BodyDecoder(
+            encoding,
+            config.get('encoding_header', None) or 'content-encoding',
+            int(max_inflated_size) if max_inflated_size else None)
+
+
 def get_validation_data():
     '''
     Read XML validation data passed from Splunk.
     '''
     val_data = {}
 
-    # Read everything from stdin.
-    val_str = sys.stdin.read()
-
-    # Parse the validation XML.
-    doc = xml.dom.minidom.parseString(val_str)
-    root = doc.documentElement
+    # Read everything from stdin & parse the validation XML.
+    parser = SplunkXMLParser('item').parse(sys.stdin.read())
 
-    logging.debug('VALIDATION XML: found items')
-    item_node = root.getElementsByTagName('item')[0]
-    if item_node:
+    if parser.checkpoint_dir:
+        val_data['checkpoint_dir'] = parser.checkpoint_dir
+    if parser.name is not None:
         logging.debug('VALIDATION XML: found item')
-
-        name = item_node.getAttribute('name')
-        val_data['stanza'] = name
-
-        params_node = item_node.getElementsByTagName('param')
-        for param in params_node:
-            name = param.getAttribute('name')
+        val_data['stanza'] = parser.name
+        for name, value in parser.params.iteritems():
             logging.debug('VALIDATION XML: found param %s', name)
-            if name and param.firstChild and \
-               param.firstChild.nodeType == param.firstChild.TEXT_NODE:
-                val_data[name] = param.firstChild.data
+            val_data[name] = value
 
     # Done!
     return val_data
@@ -236,36 +2129,22 @@ def get_config():
     config = {}
 
     try:
-        # Read everything from stdin.
-        config_str = sys.stdin.read()
-
-        # Parse the config XML.
-        doc = xml.dom.minidom.parseString(config_str)
-        root = doc.documentElement
-        conf_node = root.getElementsByTagName('configuration')[0]
-        if conf_node:
-            logging.debug('CONFIG XML: found configuration')
-            stanza = conf_node.getElementsByTagName('stanza')[0]
-            if stanza:
-                stanza_name = stanza.getAttribute("name")
-                if stanza_name:
-                    logging.debug('CONFIG XML: found stanza ' + stanza_name)
-                    config['name'] = stanza_name
-
-                    params = stanza.getElementsByTagName('param')
-                    for param in params:
-                        param_name = param.getAttribute('name')
-                        logging.debug("CONFIG XML: found param '%s'", param_name)
-                        if param_name and param.firstChild and \
-                           param.firstChild.nodeType == param.firstChild.TEXT_NODE:
-                            data = param.firstChild.data
-                            config[param_name] = data
-                            logging.debug("CONFIG XML: '%s' -> '%s'", param_name, data)
+        # Read everything from stdin & parse the config XML.
+        parser = SplunkXMLParser('stanza').parse(sys.stdin.read())
+
+        if parser.checkpoint_dir:
+            config['checkpoint_dir'] = parser.checkpoint_dir
+        if parser.name:
+            logging.debug('CONFIG XML: found stanza ' + parser.name)
+            config['name'] = parser.name
+            for name, value in parser.params.iteritems():
+                config[name] = value
+                logging.debug("CONFIG XML: '%s' -> '%s'", name, value)
     except Exception, e:
         raise Exception('Error getting Splunk configuration via STDIN: %s' % str(e))
 
     # No configuration?
-    if not config:
+    if 'name' not in config:
         raise Exception('Invalid configuration received from Splunk.')
 
     # Some basic validation: make sure some keys are present (required).
@@ -294,16 +2173,31 @@ def validate_arguments():
         # Check stanza format.
         name = parse_name(val_data['stanza'])
         if name:
+            # Check message decoding & formatting options.
+            build_body_decoder(val_data)
+            build_record_splitter(val_data)
+            build_time_extractor(val_data)
+            parse_destinations(val_data, name[2])
+            build_router(val_data)
+            build_message_filter(val_data)
+            parse_dedup_options(val_data)
+            build_header_formatter(val_data)
+            tls = build_tls_config(val_data)
+            build_socket_options(val_data)
+            stomp_version = parse_stomp_version(val_data)
+
             # Check MQM reachability.
-            connection = stomppy.Connection(
-                host_and_ports=[(name[0], name[1])],
-                user=val_data.get('username', None),
-                passcode=val_data.get('password', None))
-            try:
-                connection.start()
-                connection.connect()
-            finally:
-                connection.disconnect()
+            cache_path = None
+            if val_data.get('checkpoint_dir', None):
+                cache_path = os.path.join(val_data['checkpoint_dir'], 'validation-cache.json')
+            probe = BrokerProbe(
+                float(val_data.get('validation_timeout', None) or DEFAULT_VALIDATION_TIMEOUT),
+                val_data.get('username', None) or None,
+                val_data.get('password', None) or None,
+                cache_path,
+                tls,
+                stomp_version)
+            probe.check([(name[0], name[1])])
         else:
             raise Exception("Wrong stanza format: '%s'." % val_data['stanza'])
     except Exception, e:
@@ -324,15 +2218,47 @@ def usage():
     sys.exit(2)
 
 
+def get_ack_mode(connection, use_explicit_acks, dispatch_workers):
+    '''
+    Return the subscription ack mode. Messages processed in parallel by
+    several dispatch workers complete out of order, so they are ACKed
+    individually (cumulative ACKs would also acknowledge messages still
+    being processed by other workers).
+    '''
+    if not use_explicit_acks:
+        return 'auto'
+    if dispatch_workers > 1:
+        if connection.version >= 1.1:
+            return 'client-individual'
+        logging.warning(
+            'STOMP 1.0 has no individual ACKs: messages processed by other dispatch '
+            'workers may be acknowledged before they are indexed.')
+    return 'client'
+
+
 def run():
     # Fetch configuration.
     config = get_config()
     host, port, destination = parse_name(config['name'])
     username = config.get('username', None)
     password = config.get('password', None)
-    use_explicit_acks = config.get('use_explicit_acks', False)
-    use_persistent_subscription = config.get('use_persistent_subscription', False)
-    subscription_id = config.get('subscription_id', 'splunk-stomp')
+    use_explicit_acks = parse_boolean(config.get('use_explicit_acks', None))
+    use_persistent_subscription = parse_boolean(config.get('use_persistent_subscription', None))
+    subscriptions = parse_destinations(config, destination)
+    header_formatter = build_header_formatter(config)
+    body_escaper = build_body_escaper(config)
+    body_decoder = build_body_decoder(config)
+    record_splitter = build_record_splitter(config)
+    time_extractor = build_time_extractor(config)
+    router = build_router(config)
+    message_filter = build_message_filter(config)
+    selector = config.get('selector', None) or None
+    deduplicator = build_deduplicator(config)
+    large_body_threshold = int(
+        config.get('large_body_threshold', None) or DEFAULT_LARGE_BODY_THRESHOLD) or None
+    tls = build_tls_config(config)
+    socket_options = build_socket_options(config)
+    stomp_version = parse_stomp_version(config)
 
     # Connect & listen.
     SplunkHelper.open_stream()
@@ -340,17 +2266,33 @@ def run():
     while not stopping:
         try:
             # Connect & subscribe.
-            connection = stomppy.Connection(host_and_ports=[(host, port)], user=username, passcode=password)
-            connection.set_listener('', SplunkListener(connection, use_explicit_acks))
+            connection = stomppy.Connection(
+                host_and_ports=[(host, port)], user=username, passcode=password,
+                version=stomp_version, transform_bodies=False,
+                large_body_threshold=large_body_threshold, tls=tls,
+                **socket_options)
+            connection.set_listener('', SplunkListener(
+                connection, use_explicit_acks, header_formatter, body_escaper, body_decoder,
+                record_splitter, time_extractor, router, message_filter, deduplicator))
             connection.start()
             connection.connect(wait=True)
-            connection.subscribe(**{
-                'destination': destination,
-                'version': 1.1,
-                'ack': 'client' if use_explicit_acks else 'auto',
-                'persistent': 'true' if use_persistent_subscription else 'false',
-                'id': subscription_id,
-            })
+            # All destinations share the connection, told apart by their
+            # subscription id (see destinations).
+            ack_mode = get_ack_mode(connection, use_explicit_acks, socket_options['dispatch_workers'])
+            for subscription_id, destination in subscriptions:
+                subscribe_headers = {
+                    'destination': destination,
+                    'ack': ack_mode,
+                    'persistent': 'true' if use_persistent_subscription else 'false',
+                    'id': subscription_id,
+                }
+                if selector is not None:
+                    subscribe_headers['selector'] = selector
+                connection.subscribe(**subscribe_headers)
+            if len(subscriptions) > 1:
+                logging.info('Subscribed to %d destinations: %s', len(subscriptions),
+                             ', '.join(['%s (%s)' % (destination, subscription_id)
+                                        for subscription_id, destination in subscriptions]))
 
             # Periodically check for termination.
             while not stopping:
@@ -360,8 +2302,11 @@ def run():
                 # Is the STOMP connection still valid?
                 elif not connection.is_connected():
                     break
-                # Wait for the next check.
+                # Wait for the next check (checkpoint failures are only
+                # logged, see Deduplicator.save).
                 else:
+                    if deduplicator is not None:
+                        deduplicator.checkpoint()
                     time.sleep(1)
 
             # Avoid reconnection stampede when restarting.
@@ -374,6 +2319,8 @@ def run():
                 connection.disconnect()
             except:
                 pass
+    if deduplicator is not None:
+        deduplicator.save()
     SplunkHelper.close_stream()
 
 
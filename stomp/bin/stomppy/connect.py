@@ -6,22 +6,17 @@ import sys
 import threading
 import time
 import types
-import xml.dom.minidom
 
 try:
     from cStringIO import StringIO
 except ImportError:
     from io import StringIO
 
-try:
-    import ssl
-    from ssl import SSLError
-    DEFAULT_SSL_VERSION = ssl.PROTOCOL_SSLv3
-except ImportError: # python version < 2.6 without the backported ssl module
-    ssl = None
-    class SSLError:
-        pass
-    DEFAULT_SSL_VERSION = None
+#
+# The ssl module is slow to import and only needed for SSL connections, so it
+# is imported on first use (see get_ssl). None selects the default protocol
+#
+DEFAULT_SSL_VERSION = None
 
 try:
     from socket import SOL_SOCKET, SO_KEEPALIVE
@@ -30,24 +25,58 @@ try:
 except ImportError:
     LINUX_KEEPALIVE_AVAIL=False
 
+import connector
 import exception
 import listener
+import receipt
 import utils
 from backward import decode, encode, hasbyte, pack, socksend, NULL
 
-try:
-    import uuid    
-except ImportError:
-    from backward import uuid
-
-try:
-    from fractions import gcd
-except ImportError:
-    from backward import gcd
+# fractions.gcd is not used, as it pulls the (slow to import) decimal module
+from backward import gcd
 
 import logging
 log = logging.getLogger('stomp.py')
 
+def get_ssl():
+    """
+    Import the ssl module on first use, returning None if it's not available
+    (python version < 2.6 without the backported ssl module)
+    """
+    try:
+        import ssl
+        return ssl
+    except ImportError:
+        return None
+
+def get_tempfile():
+    """
+    Import the tempfile module on first use (only needed for large frames)
+    """
+    import tempfile
+    return tempfile
+
+def new_uuid():
+    """
+    Return a new random unique id. The uuid module is slow to import, so it's
+    imported on first use
+    """
+    try:
+        import uuid
+    except ImportError:
+        from backward import uuid
+    return str(uuid.uuid4())
+
+#
+# Frame types listeners can be notified of (as on_<frame type> methods)
+#
+LISTENER_FRAME_TYPES = ('connecting', 'connected', 'disconnected', 'message', 'receipt', 'error', 'send', 'heartbeat_timeout')
+
+#
+# STOMP protocol versions accepted when connecting (up to the requested one)
+#
+SUPPORTED_VERSIONS = ('1.0', '1.1', '1.2')
+
 class Connection(object):
     """
     Represents a STOMP client connection.
@@ -58,23 +87,9 @@ class Connection(object):
     # List of all host names (unqualified, fully-qualified, and IP
     # addresses) that refer to the local host (both loopback interface
     # and external interfaces).  This is used for determining
-    # preferred targets.
-    __localhost_names = [ "localhost", "127.0.0.1" ]
-    
-    try:
-        __localhost_names.append(socket.gethostbyname(socket.gethostname()))
-    except:
-        pass
-        
-    try:
-        __localhost_names.append(socket.gethostname())
-    except:
-        pass
-        
-    try:
-        __localhost_names.append(socket.getfqdn(socket.gethostname()))
-    except:
-        pass
+    # preferred targets. It requires DNS lookups, so it's only built
+    # when first needed (see __get_localhost_names)
+    __localhost_names = None
     
     #
     # Used to parse the STOMP "content-length" header lines,
@@ -98,12 +113,25 @@ class Connection(object):
                  ssl_ca_certs = None,
                  ssl_cert_validator = None,
                  wait_on_receipt = False,
+                 max_retained_receipts = 10000,
                  ssl_version = DEFAULT_SSL_VERSION,
                  timeout = None,
                  version = 1.0,
                  strict = True,
                  heartbeats = (0, 0),
-                 keepalive = None
+                 keepalive = None,
+                 transform_bodies = True,
+                 large_body_threshold = None,
+                 address_cache = None,
+                 connect_stagger = 0.25,
+                 tls = None,
+                 tcp_nodelay = False,
+                 tcp_quickack = False,
+                 receive_buffer_size = None,
+                 ack_coalesce_interval = None,
+                 dispatch_workers = 0,
+                 dispatch_queue_size = 100,
+                 dispatch_group_header = None
                  ):
         """
         Initialize and start this connection.
@@ -177,18 +205,28 @@ class Connection(object):
         \param wait_on_receipt
             if a receipt is specified, then the send method should wait
             (block) for the server to respond with that receipt-id
-            before continuing
+            before continuing. Otherwise, send returns a receipt.Receipt
+            future which can be waited for later (see wait_for_receipts)
+
+        \param max_retained_receipts
+            maximum number of pending receipts (and of receipts nobody
+            asked for) tracked by the connection, see
+            receipt.ReceiptManager
             
         \param ssl_version
             SSL protocol to use for the connection. This should be
             one of the PROTOCOL_x constants provided by the ssl module.
-            The default is ssl.PROTOCOL_SSLv3
+            The default is ssl.PROTOCOL_TLS (ssl.PROTOCOL_SSLv23 before
+            python 2.7.13), negotiating the highest version supported by
+            both sides. Ignored if tls is set
             
         \param timeout
             the timeout value to use when connecting the stomp socket
             
         \param version
-            STOMP protocol version (1.0 or 1.1)
+            highest STOMP protocol version (1.0, 1.1 or 1.2) to negotiate.
+            Once connected, it is replaced with the version chosen by the
+            server
             
         \param strict
             if true, use the strict version of the protocol. For STOMP 1.1, this means
@@ -205,40 +243,102 @@ class Connection(object):
             default keepalive options for your OS, or as a tuple of
             values, which also enables keepalive packets, but specifies
             options specific to your OS implementation
-        """
 
-        sorted_host_and_ports = []
-        sorted_host_and_ports.extend(host_and_ports)
+        \param transform_bodies
+            if true, bodies of received frames with a 'transformation'
+            header (e.g. jms-map-xml) are transformed before listeners are
+            notified. If false, they are passed untouched, so listeners can
+            defer the transformation (see utils.transform) until needed
+
+        \param large_body_threshold
+            if set, bodies of received frames with a content-length of
+            at least this many bytes are spooled to a temporary file as
+            they arrive, instead of being accumulated in memory, and
+            listeners are notified with the (rewound) file object as
+            body. The file is closed once listeners return
+
+        \param address_cache
+            connector.AddressCache used to resolve host names (by
+            default, a cache shared by all connections, keeping
+            addresses for 5 minutes)
+
+        \param connect_stagger
+            seconds to wait for a connection attempt to complete before
+            racing it with an attempt to the next address (of the same
+            or the next host), see connector.Connector
+
+        \param tls
+            connector.TLSConfig (see connector.create_tls_config) used to
+            wrap the socket, instead of the use_ssl / ssl_* parameters.
+            Share it between the connections to the same brokers, so its
+            SSLContext (and its CA certificates) is built once
+
+        \param tcp_nodelay
+            if true, disable Nagle's algorithm (TCP_NODELAY), so small
+            frames (e.g. ACKs) are sent straight away
+
+        \param tcp_quickack
+            if true, ask the kernel to acknowledge received data
+            straight away instead of delaying the TCP ACKs
+            (TCP_QUICKACK, Linux only). The setting isn't permanent
+            (the kernel leaves quickack mode on its own), so it is set
+            again after every read
+
+        \param receive_buffer_size
+            socket receive buffer size in bytes (SO_RCVBUF), set before
+            connecting so the TCP window scale can be negotiated
+
+        \param ack_coalesce_interval
+            if set, ACK and NACK frames are not written straight away
+            but queued for up to this many seconds, and all the queued
+            ones are written with a single send call (before any other
+            frame, so the order of frames is kept, and they are always
+            written before DISCONNECT)
+
+        \param dispatch_workers
+            if set, MESSAGE frames are passed to the listeners by this
+            many worker threads instead of the receiver thread, so a slow
+            listener doesn't stop frames (receipts, heartbeats, messages
+            of other subscriptions) from being read. Messages of the same
+            subscription are still processed in order, by the same worker
+            (see dispatch.DispatchExecutor)
+
+        \param dispatch_queue_size
+            maximum number of messages waiting for every worker. Once a
+            worker's queue is full, the receiver thread waits, so the
+            broker stops sending (with client acknowledgement) or TCP
+            flow control kicks in
+
+        \param dispatch_group_header
+            if set (e.g. JMSXGroupID), messages of the same subscription
+            with different values of this header can be processed in
+            parallel, only messages of the same group keep their order
+        """
 
         #
-        # If localhost is preferred, make sure all (host, port) tuples that refer to the local host come first in the list
+        # The final, possibly sorted list of (host, port) tuples is assembled
+        # on the first connection attempt (see __get_host_and_ports), as
+        # localhost detection requires DNS lookups
         #
-        if prefer_localhost:
-            sorted_host_and_ports.sort(key = self.is_localhost)
+        self.__requested_host_and_ports = list(host_and_ports)
+        self.__server_host_and_ports = {}
+        self.__prefer_localhost = prefer_localhost
+        self.__try_loopback_connect = try_loopback_connect
+        self.__host_and_ports = None
 
-        #
-        # If the user wishes to attempt connecting to local ports using the loopback interface, for each (host, port) tuple
-        # referring to a local host, add an entry with the host name replaced by 127.0.0.1 if it doesn't exist already
-        #
-        loopback_host_and_ports = []
-        if try_loopback_connect:
-            for host_and_port in sorted_host_and_ports:
-                if self.is_localhost(host_and_port) == 1:
-                    port = host_and_port[1]
-                    if (not ("127.0.0.1", port) in sorted_host_and_ports 
-                        and not ("localhost", port) in sorted_host_and_ports):
-                        loopback_host_and_ports.append(("127.0.0.1", port))
+        self.__recv_chunks = []
+        self.__large_frame = None
+        self.__clear_recvbuf()
+        self.__large_body_threshold = large_body_threshold
 
         #
-        # Assemble the final, possibly sorted list of (host, port) tuples
+        # Listeners, and the callbacks to notify for every frame type, are
+        # replaced (never modified) when listeners are set or removed, so
+        # the receiver thread can use them without locking
         #
-        self.__host_and_ports = []
-        self.__host_and_ports.extend(loopback_host_and_ports)
-        self.__host_and_ports.extend(sorted_host_and_ports)
-
-        self.__recvbuf = ''
-
         self.__listeners = {}
+        self.__callbacks = dict([ (frame_type, ()) for frame_type in LISTENER_FRAME_TYPES ])
+        self.__listeners_lock = threading.Lock()
 
         self.__reconnect_sleep_initial = reconnect_sleep_initial
         self.__reconnect_sleep_increase = reconnect_sleep_increase
@@ -246,6 +346,22 @@ class Connection(object):
         self.__reconnect_sleep_max = reconnect_sleep_max
         self.__reconnect_attempts_max = reconnect_attempts_max
         self.__timeout = timeout
+        socket_options = []
+        if tcp_nodelay:
+            socket_options.append((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1))
+        if receive_buffer_size:
+            socket_options.append((socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer_size))
+        self.__connector = connector.Connector(address_cache, timeout, connect_stagger, socket_options)
+        self.__tcp_quickack = tcp_quickack and getattr(socket, 'TCP_QUICKACK', None)
+
+        self.__ack_coalesce_interval = ack_coalesce_interval
+        self.__pending_acks = []
+        self.__pending_acks_condition = threading.Condition()
+
+        self.__dispatch_workers = dispatch_workers
+        self.__dispatch_queue_size = dispatch_queue_size
+        self.__dispatch_group_header = dispatch_group_header
+        self.__dispatcher = None
         
         self.__connect_headers = {}
         if user is not None and passcode is not None:
@@ -253,28 +369,29 @@ class Connection(object):
             self.__connect_headers['passcode'] = passcode
 
         self.__socket = None
+        self.__connect_timings = None
         self.__socket_semaphore = threading.BoundedSemaphore(1)
         self.__current_host_and_port = None
 
         self.__receiver_thread_exit_condition = threading.Condition()
         self.__receiver_thread_exited = False
-        self.__send_wait_condition = threading.Condition()
         self.__connect_wait_condition = threading.Condition()
         
         self.blocking = None
         self.connected = False
         
         # setup SSL
-        if use_ssl and not ssl:
+        if use_ssl and not get_ssl():
             raise Exception("SSL connection requested, but SSL library not found.")
-        self.__ssl = use_ssl
+        self.__ssl = use_ssl or tls is not None
+        self.__tls = tls
         self.__ssl_cert_file = ssl_cert_file
         self.__ssl_key_file = ssl_key_file
         self.__ssl_ca_certs = ssl_ca_certs
         self.__ssl_cert_validator = ssl_cert_validator
         self.__ssl_version = ssl_version
         
-        self.__receipts = {}
+        self.__receipts = receipt.ReceiptManager(max_retained_receipts)
         self.__wait_on_receipt = wait_on_receipt
         
         # protocol version
@@ -296,17 +413,93 @@ class Connection(object):
         self.create_thread_fc = default_create_thread
 
         self.__keepalive = keepalive
+        self.__transform_bodies = transform_bodies
+
+        # optional callback receiving every raw chunk read from the socket
+        self.__receive_tap = None
 
     def is_localhost(self, host_and_port):
         """
         Return true if the specified host+port is a member of the 'localhost' list of hosts
         """
         (host, port) = host_and_port
-        if host in Connection.__localhost_names:
+        if host in ("localhost", "127.0.0.1") or host in self.__get_localhost_names():
             return 1
         else:
             return 2
+
+    @classmethod
+    def __get_localhost_names(cls):
+        """
+        Return the (cached) list of host names referring to the local host
+        """
+        if cls.__localhost_names is None:
+            localhost_names = [ "localhost", "127.0.0.1" ]
+
+            try:
+                localhost_names.append(socket.gethostbyname(socket.gethostname()))
+            except:
+                pass
+
+            try:
+                localhost_names.append(socket.gethostname())
+            except:
+                pass
+
+            try:
+                localhost_names.append(socket.getfqdn(socket.gethostname()))
+            except:
+                pass
+
+            cls.__localhost_names = localhost_names
+        return cls.__localhost_names
+
+    def __get_host_and_ports(self):
+        """
+        Return the final, possibly sorted list of (host, port) tuples to try
+        connecting to (built on first use)
+        """
+        if self.__host_and_ports is None:
+            sorted_host_and_ports = []
+            sorted_host_and_ports.extend(self.__requested_host_and_ports)
+
+            #
+            # If localhost is preferred, make sure all (host, port) tuples that refer to the local host come first in the list
+            #
+            if self.__prefer_localhost:
+                sorted_host_and_ports.sort(key = self.is_localhost)
+
+            #
+            # If the user wishes to attempt connecting to local ports using the loopback interface, for each (host, port) tuple
+            # referring to a local host, add an entry with the host name replaced by 127.0.0.1 if it doesn't exist already
+            #
+            loopback_host_and_ports = []
+            if self.__try_loopback_connect:
+                for host_and_port in sorted_host_and_ports:
+                    if self.is_localhost(host_and_port) == 1:
+                        port = host_and_port[1]
+                        if (not ("127.0.0.1", port) in sorted_host_and_ports 
+                            and not ("localhost", port) in sorted_host_and_ports):
+                            loopback_host_and_ports.append(("127.0.0.1", port))
+                            self.__server_host_and_ports[("127.0.0.1", port)] = host_and_port
+
+            #
+            # Assemble the final, possibly sorted list of (host, port) tuples
+            #
+            self.__host_and_ports = []
+            self.__host_and_ports.extend(loopback_host_and_ports)
+            self.__host_and_ports.extend(sorted_host_and_ports)
+        return self.__host_and_ports
             
+    def __get_server_host_and_port(self, host_and_port):
+        """
+        Return the (host, port) tuple a connection to the given one was
+        requested for: the original host name if the loopback interface was
+        substituted, as TLS server name (SNI) and for certificate
+        verification
+        """
+        return self.__server_host_and_ports.get(host_and_port, host_and_port)
+
     def override_threading(self, create_thread_fc):
         """
         Override for thread creation. Use an alternate threading library by
@@ -315,6 +508,16 @@ class Connection(object):
         """
         self.create_thread_fc = create_thread_fc
 
+    def set_receive_tap(self, receive_tap):
+        """
+        Set a callback receiving every raw chunk of data read from the socket,
+        before it is decoded or split into frames (e.g. to record the wire
+        traffic). Set to None to remove it.
+
+        \param receive_tap a function with a single argument (the raw data)
+        """
+        self.__receive_tap = receive_tap
+
     #
     # Manage the connection
     #
@@ -327,7 +530,20 @@ class Connection(object):
         """
         self.__running = True
         self.__attempt_connection()
+        if self.__dispatch_workers:
+            #
+            # A new executor for every receiver loop, so the workers of a
+            # previous connection (still processing their queued messages)
+            # never take messages of this one (imported here, as it's only
+            # needed with dispatch workers)
+            #
+            import dispatch
+            self.__dispatcher = dispatch.DispatchExecutor(self.__dispatch_workers, self.__dispatch_queue_size,
+                                                          self.__dispatch_group_header, self.create_thread_fc)
+            self.__dispatcher.start()
         thread = self.create_thread_fc(self.__receiver_loop)
+        if self.__ack_coalesce_interval:
+            self.create_thread_fc(self.__ack_writer_loop)
         self.__notify('connecting')
 
     def stop(self):
@@ -351,6 +567,26 @@ class Connection(object):
         """
         return self.__current_host_and_port
         
+    def get_connect_timings(self):
+        """
+        Return a (connect seconds, TLS handshake seconds) tuple for the
+        current connection (None if not connected). The handshake time is
+        None without SSL, or if the socket was wrapped with the legacy ssl_*
+        parameters
+        """
+        return self.__connect_timings
+
+    def get_connect_latencies(self):
+        """
+        Return a dictionary with the last connect latency in seconds (None
+        if the attempt failed) of every address of the brokers of this
+        connection tried (also by previous connections, as latencies are
+        shared, see connector.DEFAULT_LATENCIES), keyed by ((host, port),
+        socket address) tuples
+        """
+        host_and_ports = self.__get_host_and_ports()
+        return dict([ (key, latency) for (key, latency) in list(self.__connector.latencies.items()) if key[0] in host_and_ports ])
+
     def is_connected(self):
         """
         Return true if the socket managed by this connection is connected
@@ -373,7 +609,13 @@ class Connection(object):
         \param name the name of the listener
         \param listener the listener object
         """
-        self.__listeners[name] = listener
+        self.__listeners_lock.acquire()
+        try:
+            listeners = dict(self.__listeners)
+            listeners[name] = listener
+            self.__set_listeners(listeners)
+        finally:
+            self.__listeners_lock.release()
         
     def remove_listener(self, name):
         """
@@ -381,7 +623,35 @@ class Connection(object):
         
         \param name the name of the listener to remove
         """
-        del self.__listeners[name]
+        self.__listeners_lock.acquire()
+        try:
+            listeners = dict(self.__listeners)
+            del listeners[name]
+            self.__set_listeners(listeners)
+        finally:
+            self.__listeners_lock.release()
+
+    def __set_listeners(self, listeners):
+        """
+        Build the table of callbacks (bound on_<frame type> methods) to notify
+        for every frame type, and replace the listeners and their table.
+        Methods are looked up once here, so methods added to a listener
+        after it's set are not notified
+        """
+        callbacks = {}
+        for frame_type in LISTENER_FRAME_TYPES:
+            method_name = 'on_' + frame_type
+            frame_callbacks = []
+            for listener in listeners.values():
+                if not listener:
+                    continue
+                if hasattr(listener, method_name):
+                    frame_callbacks.append(getattr(listener, method_name))
+                else:
+                    log.debug('listener %s has no method %s', listener, method_name)
+            callbacks[frame_type] = tuple(frame_callbacks)
+        self.__callbacks = callbacks
+        self.__listeners = listeners
 
     def get_listener(self, name):
         """
@@ -417,29 +687,103 @@ class Connection(object):
         
     def send(self, message='', headers={}, **keyword_headers):
         """
-        Send a message (SEND) frame
+        Send a message (SEND) frame. If a receipt is requested, returns its
+        receipt.Receipt future (already received if wait_on_receipt is set)
         """
         merged_headers = utils.merge_headers([headers, keyword_headers])
         
-        if self.__wait_on_receipt and 'receipt' in merged_headers.keys():
-            self.__send_wait_condition.acquire()
+        future = None
+        if 'receipt' in merged_headers:
+            future = self.__receipts.expect(merged_headers['receipt'])
          
         self.__send_frame_helper('SEND', message, merged_headers, [ 'destination' ])
         self.__notify('send', headers, message)
         
         # if we need to wait-on-receipt, then block until the receipt frame arrives 
-        if self.__wait_on_receipt and 'receipt' in merged_headers.keys():
-            receipt = merged_headers['receipt']
-            while receipt not in self.__receipts:
-                self.__send_wait_condition.wait()
-            self.__send_wait_condition.release()
-            del self.__receipts[receipt]
+        if self.__wait_on_receipt and future is not None:
+            future.wait()
+        return future
+
+    def wait_for_receipts(self, receipts, timeout=None):
+        """
+        Wait for several receipts (as returned by send / send_many), for
+        timeout seconds at most overall. Returns the list of receipts which
+        didn't arrive in time, and raises if the connection was lost
+        """
+        return self.__receipts.wait_all(receipts, timeout)
     
+    def send_many(self, destination, messages, headers={}, receipt=None, wait_on_receipt=True, **keyword_headers):
+        """
+        Send several messages (SEND frames) to the same destination. The
+        static header block is encoded once, and all frames are built into a
+        single buffer written with one sendall under one lock acquisition.
+
+        \param destination
+            the destination all messages are sent to
+
+        \param messages
+            a sequence of message payloads
+
+        \param headers
+            a map of headers added to every message
+
+        \param receipt
+            if set, a receipt is requested for the last frame of the batch
+            and the call blocks until it arrives. Either the receipt id to use,
+            or True to use a generated one. Returns the receipt (a
+            receipt.Receipt future, usable as the receipt id).
+
+        \param wait_on_receipt
+            if false, return without waiting for the receipt, so several
+            batches can be pipelined (see wait_for_receipts)
+        """
+        messages = list(messages)
+        if not messages:
+            return None
+
+        merged_headers = utils.merge_headers([headers, keyword_headers])
+        merged_headers['destination'] = destination
+        if receipt is True:
+            receipt = new_uuid()
+        future = None
+
+        header_block = 'SEND\n' + ''.join(self.__format_headers('SEND', merged_headers))
+        frame = []
+        last = len(messages) - 1
+        for index, message in enumerate(messages):
+            frame.append(header_block)
+            if type(message) == dict:
+                frame.append('transformation:jms-map-xml\n')
+                message = self.__convert_dict(message)
+            message = encode(message)
+            if hasbyte(0, message):
+                frame.append('content-length:%d\n' % len(message))
+            if index == last and receipt:
+                frame.extend(self.__format_headers('SEND', { 'receipt' : receipt }))
+            frame.append('\n')
+            frame.append(message)
+            frame.append(NULL)
+
+        if self.__socket is None:
+            raise exception.NotConnectedException()
+        if receipt:
+            future = self.__receipts.expect(receipt)
+        self.__write(pack(frame))
+        log.debug("Sent %d frames: type=SEND, headers=%r", len(messages), merged_headers)
+        for message in messages:
+            self.__notify('send', merged_headers, message)
+
+        # block until the receipt frame for the last message arrives
+        if future is not None and wait_on_receipt:
+            future.wait()
+        return future
+
     def ack(self, headers={}, **keyword_headers):
         """
-        Send an ACK frame, to acknowledge receipt of a message
+        Send an ACK frame, to acknowledge receipt of a message (identified by
+        its 'id' with STOMP 1.2, see get_ack_headers)
         """
-        self.__send_frame_helper('ACK', '', utils.merge_headers([headers, keyword_headers]), [ 'message-id' ])
+        self.__send_frame_helper('ACK', '', utils.merge_headers([headers, keyword_headers]), [ self.__ack_id_header() ])
         
     def nack(self, headers={}, **keyword_headers):
         """
@@ -447,7 +791,26 @@ class Connection(object):
         """
         if self.version < 1.1:
             raise RuntimeError('NACK is not supported with 1.0 connections')
-        self.__send_frame_helper('NACK', '', utils.merge_headers([headers, keyword_headers]), [ 'message-id' ])
+        self.__send_frame_helper('NACK', '', utils.merge_headers([headers, keyword_headers]), [ self.__ack_id_header() ])
+
+    def get_ack_headers(self, headers):
+        """
+        Return the headers identifying a received message in ACK / NACK
+        frames, given its headers: its 'ack' header as 'id' (STOMP 1.2), or
+        its message-id (and subscription, STOMP 1.1)
+        """
+        if self.version >= 1.2 and 'ack' in headers:
+            return { 'id' : headers['ack'] }
+        elif 'subscription' in headers:
+            return { 'message-id' : headers['message-id'], 'subscription' : headers['subscription'] }
+        else:
+            return { 'message-id' : headers['message-id'] }
+
+    def __ack_id_header(self):
+        if self.version >= 1.2:
+            return 'id'
+        else:
+            return 'message-id'
         
     def begin(self, headers={}, **keyword_headers):
         """
@@ -455,7 +818,7 @@ class Connection(object):
         """
         use_headers = utils.merge_headers([headers, keyword_headers])
         if not 'transaction' in use_headers.keys(): 
-            use_headers['transaction'] = str(uuid.uuid4())
+            use_headers['transaction'] = new_uuid()
         self.__send_frame_helper('BEGIN', '', use_headers, [ 'transaction' ])
         return use_headers['transaction']
 
@@ -479,13 +842,15 @@ class Connection(object):
         if 'wait' in keyword_headers and keyword_headers['wait']:
             wait = True
             del keyword_headers['wait']
-            
+
+        # don't modify the caller's (or the default) headers map
+        headers = dict(headers)
         if self.version >= 1.1:
             if self.__strict:
                 cmd = 'STOMP'
             else:
                 cmd = 'CONNECT'
-            headers['accept-version'] = self.version
+            headers['accept-version'] = ','.join([ v for v in SUPPORTED_VERSIONS if float(v) <= self.version ])
             headers['heart-beat'] = '%s,%s' % self.heartbeats
         else:
             cmd = 'CONNECT'
@@ -528,13 +893,15 @@ class Connection(object):
                 _, e, _ = sys.exc_info()
                 log.warn('Unable to close socket because of error "%s"' % e)
         self.__current_host_and_port = None
+        self.__connect_timings = None
         
     def disconnect(self, send_disconnect=True, headers={}, **keyword_headers):
         """
         Send a DISCONNECT frame to finish a connection
         """
+        headers = dict(headers)
         if self.version >= 1.1 and 'receipt' not in headers:
-            headers['receipt'] = str(uuid.uuid4())
+            headers['receipt'] = new_uuid()
         try:
             self.__send_frame_helper('DISCONNECT', '', utils.merge_headers([self.__connect_headers, headers, keyword_headers]), [ ])
         except exception.NotConnectedException:
@@ -592,6 +959,17 @@ class Connection(object):
                 raise KeyError("Command %s requires header %r" % (command, required_header_key))
         self.__send_frame(command, headers, payload)
 
+    def __format_headers(self, command, headers):
+        """
+        Return the "key:value" header lines of a frame, escaped on STOMP 1.1+
+        connections (except for CONNECT / STOMP frames, sent before the
+        version is negotiated)
+        """
+        if self.version >= 1.1 and command not in (None, 'CONNECT', 'STOMP'):
+            return [ '%s:%s\n' % (utils.escape_header('%s' % key, self.version), utils.escape_header('%s' % val, self.version)) for key, val in headers.items() ]
+        else:
+            return [ '%s:%s\n' % (key, val) for key, val in headers.items() ]
+
     def __send_frame(self, command, headers={}, payload=''):
         """
         Send a STOMP frame.
@@ -621,9 +999,7 @@ class Connection(object):
                 if command is not None:
                     frame.append(command + '\n')
                     
-                for key, val in headers.items():
-                    frame.append('%s:%s\n' % (key, val))
-                        
+                frame.extend(self.__format_headers(command, headers))
                 frame.append('\n')
                     
                 if payload:
@@ -632,13 +1008,11 @@ class Connection(object):
                 if command is not None:
                     # only send the terminator if we're sending a command (heartbeats have no term)
                     frame.append(NULL)
-                frame = pack(frame)
-                self.__socket_semaphore.acquire()
-                try:
-                    socksend(self.__socket, frame)
-                    log.debug("Sent frame: type=%s, headers=%r, body=%r" % (command, headers, payload))
-                finally:
-                    self.__socket_semaphore.release()
+                if self.__ack_coalesce_interval and command in ('ACK', 'NACK'):
+                    self.__queue_ack(pack(frame))
+                else:
+                    self.__write(pack(frame))
+                log.debug("Sent frame: type=%s, headers=%r, body=%r", command, headers, payload)
             except Exception:
                 _, e, _ = sys.exc_info()
                 log.error("Error sending frame: %s" % e)
@@ -646,6 +1020,75 @@ class Connection(object):
         else:
             raise exception.NotConnectedException()
 
+    def __write(self, data):
+        """
+        Write already encoded frame data to the socket, holding the socket
+        semaphore so frames written from different threads don't interleave.
+        """
+        self.__socket_semaphore.acquire()
+        try:
+            if self.__pending_acks:
+                data = self.__take_pending_acks() + data
+            socksend(self.__socket, data)
+        finally:
+            self.__socket_semaphore.release()
+
+    def __queue_ack(self, data):
+        """
+        Queue an encoded ACK / NACK frame, to be written by the ack writer
+        thread (or before the next frame)
+        """
+        self.__pending_acks_condition.acquire()
+        try:
+            self.__pending_acks.append(data)
+            if len(self.__pending_acks) == 1:
+                self.__pending_acks_condition.notify()
+        finally:
+            self.__pending_acks_condition.release()
+
+    def __take_pending_acks(self):
+        self.__pending_acks_condition.acquire()
+        try:
+            data = ''.join(self.__pending_acks)
+            self.__pending_acks = []
+            return data
+        finally:
+            self.__pending_acks_condition.release()
+
+    def __flush_acks(self):
+        """
+        Write all the queued ACK / NACK frames with a single send call
+        """
+        self.__socket_semaphore.acquire()
+        try:
+            data = self.__take_pending_acks()
+            if data and self.__socket is not None:
+                socksend(self.__socket, data)
+        finally:
+            self.__socket_semaphore.release()
+
+    def __ack_writer_loop(self):
+        """
+        Loop writing the queued ACK / NACK frames once the first of them has
+        waited for the coalescing interval
+        """
+        while self.__running:
+            self.__pending_acks_condition.acquire()
+            try:
+                if not self.__pending_acks:
+                    self.__pending_acks_condition.wait(1.0)
+                pending = bool(self.__pending_acks)
+            finally:
+                self.__pending_acks_condition.release()
+            if not pending:
+                continue
+            time.sleep(self.__ack_coalesce_interval)
+            try:
+                self.__flush_acks()
+            except Exception:
+                _, e, _ = sys.exc_info()
+                log.warning("Error sending ACK frames: %s" % e)
+
     def __notify(self, frame_type, headers=None, body=None):
         """
         Utility function for notifying listeners of incoming and outgoing messages
@@ -660,16 +1103,12 @@ class Connection(object):
             the content of the message
         """
         if frame_type == 'receipt':
-            # logic for wait-on-receipt notification
-            self.__send_wait_condition.acquire()
-            self.__send_wait_condition.notify()
-            self.__send_wait_condition.release()
-            
-            receipt = headers['receipt-id']
-            self.__receipts[receipt] = None
+            # wake up whoever waits for this receipt (only them)
+            receipt_id = headers['receipt-id']
+            self.__receipts.received(receipt_id)
 
             # received a stomp 1.1 disconnect receipt
-            if receipt == self.__disconnect_receipt:
+            if receipt_id == self.__disconnect_receipt:
                 self.disconnect_socket()
 
         if frame_type == 'connected':
@@ -681,33 +1120,32 @@ class Connection(object):
                 if self.version >= 1.1:
                     log.warn('Downgraded STOMP protocol version to 1.0')
                 self.version = 1.0
+            elif float(headers['version']) != self.version:
+                log.info('Negotiated STOMP protocol version %s' % headers['version'])
+                self.version = float(headers['version'])
             if 'heart-beat' in headers.keys():
                 self.heartbeats = utils.calculate_heartbeats(headers['heart-beat'].replace(' ', '').split(','), self.heartbeats)
                 if self.heartbeats != (0,0):
                     default_create_thread(self.__heartbeat_loop)
 
-        for listener in self.__listeners.values():
-            if not listener: continue
-            if not hasattr(listener, 'on_%s' % frame_type):
-                log.debug('listener %s has no method on_%s' % (listener, frame_type))
-                continue
-
-            if frame_type == 'connecting':
-                listener.on_connecting(self.__current_host_and_port)
-                continue
-            elif frame_type == 'disconnected':
-                self.connected = False
-                listener.on_disconnected()
-                continue
-
-            notify_func = getattr(listener, 'on_%s' % frame_type)
-            notify_func(headers, body)
+        callbacks = self.__callbacks[frame_type]
+        if frame_type == 'connecting':
+            for callback in callbacks:
+                callback(self.__current_host_and_port)
+        elif frame_type == 'disconnected':
+            self.connected = False
+            for callback in callbacks:
+                callback()
+        else:
+            for callback in callbacks:
+                callback(headers, body)
 
     def __receiver_loop(self):
         """
         Main loop listening for incoming data.
         """
         log.debug("Starting receiver loop")
+        dispatcher = self.__dispatcher
         try:
             try:
                 while self.__running:
@@ -720,16 +1158,39 @@ class Connection(object):
                                 frames = self.__read()
                                 
                                 for frame in frames:
-                                    (frame_type, headers, body) = utils.parse_frame(frame)
-                                    log.debug("Received frame: %r, headers=%r, body=%r" % (frame_type, headers, body))
-                                    frame_type = frame_type.lower()
-                                    if frame_type in [ 'connected', 'message', 'receipt', 'error' ]:
-                                        self.__notify(frame_type, headers, body)
-                                    elif frame_type == 'heartbeat':
-                                        # no notifications needed
-                                        pass
+                                    if type(frame) is tuple:
+                                        #
+                                        # Large frame: (preamble, spooled body)
+                                        #
+                                        (frame_type, headers, _) = utils.parse_frame(frame[0], False, self.version)
+                                        body = frame[1]
                                     else:
-                                        log.warning('Unknown response frame type: "%s" (frame length was %d)' % (frame_type, len(frame)))
+                                        (frame_type, headers, body) = utils.parse_frame(frame, self.__transform_bodies, self.version)
+                                    log.debug("Received frame: %r, headers=%r, body=%r", frame_type, headers, body)
+                                    frame_type = frame_type.lower()
+                                    if frame_type == 'message' and dispatcher is not None:
+                                        #
+                                        # The worker closes the spooled body once listeners return
+                                        #
+                                        dispatcher.submit(headers, self.__dispatch_message, headers, body, type(frame) is tuple)
+                                        continue
+                                    try:
+                                        if frame_type == 'message':
+                                            #
+                                            # Hot path: straight to the callbacks table
+                                            #
+                                            for callback in self.__callbacks['message']:
+                                                callback(headers, body)
+                                        elif frame_type in [ 'connected', 'receipt', 'error' ]:
+                                            self.__notify(frame_type, headers, body)
+                                        elif frame_type == 'heartbeat':
+                                            # no notifications needed
+                                            pass
+                                        else:
+                                            log.warning('Unknown response frame type: "%s" (frame length was %d)' % (frame_type, len(frame)))
+                                    finally:
+                                        if type(frame) is tuple:
+                                            body.close()
                         finally:
                             try:
                                 self.__socket.close()
@@ -737,6 +1198,12 @@ class Connection(object):
                                 pass # ignore errors when attempting to close socket
                             self.__socket = None
                             self.__current_host_and_port = None
+                            #
+                            # Pending receipts will never arrive now, and ACKs
+                            # still queued can't be sent on another connection
+                            #
+                            self.__receipts.fail_all(exception.ConnectionClosedException())
+                            self.__take_pending_acks()
                     except exception.ConnectionClosedException:
                         if self.__running:
                             log.error("Lost connection")
@@ -744,19 +1211,32 @@ class Connection(object):
                             #
                             # Clear out any half-received messages after losing connection
                             #
-                            self.__recvbuf = ''
+                            self.__clear_recvbuf()
                             self.__running = False
                         break
             except:
                 log.exception("An unhandled exception was encountered in the stomp receiver loop")
 
         finally:
+            if dispatcher is not None:
+                dispatcher.shutdown()
             self.__receiver_thread_exit_condition.acquire()
             self.__receiver_thread_exited = True
             self.__receiver_thread_exit_condition.notifyAll()
             self.__receiver_thread_exit_condition.release()
             log.debug("Receiver loop ended")
             
+    def __dispatch_message(self, headers, body, spooled):
+        """
+        Notify the listeners of a MESSAGE frame (on a dispatch worker thread)
+        """
+        try:
+            for callback in self.__callbacks['message']:
+                callback(headers, body)
+        finally:
+            if spooled:
+                body.close()
+
     def __heartbeat_loop(self):
         """
         Loop for sending (and monitoring received) heartbeats
@@ -789,69 +1269,148 @@ class Connection(object):
                 if time.time() - self.__received_heartbeat > receive_sleep:
                     log.debug('Heartbeat timeout')
                     # heartbeat timeout
-                    for listener in self.__listeners.values():
-                        listener.on_heartbeat_timeout()
+                    for callback in self.__callbacks['heartbeat_timeout']:
+                        callback()
                     self.disconnect_socket()
                     self.connected = False
 
     def __read(self):
         """
-        Read the next frame(s) from the socket.
+        Read the next chunk of data from the socket, returning the list
+        of frames it completes (possibly empty). Frames are returned as
+        strings, except large frames (see large_body_threshold), which
+        are returned as (preamble, body file) tuples.
         """
-        fastbuf = StringIO()
-        while self.__running:
-            try:
-                c = self.__socket.recv(1024)
-                c = decode(c)
-                
-                # reset the heartbeat for any received message
-                self.__received_heartbeat = time.time()
-            except Exception:
-                _, e, _ = sys.exc_info()
-                c = ''
+        try:
+            c = self.__socket.recv(65536)
+            if self.__tcp_quickack:
+                #
+                # TCP_QUICKACK isn't permanent (see tcp(7)): the kernel
+                # leaves quickack mode on its own, e.g. once it sees no
+                # interactive traffic, so it has to be set again after
+                # every read to keep TCP ACKs immediate
+                #
+                self.__socket.setsockopt(socket.IPPROTO_TCP, self.__tcp_quickack, 1)
+            if self.__receive_tap is not None:
+                self.__receive_tap(c)
+            c = decode(c)
+
+            # reset the heartbeat for any received message
+            self.__received_heartbeat = time.time()
+        except Exception:
+            _, e, _ = sys.exc_info()
+            c = ''
+        if len(c) == 0:
+            raise exception.ConnectionClosedException()
+
+        result = []
+        if self.__large_frame is not None:
+            c = self.__spool(c, result)
             if len(c) == 0:
-                raise exception.ConnectionClosedException()
-            fastbuf.write(c)
-            if '\x00' in c:
+                return result
+
+        #
+        # Buffered data is only joined (and scanned) once it can complete a
+        # frame: when the content-length is known, once enough data has been
+        # received, otherwise once a NUL byte is received
+        #
+        self.__recv_chunks.append(c)
+        self.__recv_size += len(c)
+        if self.__recv_needed < 0:
+            if '\x00' not in c:
+                return result
+        elif self.__recv_size < self.__recv_needed:
+            return result
+        if len(self.__recv_chunks) > 1:
+            self.__recvbuf += ''.join(self.__recv_chunks)
+        else:
+            self.__recvbuf += c
+        self.__recv_chunks = []
+        self.__recv_needed = 0
+
+        buf = self.__recvbuf
+        pos = 0
+        while self.__running:
+            #
+            # Skip heartbeats / EOLs between frames
+            #
+            while pos < len(buf) and buf[pos] in '\r\n':
+                pos += 1
+            (preamble_end, content_offset) = utils.find_preamble_end(buf, pos)
+            if preamble_end < 0:
                 break
-            elif c == '\x0a':
-                # heartbeat (special case)
-                return c
-        self.__recvbuf += fastbuf.getvalue()
-        fastbuf.close() 
-        result = []
-        
-        if len(self.__recvbuf) > 0 and self.__running:
-            while True:
-                pos = self.__recvbuf.find('\x00')
-
-                if pos >= 0:
-                    frame = self.__recvbuf[0:pos]
-                    preamble_end = frame.find('\n\n')
-                    if preamble_end >= 0:
-                        content_length_match = Connection.__content_length_re.search(frame[0:preamble_end])
-                        if content_length_match:
-                            content_length = int(content_length_match.group('value'))
-                            content_offset = preamble_end + 2
-                            frame_size = content_offset + content_length
-                            if frame_size > len(frame):
-                                #
-                                # Frame contains NUL bytes, need to read more
-                                #
-                                if frame_size < len(self.__recvbuf):
-                                    pos = frame_size
-                                    frame = self.__recvbuf[0:pos]
-                                else:
-                                    #
-                                    # Haven't read enough data yet, exit loop and wait for more to arrive
-                                    #
-                                    break
-                    result.append(frame)
-                    self.__recvbuf = self.__recvbuf[pos+1:]
-                else:
+
+            content_length_match = Connection.__content_length_re.search(buf, pos, preamble_end)
+            if content_length_match:
+                content_length = int(content_length_match.group('value'))
+                if self.__large_body_threshold is not None and content_length >= self.__large_body_threshold:
+                    #
+                    # Large frame, spool the body to a temporary file
+                    #
+                    self.__large_frame = (buf[pos:preamble_end],
+                        get_tempfile().SpooledTemporaryFile(max_size = self.__large_body_threshold),
+                        [content_length + 1])
+                    buf = self.__spool(buf[content_offset:], result)
+                    pos = 0
+                    if self.__large_frame is not None:
+                        break
+                    continue
+                frame_end = content_offset + content_length
+                if frame_end >= len(buf):
+                    #
+                    # Haven't read enough data yet, exit loop and wait for more to arrive
+                    #
+                    self.__recv_needed = frame_end + 1 - pos
                     break
+            else:
+                frame_end = buf.find('\x00', max(preamble_end, pos + self.__recv_scanned))
+                if frame_end < 0:
+                    #
+                    # No NUL byte yet, skip the data scanned so far next time
+                    #
+                    self.__recv_scanned = len(buf) - pos
+                    self.__recv_needed = -1
+                    break
+            result.append(buf[pos:frame_end])
+            pos = frame_end + 1
+            self.__recv_scanned = 0
+
+        self.__recvbuf = buf[pos:]
+        self.__recv_size = len(self.__recvbuf)
         return result
 
+    def __spool(self, data, result):
+        """
+        Write body data of the current large frame to its spool file,
+        appending the frame to result once complete. Returns any data
+        following the frame.
+        """
+        (preamble, spool, remaining) = self.__large_frame
+        size = min(len(data), remaining[0])
+        remaining[0] -= size
+        if remaining[0] == 0:
+            # drop the terminating NUL byte
+            spool.write(data[:size - 1])
+            spool.seek(0)
+            result.append((preamble, spool))
+            self.__large_frame = None
+        else:
+            spool.write(data[:size])
+        return data[size:]
+
+    def __clear_recvbuf(self):
+        """
+        Clear out any half-received frames.
+        """
+        if self.__large_frame is not None:
+            self.__large_frame[1].close()
+        self.__large_frame = None
+        self.__recvbuf = ''
+        self.__recv_chunks = []
+        self.__recv_size = 0
+        self.__recv_needed = 0
+        self.__recv_scanned = 0
+
     def __enable_keepalive(self):
         def try_setsockopt(sock, name, fam, opt, val):
             if val is None:
@@ -909,45 +1468,65 @@ class Connection(object):
         sleep_exp = 1
         connect_count = 0
         while self.__running and self.__socket is None and connect_count < self.__reconnect_attempts_max:
-            for host_and_port in self.__host_and_ports:
-                try:
-                    log.debug("Attempting connection to host %s, port %s" % host_and_port)
-                    self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    self.__enable_keepalive()
-
-                    if self.__ssl: # wrap socket
-                        if self.__ssl_ca_certs:
-                            cert_validation = ssl.CERT_REQUIRED
-                        else:
-                            cert_validation = ssl.CERT_NONE
-                        self.__socket = ssl.wrap_socket(self.__socket, keyfile = self.__ssl_key_file,
-                                certfile = self.__ssl_cert_file, cert_reqs = cert_validation, 
-                                ca_certs = self.__ssl_ca_certs, ssl_version = self.__ssl_version)
-                    self.__socket.settimeout(self.__timeout)
-                    if self.blocking is not None:
-                        self.__socket.setblocking(self.blocking)
-                    self.__socket.connect(host_and_port)
-                    
-                    #
-                    # Validate server cert
-                    #
-                    if self.__ssl and self.__ssl_cert_validator: 
-                        cert = self.__socket.getpeercert()
-                        (ok, errmsg) = apply(self.__ssl_cert_validator, (cert, host_and_port[0]))
-                        if not ok:
-                            raise SSLError("Server certificate validation failed: %s" % errmsg)
-
-                    self.__current_host_and_port = host_and_port
-                    log.info("Established connection to host %s, port %s" % host_and_port)
-                    break
-                except socket.error:
-                    self.__socket = None
-                    if isinstance(sys.exc_info()[1], tuple):
-                        exc = sys.exc_info()[1][1]
+            host_and_ports = self.__get_host_and_ports()
+            try:
+                #
+                # Race connections to every address of every host, see
+                # connector.Connector
+                #
+                (self.__socket, host_and_port, connect_time) = self.__connector.connect(host_and_ports)
+                self.__socket.settimeout(self.__timeout)
+                self.__enable_keepalive()
+                if self.__tcp_quickack:
+                    self.__socket.setsockopt(socket.IPPROTO_TCP, self.__tcp_quickack, 1)
+                handshake_time = None
+
+                if self.__tls: # wrap socket with the shared SSLContext
+                    (self.__socket, handshake_time) = self.__tls.wrap(self.__socket, self.__get_server_host_and_port(host_and_port))
+                elif self.__ssl: # wrap socket
+                    ssl = get_ssl()
+                    if self.__ssl_ca_certs:
+                        cert_validation = ssl.CERT_REQUIRED
                     else:
-                        exc = sys.exc_info()[1]
-                    connect_count += 1
-                    log.warning("Could not connect to host %s, port %s: %s" % (host_and_port[0], host_and_port[1], exc))
+                        cert_validation = ssl.CERT_NONE
+                    self.__socket = ssl.wrap_socket(self.__socket, keyfile = self.__ssl_key_file,
+                            certfile = self.__ssl_cert_file, cert_reqs = cert_validation, 
+                            ca_certs = self.__ssl_ca_certs,
+                            ssl_version = self.__ssl_version or getattr(ssl, 'PROTOCOL_TLS', ssl.PROTOCOL_SSLv23))
+                if self.blocking is not None:
+                    self.__socket.setblocking(self.blocking)
+                
+                #
+                # Validate server cert
+                #
+                if self.__ssl and self.__ssl_cert_validator: 
+                    cert = self.__socket.getpeercert()
+                    (ok, errmsg) = apply(self.__ssl_cert_validator, (cert, self.__get_server_host_and_port(host_and_port)[0]))
+                    if not ok:
+                        raise get_ssl().SSLError("Server certificate validation failed: %s" % errmsg)
+
+                self.__current_host_and_port = host_and_port
+                self.__connect_timings = (connect_time, handshake_time)
+                if handshake_time is None:
+                    log.info("Established connection to host %s, port %s (connect %.1fms)" % (host_and_port[0], host_and_port[1], connect_time * 1000))
+                else:
+                    log.info("Established connection to host %s, port %s (connect %.1fms, TLS handshake %.1fms)" % (host_and_port[0], host_and_port[1], connect_time * 1000, handshake_time * 1000))
+            except socket.error:
+                if self.__socket is not None:
+                    try:
+                        self.__socket.close()
+                    except socket.error:
+                        pass
+                self.__socket = None
+                if isinstance(sys.exc_info()[1], tuple):
+                    exc = sys.exc_info()[1][1]
+                else:
+                    exc = sys.exc_info()[1]
+                #
+                # Every host was tried, so count an attempt for each one
+                #
+                connect_count += max(1, len(host_and_ports))
+                log.warning("Could not connect: %s" % exc)
 
             if self.__socket is None:
                 sleep_duration = (min(self.__reconnect_sleep_max, 
@@ -0,0 +1,379 @@
+import errno
+import os
+import socket
+import threading
+import time
+
+import logging
+log = logging.getLogger('stomp.py')
+
+#
+# connect_ex results meaning the (non-blocking) connection is under way
+#
+CONNECT_IN_PROGRESS = (0, errno.EINPROGRESS, errno.EWOULDBLOCK, getattr(errno, 'WSAEWOULDBLOCK', 10035))
+
+
+class AddressCache(object):
+    """
+    Caches getaddrinfo results for a number of seconds, so reconnections
+    don't wait for (or fail because of) the resolver. Stale entries are
+    still used if the name can't be resolved again.
+    """
+    def __init__(self, ttl = 300.0):
+        """
+        \param ttl
+            seconds resolved addresses are reused for
+        """
+        self.ttl = ttl
+        self.__entries = {}
+        self.__lock = threading.Lock()
+
+    def resolve(self, host, port):
+        """
+        Return the list of (family, socktype, proto, sockaddr) tuples the
+        given host and port resolve to, alternating address families (e.g.
+        IPv6, IPv4, IPv6...) so a broken family doesn't delay the other one
+        """
+        key = (host, port)
+        now = time.time()
+        with self.__lock:
+            entry = self.__entries.get(key, None)
+        if entry is not None and now - entry[0] < self.ttl:
+            return entry[1]
+
+        try:
+            infos = socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM)
+        except socket.error:
+            if entry is None:
+                raise
+            log.warning("Could not resolve host %s, using addresses resolved %d seconds ago" % (host, now - entry[0]))
+            return entry[1]
+
+        addresses = interleave_families([ (family, socktype, proto, sockaddr) for (family, socktype, proto, canonname, sockaddr) in infos ])
+        with self.__lock:
+            self.__entries[key] = (now, addresses)
+        return addresses
+
+    def clear(self):
+        """
+        Forget all resolved addresses
+        """
+        with self.__lock:
+            self.__entries.clear()
+
+
+#
+# Addresses resolved by connections not given their own cache (shared, so
+# connections created when reconnecting benefit from it)
+#
+DEFAULT_ADDRESS_CACHE = AddressCache()
+
+#
+# Connect latencies recorded by connectors not given their own table (shared
+# for the same reason: connections are recreated when reconnecting, exactly
+# when the ranking of addresses matters)
+#
+DEFAULT_LATENCIES = {}
+
+
+def interleave_families(addresses):
+    """
+    Reorder a list of addresses alternating address families, keeping the
+    relative order within each family (the first family is kept first)
+    """
+    families = []
+    by_family = {}
+    for address in addresses:
+        if address[0] not in by_family:
+            families.append(address[0])
+            by_family[address[0]] = []
+        by_family[address[0]].append(address)
+    result = []
+    while len(result) < len(addresses):
+        for family in families:
+            if by_family[family]:
+                result.append(by_family[family].pop(0))
+    return result
+
+
+class Connector(object):
+    """
+    Establishes TCP connections "happy eyeballs" style (see RFC 8305):
+    connection attempts to every address of every broker are started one
+    after another, each one 'stagger' seconds after the previous one (or
+    straight away if the previous one fails), and the first one to complete
+    wins, so a black-holed broker or address family doesn't add a full
+    timeout to every (re)connection.
+
+    The latency of every attempt is recorded, and addresses of a broker
+    which previously connected are tried first (fastest first), before the
+    untried ones and those which failed.
+    """
+    def __init__(self, address_cache = None, timeout = None, stagger = 0.25, socket_options = (), latencies = None):
+        """
+        \param address_cache
+            the AddressCache used to resolve broker names (a cache
+            shared by all connectors by default)
+
+        \param timeout
+            seconds after which a single connection attempt is given
+            up (None waits for the operating system to give up)
+
+        \param stagger
+            seconds to wait for an attempt to complete before starting
+            the next one in parallel
+
+        \param socket_options
+            list of (level, option, value) tuples set on every socket
+            before connecting (e.g. SO_RCVBUF, which must be set before
+            the TCP window scale is negotiated)
+
+        \param latencies
+            dictionary recording the last connect latency in seconds (None
+            if failed) keyed by ((host, port), sockaddr), used to rank
+            addresses (a table shared by all connectors by default)
+        """
+        self.address_cache = address_cache or DEFAULT_ADDRESS_CACHE
+        self.timeout = timeout
+        self.stagger = stagger
+        self.socket_options = list(socket_options)
+        if latencies is None:
+            latencies = DEFAULT_LATENCIES
+        self.latencies = latencies
+
+    def get_candidates(self, host_and_ports):
+        """
+        Return the list of ((host, port), (family, socktype, proto, sockaddr))
+        tuples to try, in order, and a list of resolution errors
+        """
+        candidates = []
+        errors = []
+        for host_and_port in host_and_ports:
+            try:
+                addresses = self.address_cache.resolve(host_and_port[0], host_and_port[1])
+            except socket.error as e:
+                exc = socket_error_message(e)
+                log.warning("Could not resolve host %s: %s" % (host_and_port[0], exc))
+                errors.append("%s:%s (%s)" % (host_and_port[0], host_and_port[1], exc))
+                continue
+            addresses = sorted(addresses, key = lambda address: self.__rank(host_and_port, address[3]))
+            candidates.extend([ (host_and_port, address) for address in addresses ])
+        return (candidates, errors)
+
+    def __rank(self, host_and_port, sockaddr):
+        key = (host_and_port, sockaddr)
+        if key not in self.latencies:
+            return (1, 0)
+        elif self.latencies[key] is None:
+            return (2, 0)
+        else:
+            return (0, self.latencies[key])
+
+    def connect(self, host_and_ports):
+        """
+        Race connections to the given list of (host, port) tuples, returning
+        a (socket, (host, port), latency in seconds) tuple for the first one
+        established (as a blocking socket), or raising socket.error if all of
+        them failed
+        """
+        (candidates, errors) = self.get_candidates(host_and_ports)
+        pending = {}
+        next_start = time.time()
+        try:
+            while candidates or pending:
+                now = time.time()
+
+                #
+                # Start the next attempt when due (or if nothing else is
+                # under way)
+                #
+                if candidates and (now >= next_start or not pending):
+                    (host_and_port, (family, socktype, proto, sockaddr)) = candidates.pop(0)
+                    log.debug("Attempting connection to host %s, port %s (%s)" % (host_and_port[0], host_and_port[1], sockaddr[0]))
+                    sock = socket.socket(family, socktype, proto)
+                    self.__set_options(sock)
+                    sock.setblocking(0)
+                    error = sock.connect_ex(sockaddr)
+                    if error in CONNECT_IN_PROGRESS:
+                        pending[sock] = (host_and_port, sockaddr, now)
+                        next_start = now + self.stagger
+                    else:
+                        sock.close()
+                        self.__failed(host_and_port, sockaddr, errno_message(error), errors)
+                    continue
+
+                #
+                # Wait for an attempt to complete, for the next one to be due
+                # or for the earliest timeout
+                #
+                wakeups = []
+                if candidates:
+                    wakeups.append(next_start)
+                if self.timeout is not None:
+                    wakeups.extend([ started + self.timeout for (host_and_port, sockaddr, started) in pending.values() ])
+                wait = max(0, min(wakeups) - now) if wakeups else None
+                socks = list(pending.keys())
+                (readable, writable, exceptional) = get_select().select([], socks, socks, wait)
+
+                now = time.time()
+                for sock in set(writable + exceptional):
+                    (host_and_port, sockaddr, started) = pending.pop(sock)
+                    error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if error == 0:
+                        self.latencies[(host_and_port, sockaddr)] = now - started
+                        log.debug("Connected to host %s, port %s (%s) in %.1fms" % (host_and_port[0], host_and_port[1], sockaddr[0], (now - started) * 1000))
+                        sock.setblocking(1)
+                        return (sock, host_and_port, now - started)
+                    sock.close()
+                    self.__failed(host_and_port, sockaddr, errno_message(error), errors)
+                    next_start = now
+
+                if self.timeout is not None:
+                    for (sock, (host_and_port, sockaddr, started)) in list(pending.items()):
+                        if now - started >= self.timeout:
+                            del pending[sock]
+                            sock.close()
+                            self.__failed(host_and_port, sockaddr, "timed out", errors)
+        finally:
+            for sock in pending:
+                sock.close()
+
+        raise socket.error("Could not connect to any host: %s" % ", ".join(errors))
+
+    def __set_options(self, sock):
+        for (level, option, value) in self.socket_options:
+            try:
+                sock.setsockopt(level, option, value)
+            except socket.error as e:
+                log.warning("Unable to set socket option %s/%s to %r: %s" % (level, option, value, socket_error_message(e)))
+
+    def __failed(self, host_and_port, sockaddr, message, errors):
+        self.latencies[(host_and_port, sockaddr)] = None
+        log.warning("Could not connect to host %s, port %s (%s): %s" % (host_and_port[0], host_and_port[1], sockaddr[0], message))
+        errors.append("%s:%s (%s: %s)" % (host_and_port[0], host_and_port[1], sockaddr[0], message))
+
+
+def get_select():
+    """
+    Import the select module on first use (only needed when connecting)
+    """
+    import select
+    return select
+
+
+def errno_message(error):
+    try:
+        return os.strerror(error)
+    except ValueError:
+        return "error %s" % error
+
+
+def socket_error_message(exc):
+    if len(exc.args) > 1:
+        return exc.args[1]
+    return str(exc)
+
+
+#
+# Oldest TLS version accepted for each minimum version setting, as the
+# options disabling every older one
+#
+TLS_MIN_VERSION_OPTIONS = {
+    '1.2': ('OP_NO_SSLv2', 'OP_NO_SSLv3', 'OP_NO_TLSv1', 'OP_NO_TLSv1_1'),
+    '1.3': ('OP_NO_SSLv2', 'OP_NO_SSLv3', 'OP_NO_TLSv1', 'OP_NO_TLSv1_1', 'OP_NO_TLSv1_2'),
+}
+
+
+def create_tls_config(min_version = '1.2', ca_certs = None, verify = True, check_hostname = True,
+                      cert_file = None, key_file = None, ciphers = None):
+    """
+    Build a TLSConfig with a new ssl.SSLContext (python 2.7.9+) accepting
+    TLS min_version ('1.2' or '1.3') or newer. CA certificates (ca_certs,
+    or the system ones if not set) are loaded once, when the context is
+    created, and verified unless verify is False
+    """
+    import ssl
+    if not hasattr(ssl, 'SSLContext'):
+        raise Exception("TLS options require python 2.7.9+")
+    if min_version not in TLS_MIN_VERSION_OPTIONS:
+        raise Exception("Unsupported TLS version '%s' (expected one of %s)" % (min_version, ', '.join(sorted(TLS_MIN_VERSION_OPTIONS))))
+    if min_version == '1.3' and not getattr(ssl, 'HAS_TLSv1_3', False):
+        raise Exception("TLS 1.3 is not supported by %s" % ssl.OPENSSL_VERSION)
+
+    context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS', ssl.PROTOCOL_SSLv23))
+    for option in TLS_MIN_VERSION_OPTIONS[min_version]:
+        context.options |= getattr(ssl, option, 0)
+    if verify:
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.check_hostname = check_hostname
+        if ca_certs:
+            context.load_verify_locations(ca_certs)
+        else:
+            context.load_default_certs()
+    else:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    if cert_file:
+        context.load_cert_chain(cert_file, key_file)
+    if ciphers:
+        context.set_ciphers(ciphers)
+    return TLSConfig(context)
+
+
+class TLSConfig(object):
+    """
+    Wraps connected sockets with a shared ssl.SSLContext, so the context
+    (and its CA certificates) is built once for all the connections to the
+    same brokers. TLS sessions are not resumed: python 2 has no API to
+    offer a previous session when reconnecting, so every connection does a
+    full handshake.
+    """
+    def __init__(self, context):
+        """
+        \param context
+            the ssl.SSLContext used to wrap sockets
+        """
+        self.context = context
+        self.handshakes = 0
+        self.__lock = threading.Lock()
+
+    def wrap(self, sock, host_and_port):
+        """
+        Wrap a connected socket and do the TLS handshake, returning a
+        (wrapped socket, handshake seconds) tuple
+        """
+        kwargs = {}
+        if self.context.check_hostname or not is_ip_address(host_and_port[0]):
+            kwargs['server_hostname'] = host_and_port[0]
+
+        start = time.time()
+        try:
+            wrapped = self.context.wrap_socket(sock, **kwargs)
+        except (socket.error, ValueError) as e:
+            sock.close()
+            if isinstance(e, ValueError):
+                #
+                # ssl.CertificateError is a ValueError before python 3.7
+                #
+                raise socket.error("TLS handshake failed: %s" % e)
+            raise
+        handshake_time = time.time() - start
+
+        with self.__lock:
+            self.handshakes += 1
+        return (wrapped, handshake_time)
+
+
+def is_ip_address(host):
+    """
+    Return true if host is an IPv4 or IPv6 address (SNI requires names)
+    """
+    for family in (socket.AF_INET, getattr(socket, 'AF_INET6', None)):
+        if family is None:
+            continue
+        try:
+            socket.inet_pton(family, host)
+            return True
+        except (socket.error, ValueError, AttributeError):
+            pass
+    return False
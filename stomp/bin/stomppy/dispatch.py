@@ -0,0 +1,112 @@
+import threading
+import zlib
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import logging
+log = logging.getLogger('stomp.py')
+
+#
+# Queued in place of a task to stop a worker
+#
+_STOP = object()
+
+
+class DispatchExecutor(object):
+    """
+    Runs listener callbacks for received messages on a pool of worker
+    threads, so a slow listener doesn't stop the receiver thread reading
+    from the socket.
+
+    Every message is assigned to a worker by hashing its subscription (and
+    optionally a message group header, e.g. JMSXGroupID), so messages of the
+    same subscription (or group) are still processed one at a time and in
+    order, while different subscriptions (or groups) are processed in
+    parallel. Every worker has a bounded queue: once it's full, submit
+    blocks, applying backpressure to the receiver thread (and the broker).
+    """
+    def __init__(self, workers, queue_size = 100, group_header = None, create_thread_fc = None):
+        """
+        \param workers
+            number of worker threads
+
+        \param queue_size
+            maximum number of messages waiting for every worker
+
+        \param group_header
+            if set, messages with this header are assigned to workers by
+            subscription and header value, so different groups of the same
+            subscription are processed in parallel
+
+        \param create_thread_fc
+            function used to create (and start) the worker threads
+        """
+        if workers < 1:
+            raise ValueError("At least one dispatch worker is required")
+        self.group_header = group_header
+        self.__queues = [ queue.Queue(queue_size) for i in range(workers) ]
+        self.__create_thread_fc = create_thread_fc
+        self.__started = False
+        self.__lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the worker threads (if not started yet)
+        """
+        with self.__lock:
+            if self.__started:
+                return
+            self.__started = True
+        for worker_queue in self.__queues:
+            callback = lambda worker_queue = worker_queue: self.__worker_loop(worker_queue)
+            if self.__create_thread_fc is not None:
+                self.__create_thread_fc(callback)
+            else:
+                thread = threading.Thread(None, callback)
+                thread.daemon = True
+                thread.start()
+
+    def get_key(self, headers):
+        """
+        Return the ordering key of a message: its subscription (or
+        destination), and its group header value if set
+        """
+        key = headers.get('subscription', None) or headers.get('destination', '')
+        if self.group_header is not None and self.group_header in headers:
+            key = '%s\x00%s' % (key, headers[self.group_header])
+        return key
+
+    def submit(self, headers, task, *args):
+        """
+        Queue a task for the worker processing the message with the given
+        headers, blocking while its queue is full
+        """
+        index = 0
+        if len(self.__queues) > 1:
+            index = (zlib.crc32(self.get_key(headers)) & 0xffffffff) % len(self.__queues)
+        self.__queues[index].put((task, args))
+
+    def shutdown(self):
+        """
+        Stop the workers once they've processed the tasks already queued
+        """
+        with self.__lock:
+            if not self.__started:
+                return
+            self.__started = False
+        for worker_queue in self.__queues:
+            worker_queue.put(_STOP)
+
+    def __worker_loop(self, worker_queue):
+        while True:
+            item = worker_queue.get()
+            if item is _STOP:
+                break
+            (task, args) = item
+            try:
+                task(*args)
+            except Exception:
+                log.exception("An unhandled exception was raised by a dispatched listener callback")
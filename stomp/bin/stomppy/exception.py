@@ -24,4 +24,10 @@ class ConnectFailedException(Exception):
 class ProtocolException(Exception):
     """
     Raised on a protocol violation.
-    """
\ No newline at end of file
+    """
+
+class ReceiptTimeoutException(Exception):
+    """
+    Raised when waiting for a receipt which won't arrive, as it was
+    evicted from the (bounded) receipt manager.
+    """
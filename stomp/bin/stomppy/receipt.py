@@ -0,0 +1,152 @@
+import threading
+import time
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    OrderedDict = None
+
+import exception
+
+
+class Receipt(str):
+    """
+    A receipt id (so it can be used wherever the id string was used before)
+    which is also a future for the RECEIPT frame acknowledging it. Every
+    receipt has its own event, so waiting for one doesn't wake up the
+    threads waiting for others.
+    """
+    def __new__(cls, receipt_id):
+        receipt = str.__new__(cls, receipt_id)
+        receipt.__event = threading.Event()
+        receipt.__error = None
+        return receipt
+
+    def done(self):
+        """
+        Return true if the receipt arrived (or will never arrive)
+        """
+        return self.__event.is_set()
+
+    def wait(self, timeout = None):
+        """
+        Wait for the receipt, for timeout seconds at most (forever if None).
+        Returns true if it arrived, false on timeout, and raises the error
+        preventing it from arriving (e.g. the connection was lost)
+        """
+        self.__event.wait(timeout)
+        if self.__error is not None:
+            raise self.__error
+        return self.__event.is_set()
+
+    def _set(self, error = None):
+        self.__error = error
+        self.__event.set()
+
+
+class ReceiptManager(object):
+    """
+    Tracks the receipts requested on a connection. Futures are registered
+    (see expect) before their frame is sent, so any number of frames can be
+    pipelined and their receipts awaited later, together (see wait_all).
+
+    Memory is bounded: at most max_retained receipts are kept waiting (the
+    oldest ones fail with a ReceiptTimeoutException beyond that), and at
+    most max_retained receipts nobody asked for are remembered (the oldest
+    ones are forgotten), so they can still be waited for if they arrive
+    before expect is called.
+    """
+    def __init__(self, max_retained = 10000):
+        """
+        \param max_retained
+            maximum number of pending receipts, and of unexpected receipts
+            remembered
+        """
+        self.max_retained = max_retained
+        self.__lock = threading.Lock()
+        self.__pending = new_ordered_dict()
+        self.__unexpected = new_ordered_dict()
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__pending) + len(self.__unexpected)
+
+    def expect(self, receipt_id):
+        """
+        Return the future for a receipt (registered before sending the frame
+        requesting it)
+        """
+        evicted = None
+        with self.__lock:
+            receipt = self.__pending.get(receipt_id, None)
+            if receipt is None:
+                receipt = Receipt(receipt_id)
+                if receipt_id in self.__unexpected:
+                    del self.__unexpected[receipt_id]
+                    receipt._set()
+                else:
+                    self.__pending[receipt_id] = receipt
+                    if len(self.__pending) > self.max_retained:
+                        evicted = pop_oldest(self.__pending)
+        if evicted is not None:
+            evicted._set(exception.ReceiptTimeoutException("Receipt %s evicted, more than %d receipts pending" % (evicted, self.max_retained)))
+        return receipt
+
+    def received(self, receipt_id):
+        """
+        Complete the future for a received receipt (or remember it if nobody
+        is waiting for it)
+        """
+        with self.__lock:
+            receipt = self.__pending.pop(receipt_id, None)
+            if receipt is None:
+                self.__unexpected[receipt_id] = None
+                if len(self.__unexpected) > self.max_retained:
+                    pop_oldest(self.__unexpected)
+        if receipt is not None:
+            receipt._set()
+
+    def fail_all(self, error):
+        """
+        Fail all pending receipts with the given error (e.g. once the
+        connection is lost, as they will never arrive)
+        """
+        with self.__lock:
+            pending = list(self.__pending.values())
+            self.__pending.clear()
+            self.__unexpected.clear()
+        for receipt in pending:
+            receipt._set(error)
+
+    def wait_all(self, receipts, timeout = None):
+        """
+        Wait for several receipts, for timeout seconds at most overall.
+        Returns the list of receipts which didn't arrive in time
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        missing = []
+        for receipt in receipts:
+            if deadline is None:
+                receipt.wait()
+            elif not receipt.wait(max(0, deadline - time.time())):
+                missing.append(receipt)
+        return missing
+
+
+def new_ordered_dict():
+    if OrderedDict is not None:
+        return OrderedDict()
+    return {}
+
+
+def pop_oldest(receipts):
+    """
+    Remove and return the oldest entry of an (ordered) receipts map
+    """
+    if OrderedDict is not None and isinstance(receipts, OrderedDict):
+        (receipt_id, receipt) = receipts.popitem(last = False)
+    else:
+        (receipt_id, receipt) = receipts.popitem()
+    return receipt
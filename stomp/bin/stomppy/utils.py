@@ -1,5 +1,4 @@
 import re
-import xml.dom
 
 try:
     import hashlib
@@ -11,57 +10,186 @@ except ImportError:
 #
 HEADER_LINE_RE = re.compile('(?P<key>[^:]+)[:](?P<value>.*)')
 
+#
+# Header escaping (STOMP 1.1+). STOMP 1.1 defines \\, \n and \c only, \r
+# was added by 1.2 (and is an undefined, fatal, escape for 1.1 brokers), so
+# every version has its own tables. A single precompiled pattern is used in
+# each direction, and values without special characters (nearly all of
+# them) are returned untouched
+#
+class _HeaderEscaping(object):
+    def __init__(self, escapes):
+        self.escapes = escapes
+        self.unescapes = dict([ (escaped, char) for (char, escaped) in escapes.items() ])
+        self.escape_re = re.compile('[%s]' % ''.join([ re.escape(char) for char in escapes ]))
+        self.unescape_re = re.compile('|'.join([ re.escape(escaped) for escaped in self.unescapes ]))
+
+    def escape_match(self, match):
+        return self.escapes[match.group(0)]
+
+    def unescape_match(self, match):
+        return self.unescapes[match.group(0)]
+
+HEADER_ESCAPING_1_1 = _HeaderEscaping({ '\\' : '\\\\', '\n' : '\\n', ':' : '\\c' })
+HEADER_ESCAPING_1_2 = _HeaderEscaping({ '\\' : '\\\\', '\r' : '\\r', '\n' : '\\n', ':' : '\\c' })
+
+def get_header_escaping(version):
+    """
+    Return the header escaping tables of a STOMP (1.1+) version
+    """
+    if version >= 1.2:
+        return HEADER_ESCAPING_1_2
+    return HEADER_ESCAPING_1_1
 
-def parse_headers(lines, offset=0):
+def escape_header(value, version = 1.1):
+    """
+    Escape a header key or value for a frame of the given STOMP (1.1+)
+    version
+    """
+    escaping = get_header_escaping(version)
+    if escaping.escape_re.search(value) is None:
+        return value
+    return escaping.escape_re.sub(escaping.escape_match, value)
+
+def unescape_header(value, version = 1.1):
+    """
+    Unescape a header key or value of a frame of the given STOMP (1.1+)
+    version (unknown escape sequences are kept as they are)
+    """
+    if '\\' not in value:
+        return value
+    escaping = get_header_escaping(version)
+    return escaping.unescape_re.sub(escaping.unescape_match, value)
+
+def parse_headers(lines, offset=0, version=1.0):
+    """
+    Parse "key:value" header lines (ignoring a trailing CR) into a map. If
+    a header is repeated, the first value is used. On STOMP 1.1+ (version),
+    keys and values are unescaped (see unescape_header)
+    """
+    unescape = version >= 1.1
     headers = {}
     for header_line in lines[offset:]:
+        if header_line.endswith('\r'):
+            header_line = header_line[:-1]
         header_match = HEADER_LINE_RE.match(header_line)
         if header_match:
             key = header_match.group('key')
+            value = header_match.group('value')
+            if unescape:
+                key = unescape_header(key, version)
+                value = unescape_header(value, version)
             if key not in headers:
-                headers[key] = header_match.group('value')
+                headers[key] = value
     return headers
 
-def parse_frame(frame):
+def find_preamble_end(data, start=0, end=None):
+    """
+    Find the blank line ending the command and headers of a frame, which
+    may use LF or (STOMP 1.2) CRLF line endings. Returns a (preamble end,
+    body start) tuple of offsets, or (-1, -1) if not found
+    """
+    if end is None:
+        end = len(data)
+    lf = data.find('\n\n', start, end)
+    crlf = data.find('\n\r\n', start, lf + 2 if lf >= 0 else end)
+    if crlf >= 0:
+        return (crlf, crlf + 3)
+    elif lf >= 0:
+        return (lf, lf + 2)
+    else:
+        return (-1, -1)
+
+def parse_frame(frame, transform_body=True, version=1.0):
     """
     Parse a STOMP frame into a (frame_type, headers, body) tuple,
     where frame_type is the frame type as a string (e.g. MESSAGE),
     headers is a map containing all header key/value pairs, and
     body is a string containing the frame's payload.
+
+    If transform_body is False, bodies with a 'transformation' header
+    are returned untouched, so the transformation can be deferred (see
+    transform).
+
+    On STOMP 1.1+ connections (version), header keys and values are
+    unescaped, except in CONNECTED frames (sent before the version is
+    negotiated).
     """
     if frame == '\x0a':
         return ('heartbeat', {}, None)
         
-    preamble_end = frame.find('\n\n')
+    (preamble_end, body_start) = find_preamble_end(frame)
     if preamble_end == -1:
-        preamble_end = len(frame)
+        preamble_end = body_start = len(frame)
     preamble = frame[0:preamble_end]
     preamble_lines = preamble.split('\n')
-    body = frame[preamble_end + 2:]
+    body = frame[body_start:]
 
     # Skip any leading newlines
     first_line = 0
-    while first_line < len(preamble_lines) and len(preamble_lines[first_line]) == 0:
+    while first_line < len(preamble_lines) and len(preamble_lines[first_line].rstrip('\r')) == 0:
         first_line += 1
 
     # Extract frame type
-    frame_type = preamble_lines[first_line]
+    frame_type = preamble_lines[first_line].rstrip('\r')
 
     # Put headers into a key/value map
-    headers = parse_headers(preamble_lines, first_line + 1)
+    if frame_type == 'CONNECTED':
+        version = 1.0
+    headers = parse_headers(preamble_lines, first_line + 1, version)
 
-    if 'transformation' in headers:
+    if transform_body and 'transformation' in headers:
         body = transform(body, headers['transformation'])
 
     return (frame_type, headers, body)
     
-def transform(body, trans_type):
+class _ElementCollector(object):
     """
-    Perform body transformation. Currently, the only supported transformation is
-    'jms-map-xml', which converts a map into python dictionary. This can be extended
-    to support other transformation types.
+    Streaming (expat based) parser building a compact python representation
+    of an XML document: elements without child elements become their text,
+    elements with children become a dictionary (repeated children become
+    lists), and attributes are kept as '@name' keys.
+    """
+    def __init__(self):
+        self.stack = [({}, [])]
+
+    def start(self, name, attrs):
+        children = {}
+        for key, value in attrs.items():
+            children['@' + key] = value
+        self.stack.append((children, []))
+
+    def data(self, text):
+        self.stack[-1][1].append(text)
+
+    def end(self, name):
+        children, text = self.stack.pop()
+        if children:
+            value = children
+        else:
+            value = ''.join(text)
+        parent = self.stack[-1][0]
+        if name in parent:
+            if type(parent[name]) is not list:
+                parent[name] = [parent[name]]
+            parent[name].append(value)
+        else:
+            parent[name] = value
 
-    The body has the following format: 
+    def parse(self, body):
+        import xml.parsers.expat
+        parser = xml.parsers.expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = self.start
+        parser.EndElementHandler = self.end
+        parser.CharacterDataHandler = self.data
+        parser.Parse(body, True)
+        return self.stack[0][0]
+
+def transform_jms_map_xml(body):
+    """
+    Convert a 'jms-map-xml' body into a python dictionary. The body has the
+    following format:
     <map>
       <entry>
         <string>name</string>
@@ -74,32 +202,113 @@ def transform(body, trans_type):
     </map>
 
     (see http://docs.codehaus.org/display/STOMP/Stomp+v1.1+Ideas)
-    
+
+    The body is parsed in a single streaming (expat) pass, without building
+    a DOM. Entries are collected at any depth, in document order, and a value
+    is the text preceding its first child element (None if it starts with an
+    element, u'' if it is empty), as with the former minidom transformation.
+
+    \param body the 'jms-map-xml' document
+
+    Raises ValueError if an entry doesn't hold exactly a name and a value.
+    """
+    import xml.parsers.expat
+    pairs = []
+    #
+    # one [pair, owner, slot] frame per open element: pair is the value list
+    # of an 'entry' element, owner[slot] the value an entry child collects
+    # text into (slot is None once its first child element started)
+    #
+    stack = []
+
+    def start(name, attrs):
+        pair = owner = slot = None
+        if stack:
+            parent = stack[-1]
+            if parent[2] is not None:
+                if parent[1][parent[2]] == u'':
+                    parent[1][parent[2]] = None
+                parent[2] = None
+            if parent[0] is not None:
+                owner = parent[0]
+                owner.append(u'')
+                slot = len(owner) - 1
+            if name == 'entry':
+                pair = []
+                pairs.append(pair)
+        stack.append([pair, owner, slot])
+
+    def data(text):
+        frame = stack[-1]
+        if frame[2] is not None:
+            frame[1][frame[2]] += text
+
+    def end(name):
+        pair = stack.pop()[0]
+        if pair is not None and len(pair) != 2:
+            raise ValueError('Invalid jms-map-xml entry: expected a name and a value, got %d elements' % len(pair))
+
+    parser = xml.parsers.expat.ParserCreate()
+    parser.buffer_text = True
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.CharacterDataHandler = data
+    parser.Parse(body, True)
+
+    entries = {}
+    for (name, value) in pairs:
+        entries[name] = value
+    return entries
+
+def transform_jms_object_xml(body):
+    """
+    Convert a 'jms-object-xml' body (an XStream serialized object) into
+    nested python dictionaries (see _ElementCollector).
+    """
+    return _ElementCollector().parse(body)
+
+#
+# Body transformers, by 'transformation' header value
+#
+TRANSFORMERS = {
+    'jms-map-xml': transform_jms_map_xml,
+    'jms-object-xml': transform_jms_object_xml,
+}
+
+def register_transformer(trans_type, transformer):
+    """
+    Register a body transformer for a 'transformation' header value.
+
+    \param trans_type the 'transformation' header value
+
+    \param transformer a function receiving the body and returning the
+    transformed body. Raising an exception leaves the body untouched.
+    """
+    TRANSFORMERS[trans_type] = transformer
+
+def transform(body, trans_type):
+    """
+    Perform body transformation using the transformer registered for
+    trans_type (see TRANSFORMERS and register_transformer). Bodies with
+    unknown transformations, or which can't be transformed, are returned
+    untouched.
+
     \param body the content of a message
-    
+
     \param trans_type the type transformation
     """
-    if trans_type != 'jms-map-xml':
+    transformer = TRANSFORMERS.get(trans_type, None)
+    if transformer is None:
         return body
 
     try:
-        entries = {}
-        doc = xml.dom.minidom.parseString(body)
-        rootElem = doc.documentElement
-        for entryElem in rootElem.getElementsByTagName("entry"):
-            pair = []
-            for node in entryElem.childNodes:
-                if not isinstance(node, xml.dom.minidom.Element): continue
-                pair.append(node.firstChild.nodeValue)
-            assert len(pair) == 2
-            entries[pair[0]] = pair[1]
-        return entries
+        return transformer(body)
     except Exception:
         #
         # unable to parse message. return original
         #
         return body
-    
+
 def merge_headers(header_map_list):
     """
     Helper function for combining multiple header maps into one.
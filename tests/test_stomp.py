@@ -0,0 +1,625 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the modular input script (stomp/bin/stomp.py).
+
+Run with: python -m unittest discover tests
+"""
+
+import os
+import sys
+import json
+import hashlib
+import zlib
+import shutil
+import socket
+import struct
+import threading
+import time
+import tempfile
+import cStringIO
+import subprocess
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SCRIPT = os.path.join(ROOT, 'stomp', 'bin', 'stomp.py')
+sys.path.insert(0, os.path.join(ROOT, 'stomp', 'bin'))
+sys.path.insert(0, os.path.join(ROOT, 'extras', 'tools'))
+
+import stomp
+import broker
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.acks = []
+        self.nacks = []
+
+    def get_ack_headers(self, headers):
+        return {'message-id': headers['message-id']}
+
+    def ack(self, headers):
+        self.acks.append(headers['message-id'])
+
+    def nack(self, headers):
+        self.nacks.append(headers['message-id'])
+
+
+class CountingDecoder(object):
+    '''
+    Stands in for a stomp.BodyDecoder, counting the bodies decoded (without
+    decoding anything).
+    '''
+    def __init__(self):
+        self.calls = 0
+
+    def decode(self, headers, body):
+        self.calls += 1
+        return body
+
+
+class ListenerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.stdout = sys.stdout
+        sys.stdout = cStringIO.StringIO()
+        self.connection = FakeConnection()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def listen(self, headers, body, **kwargs):
+        listener = stomp.SplunkListener(self.connection, True, **kwargs)
+        headers = dict(headers, **{'message-id': 'ID:1', 'destination': '/queue/a'})
+        listener.on_message(headers, body)
+        return sys.stdout.getvalue()
+
+
+class FailingFile(object):
+    '''
+    A spooled body whose read fails after returning some data.
+    '''
+    def __init__(self, data):
+        self.data = data
+
+    def seek(self, offset):
+        pass
+
+    def read(self, size):
+        if self.data is None:
+            raise IOError('Read error')
+        data, self.data = self.data, None
+        return data
+
+
+class SpooledBodyTest(ListenerTestCase):
+    def test_spooled_body_is_streamed(self):
+        spool = tempfile.TemporaryFile()
+        spool.write('a <b>\n' * 50000)
+        output = self.listen({}, spool)
+        self.assertEqual(output, '<event unbroken="1"><data>%s</data><done/></event>\n' % ('a &lt;b&gt;\n' * 50000))
+
+    def test_read_error_leaves_no_truncated_event(self):
+        output = self.listen({}, FailingFile('partial body'))
+        self.assertEqual(output, '')
+        self.assertEqual(self.connection.nacks, ['ID:1'])
+
+
+class BodyDecoderTest(ListenerTestCase):
+    def gzip(self, data):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    def test_unsupported_encoding_is_indexed_as_is(self):
+        output = self.listen({'content-encoding': 'utf-8'}, 'plain body',
+                             body_decoder=stomp.build_body_decoder({}))
+        self.assertIn('<data>plain body</data>', output)
+        self.assertEqual(self.connection.acks, ['ID:1'])
+        self.assertEqual(self.connection.nacks, [])
+
+    def test_gzip_body_is_inflated(self):
+        output = self.listen({'content-encoding': 'gzip'}, self.gzip('inflated body'),
+                             body_decoder=stomp.build_body_decoder({}))
+        self.assertIn('<data>inflated body</data>', output)
+        self.assertEqual(self.connection.acks, ['ID:1'])
+
+    def test_oversized_body_is_dropped_and_acked(self):
+        decoder = stomp.build_body_decoder({'max_inflated_size': '1000'})
+        output = self.listen({'content-encoding': 'gzip'}, self.gzip('x' * 100000), body_decoder=decoder)
+        self.assertEqual(output, '')
+        self.assertEqual(self.connection.acks, ['ID:1'])
+        self.assertEqual(self.connection.nacks, [])
+
+    def test_corrupt_body_is_dropped_and_acked(self):
+        output = self.listen({'content-encoding': 'gzip'}, self.gzip('x' * 1000)[:10] + '\xff\xff\xff garbage',
+                             body_decoder=stomp.build_body_decoder({}))
+        self.assertEqual(output, '')
+        self.assertEqual(self.connection.acks, ['ID:1'])
+        self.assertEqual(self.connection.nacks, [])
+
+
+class StartupTest(unittest.TestCase):
+    # Slow to import, or only needed by optional features: splunkd runs
+    # 'stomp.py --scheme' and '--validate-arguments' often.
+    DEFERRED_MODULES = (
+        'ssl', 'tempfile', 'uuid', 'decimal', 'fractions', 'platform', 'xml.dom', 'xml.sax', 'pyexpat',
+        'json', 'zlib', 'calendar', 'datetime', 'base64', 'Queue', 'select', 'stomppy.dispatch')
+
+    def test_scheme_skips_deferred_imports(self):
+        code = 'import sys; import stomp; stomp.do_scheme(); sys.stderr.write(" ".join(sys.modules))'
+        process = subprocess.Popen(
+            [sys.executable, '-c', code], cwd=os.path.dirname(SCRIPT),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, modules = process.communicate()
+        self.assertEqual(process.returncode, 0, modules)
+        self.assertTrue(output.startswith('<scheme>'), output)
+        imported = [module for module in self.DEFERRED_MODULES if module in modules.split()]
+        self.assertEqual(imported, [])
+
+
+class BodyEscaperTest(unittest.TestCase):
+    BODY = 'a <b> & c \r\nd\t\r\n\re\n  \n'
+
+    def write(self, escaper, body):
+        out = cStringIO.StringIO()
+        escaper.write(out, body)
+        return out.getvalue()
+
+    def test_normalization(self):
+        for options, expected in (
+                ({}, 'a &lt;b&gt; &amp; c \r\nd\t\r\n\re\n  \n'),
+                ({'collapse_crlf': True}, 'a &lt;b&gt; &amp; c \nd\t\n\re\n  \n'),
+                ({'strip_newlines': True}, 'a &lt;b&gt; &amp; c  d\t  e    '),
+                ({'strip_newlines': True, 'collapse_crlf': True}, 'a &lt;b&gt; &amp; c  d\t  e    '),
+                ({'strip_trailing_whitespace': True}, 'a &lt;b&gt; &amp; c\r\nd\r\n\re'),
+                ({'strip_trailing_whitespace': True, 'collapse_crlf': True}, 'a &lt;b&gt; &amp; c\nd\n\re'),
+                ({'strip_trailing_whitespace': True, 'strip_newlines': True}, 'a &lt;b&gt; &amp; c d  e')):
+            self.assertEqual(self.write(stomp.BodyEscaper(**options), self.BODY), expected, options)
+
+    def test_chunk_boundaries(self):
+        options = [{}, {'collapse_crlf': True}, {'strip_newlines': True}, {'strip_trailing_whitespace': True},
+                   {'strip_trailing_whitespace': True, 'collapse_crlf': True}]
+        body = self.BODY * 5
+        for option in options:
+            escaper = stomp.BodyEscaper(**option)
+            expected = self.write(escaper, body)
+            for size in (1, 2, 3, 5):
+                chunks = iter([body[i:i + size] for i in range(0, len(body), size)])
+                self.assertEqual(self.write(escaper, chunks), expected, (option, size))
+                escaper.CHUNK_SIZE = size
+                self.assertEqual(self.write(escaper, body), expected, (option, size))
+                del escaper.CHUNK_SIZE
+
+
+class RecordSplitterTest(ListenerTestCase):
+    BODIES = {
+        'delimiter': '\r\n'.join(['{"n": %d, "pad": "%s"}' % (i, 'x' * (i % 7)) for i in range(300)]) + '\r\n',
+        'json_array': ' [ %s ] ' % ' , '.join(
+            ['{"n": %d, "pad": "%s"}' % (i, 'x' * (i % 7)) for i in range(300)] + ['12345', '"s"']),
+        'length_prefixed': ''.join([
+            struct.pack('!I', len(record)) + record for record in ['record %d' % i for i in range(300)] + ['']]),
+    }
+
+    def chunks(self, body, size):
+        return iter([body[i:i + size] for i in range(0, len(body), size)])
+
+    def test_chunked_split_matches_split(self):
+        for mode, body in self.BODIES.items():
+            splitter = stomp.RecordSplitter(mode, '\r\n')
+            expected = splitter.split(body)
+            for size in (1, 2, 3, 7, 64, len(body)):
+                self.assertEqual(list(splitter.iter_split(self.chunks(body, size))), expected, (mode, size))
+
+    def test_chunked_split_errors(self):
+        for mode, body in (('json_array', '[1, 2 3]'), ('json_array', '{}'), ('json_array', '[1, {"a"'),
+                           ('length_prefixed', struct.pack('!I', 10) + 'short')):
+            splitter = stomp.RecordSplitter(mode)
+            self.assertRaises(Exception, splitter.split, body)
+            self.assertRaises(Exception, list, splitter.iter_split(self.chunks(body, 2)))
+
+    def spool(self, body):
+        spool = tempfile.TemporaryFile()
+        spool.write(body)
+        spool.seek(0)
+        return spool
+
+    def test_spooled_body_is_split_in_batches(self):
+        stomp.SplunkListener.RECORDS_BATCH_SIZE, batch_size = 100, stomp.SplunkListener.RECORDS_BATCH_SIZE
+        try:
+            output = self.listen({}, self.spool(self.BODIES['delimiter']),
+                                 record_splitter=stomp.RecordSplitter('delimiter', '\r\n'))
+        finally:
+            stomp.SplunkListener.RECORDS_BATCH_SIZE = batch_size
+        self.assertEqual(output.count('<event '), 300)
+        self.assertIn('<data>{"n": 299, "pad": "xxxxx"}</data>', output)
+        self.assertEqual(self.connection.acks, ['ID:1'])
+
+    def test_spooled_body_is_read_once(self):
+        decoder = CountingDecoder()
+        output = self.listen({}, self.spool(self.BODIES['delimiter']), body_decoder=decoder,
+                             record_splitter=stomp.RecordSplitter('delimiter', '\r\n'))
+        self.assertEqual(output.count('<event '), 300)
+        self.assertEqual(decoder.calls, 1)
+
+    def test_split_failure_after_a_batch_drops_the_rest(self):
+        stomp.SplunkListener.RECORDS_BATCH_SIZE, batch_size = 100, stomp.SplunkListener.RECORDS_BATCH_SIZE
+        try:
+            body = '[%s, {"n": oops}]' % ', '.join(['{"n": %d}' % i for i in range(50)])
+            output = self.listen({}, self.spool(body), record_splitter=stomp.RecordSplitter('json_array'))
+        finally:
+            stomp.SplunkListener.RECORDS_BATCH_SIZE = batch_size
+        self.assertIn('<data>{"n": 0}</data>', output)
+        self.assertNotIn('oops', output)
+        self.assertEqual(self.connection.acks, ['ID:1'])
+        self.assertEqual(self.connection.nacks, [])
+
+    def test_unsplittable_spooled_body_is_a_single_event(self):
+        output = self.listen({}, self.spool('[1, 2 3]'), record_splitter=stomp.RecordSplitter('json_array'))
+        self.assertEqual(output.count('<event '), 1)
+        self.assertIn('<data>[1, 2 3]</data>', output)
+        self.assertEqual(self.connection.acks, ['ID:1'])
+
+
+class HeaderFormatterTest(ListenerTestCase):
+    def test_json_envelope_with_latin1_body(self):
+        formatter = stomp.HeaderFormatter(['destination', 'origin'], 'json')
+        data, _ = formatter.format({'destination': '/queue/a', 'origin': 'caf\xe9'}, 'caf\xe9')
+        envelope = json.loads(data)
+        self.assertEqual(envelope['body'], 'Y2Fm6Q==')
+        self.assertEqual(envelope['encoding'], 'base64')
+        self.assertEqual(envelope['headers'], {'destination': '/queue/a', 'origin': u'caf\ufffd'})
+
+    def test_json_envelope_with_utf8_body(self):
+        formatter = stomp.HeaderFormatter(['destination'], 'json')
+        data, _ = formatter.format({'destination': '/queue/a'}, 'caf\xc3\xa9')
+        self.assertEqual(json.loads(data), {'headers': {'destination': '/queue/a'}, 'body': u'caf\xe9'})
+
+    def test_binary_body_is_indexed_and_acked(self):
+        output = self.listen({}, '\x00\xff\xfe', header_formatter=stomp.HeaderFormatter(['destination'], 'json'))
+        self.assertIn('"encoding":"base64"', output)
+        self.assertEqual(self.connection.acks, ['ID:1'])
+        self.assertEqual(self.connection.nacks, [])
+
+
+class TimeExtractorTest(unittest.TestCase):
+    def test_valid_timestamps(self):
+        extractor = stomp.TimeExtractor('timestamp')
+        self.assertEqual(extractor.extract({'timestamp': '1381234567890'}, '', 0), '1381234567.890')
+        self.assertEqual(extractor.extract({'timestamp': '2013-10-08T12:16:07Z'}, '', 0), '1381234567.000')
+
+    def test_unparseable_timestamps_fall_back(self):
+        for value in ('caf\xe9', 'nan', 'inf', '-inf', '2013-13-08T12:16:07Z', 'garbage'):
+            self.assertEqual(stomp.TimeExtractor('timestamp').extract({'timestamp': value}, '', 0), None)
+            self.assertEqual(
+                stomp.TimeExtractor('timestamp', fallback='arrival').extract({'timestamp': value}, '', 12.5),
+                '12.500')
+
+    def test_unparseable_json_field_is_indexed_and_acked(self):
+        connection = FakeConnection()
+        listener = stomp.SplunkListener(connection, True, time_extractor=stomp.TimeExtractor(json_field='ts'))
+        stdout = sys.stdout
+        sys.stdout = cStringIO.StringIO()
+        try:
+            listener.on_message({'message-id': 'ID:1'}, '{"ts": "\xff\xfe"}')
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertNotIn('<time>', output)
+        self.assertEqual(connection.acks, ['ID:1'])
+
+
+class AckModeTest(unittest.TestCase):
+    def test_ack_modes(self):
+        connection = FakeConnection()
+        for version, explicit, workers, mode in (
+                (1.2, False, 4, 'auto'), (1.2, True, 0, 'client'), (1.2, True, 1, 'client'),
+                (1.1, True, 4, 'client-individual'), (1.0, True, 4, 'client')):
+            connection.version = version
+            self.assertEqual(stomp.get_ack_mode(connection, explicit, workers), mode, (version, explicit, workers))
+
+
+class RouterTest(unittest.TestCase):
+    def test_rules_are_tried_in_order(self):
+        router = stomp.Router('type', 'first => index=a; ord* => index=b; order => index=c; other => index=d')
+        self.assertEqual(router.route({'type': 'first'}), {'index': 'a'})
+        self.assertEqual(router.route({'type': 'order'}), {'index': 'b'})
+        self.assertEqual(router.route({'type': 'other'}), {'index': 'd'})
+        self.assertEqual(router.route({'type': 'unknown'}), None)
+
+    def test_many_rules(self):
+        rules = '; '.join(['type%d-* => sourcetype=s%d; exact%d => sourcetype=e%d' % (i, i, i, i) for i in range(150)])
+        router = stomp.Router('type', 'type12-* => sourcetype=first; ' + rules)
+        self.assertEqual(router.route({'type': 'type0-x'}), {'sourcetype': 's0'})
+        self.assertEqual(router.route({'type': 'type149-x'}), {'sourcetype': 's149'})
+        self.assertEqual(router.route({'type': 'exact120'}), {'sourcetype': 'e120'})
+        self.assertEqual(router.route({'type': 'type12-x'}), {'sourcetype': 'first'})
+
+
+class MessageFilterTest(unittest.TestCase):
+    MESSAGE_IDS = ['ID:host-%d' % i for i in range(1000)]
+
+    def test_sampling(self):
+        self.assertRaises(Exception, stomp.MessageFilter, sample_rate=0)
+        self.assertRaises(Exception, stomp.build_message_filter, {'sample_rate': '0.5'})
+        self.assertEqual(stomp.build_message_filter({'sample_rate': '1'}), None)
+        every = stomp.MessageFilter(sample_rate=1)
+        self.assertTrue(all([every.accept({'message-id': message_id}) for message_id in self.MESSAGE_IDS]))
+
+        quarter = stomp.MessageFilter(sample_rate=4)
+        accepted = [message_id for message_id in self.MESSAGE_IDS if quarter.accept({'message-id': message_id})]
+        self.assertTrue(200 < len(accepted) < 300, len(accepted))
+        # Deterministic: the same messages (e.g. redelivered ones) are always sampled.
+        self.assertEqual(
+            accepted, [message_id for message_id in self.MESSAGE_IDS
+                       if stomp.MessageFilter(sample_rate=4).accept({'message-id': message_id})])
+        self.assertEqual(
+            accepted, [message_id for message_id in self.MESSAGE_IDS
+                       if (zlib.crc32(message_id) & 0xffffffff) % 4 == 0])
+
+    def test_header_predicates(self):
+        message_filter = stomp.build_message_filter({'filter': 'type=order*, region!=eu, priority, !test'})
+        self.assertTrue(message_filter.accept({'type': 'order-created', 'region': 'us', 'priority': '4'}))
+        self.assertTrue(message_filter.accept({'type': 'order', 'priority': '4'}))
+        self.assertFalse(message_filter.accept({'type': 'audit', 'priority': '4'}))
+        self.assertFalse(message_filter.accept({'type': 'order', 'region': 'eu', 'priority': '4'}))
+        self.assertFalse(message_filter.accept({'type': 'order'}))
+        self.assertFalse(message_filter.accept({'type': 'order', 'priority': '4', 'test': 'true'}))
+        self.assertRaises(Exception, stomp.MessageFilter, ['!name=value'])
+
+    def test_filtered_messages_are_acked(self):
+        connection = FakeConnection()
+        listener = stomp.SplunkListener(connection, True, message_filter=stomp.MessageFilter(['type=order']))
+        stdout = sys.stdout
+        sys.stdout = cStringIO.StringIO()
+        try:
+            listener.on_message({'message-id': 'ID:1', 'type': 'audit'}, 'dropped')
+            listener.on_message({'message-id': 'ID:2', 'type': 'order'}, 'indexed')
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertNotIn('dropped', output)
+        self.assertIn('<data>indexed</data>', output)
+        self.assertEqual(connection.acks, ['ID:1', 'ID:2'])
+
+
+class SelectorTest(unittest.TestCase):
+    def test_selector_is_sent_with_subscribe(self):
+        server = broker.Broker().start()
+        process = None
+        try:
+            config = (
+                '<input><configuration><stanza name="stomp://127.0.0.1:%d/queue/a">'
+                '<param name="selector">priority &gt; 4</param>'
+                '<param name="destinations">/queue/b</param>'
+                '</stanza></configuration></input>' % server.address[1])
+            process = subprocess.Popen(
+                [sys.executable, SCRIPT], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            process.stdin.write(config)
+            process.stdin.close()
+            subscriptions = {}
+            deadline = time.time() + 10
+            while len(subscriptions) < 2 and time.time() < deadline:
+                time.sleep(0.05)
+                for client in list(server._clients):
+                    subscriptions.update(client.subscriptions)
+            self.assertEqual(
+                sorted([(headers['destination'], headers.get('selector', None))
+                        for headers in subscriptions.values()]),
+                [('/queue/a', 'priority > 4'), ('/queue/b', 'priority > 4')])
+        finally:
+            if process is not None:
+                process.kill()
+                process.wait()
+            server.stop()
+
+
+class DestinationsTest(unittest.TestCase):
+    def test_stanza_name_is_a_single_destination(self):
+        self.assertEqual(stomp.parse_name('stomp://host:61613/queue/a,queue/b'), ('host', 61613, '/queue/a,queue/b'))
+        self.assertEqual(
+            stomp.parse_destinations({}, '/queue/a,queue/b'), [('splunk-stomp', '/queue/a,queue/b')])
+
+    def test_additional_destinations(self):
+        config = {'subscription_id': 'id', 'destinations': '/topic/app.>, /queue/c'}
+        self.assertEqual(
+            stomp.parse_destinations(config, '/queue/a'),
+            [('id', '/queue/a'), ('id-2', '/topic/app.>'), ('id-3', '/queue/c')])
+
+    def test_wrong_destinations(self):
+        self.assertRaises(Exception, stomp.parse_destinations, {'destinations': 'queue/b'}, '/queue/a')
+        self.assertRaises(Exception, stomp.parse_destinations, {'destinations': '/queue/a'}, '/queue/a')
+
+    def test_routing_by_destination(self):
+        router = stomp.build_router({'routing_rules': '/queue/a => sourcetype=a; /topic/app.* => sourcetype=app'})
+        self.assertEqual(router.route({'destination': '/topic/app.x', 'subscription': 'id-2'}), {'sourcetype': 'app'})
+        self.assertEqual(stomp.build_router({}), None)
+        self.assertRaises(Exception, stomp.build_router, {'routing_header': 'type'})
+
+
+class DeduplicatorTest(unittest.TestCase):
+    def setUp(self):
+        self.checkpoint_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.checkpoint_dir)
+
+    def test_validation_and_run_share_the_checkpoint(self):
+        validating = stomp.parse_dedup_options(
+            {'stanza': 'localhost:61613/queue/a', 'dedup': '1', 'checkpoint_dir': self.checkpoint_dir})
+        running = stomp.build_deduplicator(
+            {'name': 'stomp://localhost:61613/queue/a', 'dedup': '1', 'checkpoint_dir': self.checkpoint_dir})
+        self.assertEqual(validating, (stomp.DEFAULT_DEDUP_CAPACITY, running._checkpoint_path))
+        self.assertRaises(Exception, stomp.parse_dedup_options, {'dedup': '1', 'dedup_capacity': '0'})
+        self.assertRaises(Exception, stomp.parse_dedup_options, {'dedup': '1', 'dedup_capacity': 'many'})
+        self.assertEqual(stomp.parse_dedup_options({'dedup': '0', 'dedup_capacity': 'many'}), None)
+
+    def test_oldest_ids_are_forgotten(self):
+        deduplicator = stomp.Deduplicator(3)
+        for message_id in ['ID:1', 'ID:2', 'ID:3', 'ID:2', 'ID:4']:
+            deduplicator.remember({'message-id': message_id})
+        self.assertEqual(
+            [deduplicator.is_duplicate({'message-id': message_id}) for message_id in ['ID:1', 'ID:2', 'ID:3', 'ID:4']],
+            [False, True, True, True])
+        self.assertFalse(deduplicator.is_duplicate({'message-id': 'ID:4', 'redelivered': 'false'}))
+        self.assertEqual(deduplicator.stats(), (4, 3, 3, 3 * 8 + 8 * 4))
+
+    def test_matches_a_reference_window(self):
+        # Few ids in a small table: many collisions and backward shifts.
+        random = __import__('random').Random(42)
+        deduplicator = stomp.Deduplicator(20)
+        window = []
+        for _ in xrange(20000):
+            message_id = 'ID:%d' % random.randint(0, 60)
+            self.assertEqual(
+                deduplicator.is_duplicate({'message-id': message_id}), message_id in window, message_id)
+            deduplicator.remember({'message-id': message_id})
+            if message_id not in window:
+                window = (window + [message_id])[-20:]
+        self.assertEqual(len([slot for slot in deduplicator._table if slot != -1]), 20)
+
+    def test_checkpoint_format(self):
+        path = os.path.join(self.checkpoint_dir, 'dedup')
+        deduplicator = stomp.Deduplicator(3, path)
+        for message_id in ['ID:1', 'ID:2', 'ID:3', 'ID:4']:
+            deduplicator.remember({'message-id': message_id})
+        deduplicator.save()
+        # 64 bit big endian fingerprints, oldest first.
+        with open(path, 'rb') as input:
+            self.assertEqual(input.read(), stomp.Deduplicator.MAGIC + ''.join(
+                [hashlib.md5(message_id).digest()[:8] for message_id in ['ID:2', 'ID:3', 'ID:4']]))
+
+        restored = stomp.Deduplicator(3, path)
+        self.assertEqual(restored.stats()[2], 3)
+        self.assertTrue(restored.is_duplicate({'message-id': 'ID:2'}))
+        smaller = stomp.Deduplicator(2, path)
+        self.assertFalse(smaller.is_duplicate({'message-id': 'ID:2'}))
+        self.assertTrue(smaller.is_duplicate({'message-id': 'ID:3'}))
+        self.assertTrue(smaller.is_duplicate({'message-id': 'ID:4'}))
+        # The next one forgotten is the oldest one of the checkpoint.
+        smaller.remember({'message-id': 'ID:5'})
+        self.assertFalse(smaller.is_duplicate({'message-id': 'ID:3'}))
+        self.assertTrue(smaller.is_duplicate({'message-id': 'ID:4'}))
+
+    def test_save_failures_are_not_raised(self):
+        deduplicator = stomp.Deduplicator(10, os.path.join(self.checkpoint_dir, 'missing', 'dedup'))
+        deduplicator.remember({'message-id': 'ID:1'})
+        deduplicator.save()
+
+    def test_validate_arguments_with_dedup(self):
+        server = broker.Broker().start()
+        try:
+            # The checkpoint is not loaded (nor saved) by validation.
+            checkpoint_path = stomp.parse_dedup_options({
+                'stanza': 'localhost:%d/queue/a' % server.address[1], 'dedup': '1',
+                'checkpoint_dir': self.checkpoint_dir})[1]
+            with open(checkpoint_path, 'wb') as output:
+                output.write('corrupted')
+            validation = (
+                '<items><checkpoint_dir>%s</checkpoint_dir><item name="localhost:%d/queue/a">'
+                '<param name="dedup">1</param></item></items>' % (self.checkpoint_dir, server.address[1]))
+            process = subprocess.Popen(
+                [sys.executable, SCRIPT, '--validate-arguments'],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            output, errors = process.communicate(validation)
+            self.assertEqual(process.returncode, 0, output)
+            self.assertEqual(output, '')
+            self.assertNotIn('checkpoint', errors)
+            with open(checkpoint_path, 'rb') as input:
+                self.assertEqual(input.read(), 'corrupted')
+        finally:
+            server.stop()
+
+
+class ProbeServer(object):
+    '''
+    A TCP server recording the CONNECT frames it receives, answering them
+    with CONNECTED, or never answering at all when silent.
+    '''
+    def __init__(self, silent=False):
+        self.silent = silent
+        self.frames = []
+        self.sockets = []
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.address = self.server.getsockname()
+        thread = threading.Thread(target=self.accept_loop)
+        thread.daemon = True
+        thread.start()
+
+    def accept_loop(self):
+        while True:
+            try:
+                sock = self.server.accept()[0]
+            except socket.error:
+                return
+            self.sockets.append(sock)
+            data = ''
+            while '\x00' not in data:
+                data += sock.recv(4096)
+            self.frames.append(data[:data.index('\x00')])
+            if not self.silent:
+                sock.sendall('CONNECTED\nversion:1.2\n\n\x00')
+
+    def stop(self):
+        # Shut down first, to wake the accept loop up (closing the socket
+        # alone doesn't).
+        try:
+            self.server.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.server.close()
+        for sock in self.sockets:
+            sock.close()
+
+
+class BrokerProbeTest(unittest.TestCase):
+    def setUp(self):
+        self.checkpoint_dir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.checkpoint_dir, 'validation-cache.json')
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.checkpoint_dir)
+
+    def server(self, silent=False):
+        server = ProbeServer(silent)
+        self.servers.append(server)
+        return server
+
+    def test_connect_offers_the_negotiated_versions(self):
+        server = self.server()
+        stomp.BrokerProbe(5, 'user', 'secret').check([server.address])
+        stomp.BrokerProbe(5, version=1.1).check([server.address])
+        self.assertIn('accept-version:1.0,1.1,1.2', server.frames[0].split('\n'))
+        self.assertIn('passcode:secret', server.frames[0].split('\n'))
+        self.assertIn('accept-version:1.0,1.1', server.frames[1].split('\n'))
+
+    def test_silent_brokers_are_probed_in_parallel_until_the_deadline(self):
+        brokers = [self.server(silent=True).address for i in range(3)]
+        probe = stomp.BrokerProbe(0.5, cache_path=self.cache_path)
+        start = time.time()
+        self.assertRaises(Exception, probe.check, brokers)
+        elapsed = time.time() - start
+        self.assertTrue(0.5 <= elapsed < 1.0, elapsed)
+        # Failures are not cached.
+        self.assertFalse(os.path.exists(self.cache_path))
+
+    def test_successful_checks_are_cached_without_the_password(self):
+        server = self.server()
+        stomp.BrokerProbe(5, 'user', 'secret', self.cache_path).check([server.address])
+        with open(self.cache_path) as input:
+            cache = input.read()
+        for digest in (hashlib.md5, hashlib.sha1, hashlib.sha256):
+            self.assertNotIn(digest('secret').hexdigest(), cache)
+        server.stop()
+        # Cached as reachable, so the (now stopped) broker isn't probed again.
+        stomp.BrokerProbe(5, 'user', 'secret', self.cache_path).check([server.address])
+        self.assertEqual(len(server.frames), 1)
+        self.assertRaises(
+            Exception, stomp.BrokerProbe(5, 'other', 'secret', self.cache_path).check, [server.address])
+
+
+if __name__ == '__main__':
+    unittest.main()
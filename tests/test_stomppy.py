@@ -0,0 +1,500 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the embedded STOMP client (stomp/bin/stomppy), against the
+in-memory broker stand-in (extras/tools/broker.py).
+
+Run with: python -m unittest discover tests
+"""
+
+import os
+import sys
+import socket
+import threading
+import time
+import unittest
+import xml.dom.minidom
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'stomp', 'bin'))
+sys.path.insert(0, os.path.join(ROOT, 'extras', 'tools'))
+
+import stomppy
+import broker
+from stomppy import connector, dispatch, exception, receipt, utils
+
+
+class CollectingListener(object):
+    def __init__(self, expected):
+        self.messages = []
+        self.expected = expected
+        self.done = threading.Event()
+
+    def on_message(self, headers, body):
+        self.messages.append((headers, body))
+        if len(self.messages) >= self.expected:
+            self.done.set()
+
+
+class BrokerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.broker = broker.Broker().start()
+        self.connections = []
+
+    def tearDown(self):
+        for connection in self.connections:
+            try:
+                connection.disconnect()
+            except Exception:
+                pass
+        self.broker.stop()
+
+    def connect(self, listener=None, **kwargs):
+        connection = stomppy.Connection([self.broker.address], **kwargs)
+        if listener is not None:
+            connection.set_listener('', listener)
+        connection.start()
+        connection.connect(wait=True)
+        self.connections.append(connection)
+        return connection
+
+
+class FakeSocket(object):
+    '''
+    Returns the given chunks of data from recv, then '' (connection closed).
+    '''
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def recv(self, size):
+        return self.chunks.pop(0) if self.chunks else ''
+
+
+class ReadTest(unittest.TestCase):
+    BINARY = 'binary\x00body\n\n\x00'
+    FRAMES = [
+        'MESSAGE\ndestination:/queue/a\ncontent-length:%d\n\n%s' % (len(BINARY), BINARY),
+        'MESSAGE\ndestination:/queue/a\n\nplain body',
+        'RECEIPT\nreceipt-id:1\n\n',
+        'MESSAGE\r\ncontent-length:3\r\n\r\n\x00\x00\x00',
+    ]
+    LARGE_BODY = ''.join([chr(i % 256) for i in range(5000)])
+    LARGE_FRAME = 'MESSAGE\ncontent-length:%d\n\n%s' % (len(LARGE_BODY), LARGE_BODY)
+
+    def read(self, chunks, **kwargs):
+        connection = stomppy.Connection(**kwargs)
+        connection._Connection__socket = FakeSocket(chunks)
+        connection._Connection__running = True
+        frames = []
+        try:
+            while True:
+                frames.extend(connection._Connection__read())
+        except exception.ConnectionClosedException:
+            pass
+        return [frame if isinstance(frame, str) else (frame[0], frame[1].read()) for frame in frames]
+
+    def chunks(self, data, size):
+        return [data[i:i + size] for i in range(0, len(data), size)]
+
+    def test_frames_split_across_reads(self):
+        data = '\n'.join([frame + '\x00' for frame in self.FRAMES])
+        for size in (1, 2, 3, 7, 16, len(data)):
+            self.assertEqual(self.read(self.chunks(data, size)), self.FRAMES, size)
+
+    def test_several_frames_per_read(self):
+        data = ''.join([frame + '\x00\n' for frame in self.FRAMES])
+        self.assertEqual(self.read([data, data]), self.FRAMES * 2)
+
+    def test_large_frames_are_spooled_intact(self):
+        data = self.FRAMES[0] + '\x00' + self.LARGE_FRAME + '\x00\n' + self.FRAMES[1] + '\x00'
+        expected = [self.FRAMES[0], ('MESSAGE\ncontent-length:%d' % len(self.LARGE_BODY), self.LARGE_BODY),
+                    self.FRAMES[1]]
+        for size in (1, 7, 1000, 4096, len(data)):
+            self.assertEqual(self.read(self.chunks(data, size), large_body_threshold=1000), expected, size)
+        self.assertEqual(
+            self.read([data], large_body_threshold=None),
+            [self.FRAMES[0], self.LARGE_FRAME, self.FRAMES[1]])
+
+
+class HeaderEscapingTest(unittest.TestCase):
+    def test_carriage_return_is_only_escaped_on_1_2(self):
+        self.assertEqual(utils.escape_header('a:b\nc\\d\re', 1.1), 'a\\cb\\nc\\\\d\re')
+        self.assertEqual(utils.escape_header('a:b\nc\\d\re', 1.2), 'a\\cb\\nc\\\\d\\re')
+
+    def test_carriage_return_is_only_unescaped_on_1_2(self):
+        self.assertEqual(utils.unescape_header('a\\cb\\r', 1.1), 'a:b\\r')
+        self.assertEqual(utils.unescape_header('a\\cb\\r', 1.2), 'a:b\r')
+
+    def test_frames_are_unescaped_by_version(self):
+        self.assertEqual(utils.parse_frame('MESSAGE\nk:a\\cb\n\n', True, 1.1)[1], {'k': 'a:b'})
+        self.assertEqual(utils.parse_frame('MESSAGE\nk:a\\cb\n\n', True, 1.0)[1], {'k': 'a\\cb'})
+        self.assertEqual(utils.parse_frame('CONNECTED\nk:a\\cb\n\n', True, 1.2)[1], {'k': 'a\\cb'})
+
+
+def minidom_map_xml(body):
+    # The jms-map-xml transformation stomp.py shipped before it was streamed.
+    entries = {}
+    doc = xml.dom.minidom.parseString(body)
+    for entry in doc.documentElement.getElementsByTagName('entry'):
+        pair = []
+        for node in entry.childNodes:
+            if isinstance(node, xml.dom.minidom.Element):
+                pair.append(node.firstChild.nodeValue)
+        assert len(pair) == 2
+        entries[pair[0]] = pair[1]
+    return entries
+
+
+class TransformTest(unittest.TestCase):
+    MAPS = [
+        '<map>\n  <entry>\n    <string>name</string>\n    <string>Dejan</string>\n  </entry>\n</map>',
+        '<map><entry><string>count</string><int>5</int></entry>'
+        '<entry><string>ratio</string><double>0.5</double></entry>'
+        '<entry><string>ok</string><boolean>true</boolean></entry></map>',
+        '<map><entry><string>a&amp;b</string><string>&lt;&#233;&gt;</string></entry></map>',
+        '<map><entry><string>outer</string><map><entry><string>a</string><string>b</string></entry></map></entry>'
+        '<entry><string>spaced</string>\n<map>\n<entry><string>c</string><string>d</string></entry></map></entry></map>',
+        '<map><entry><string>key</string><string>first</string></entry>'
+        '<entry><string>key</string><string>last</string></entry></map>',
+        '<map></map>',
+    ]
+
+    def test_map_xml_matches_minidom(self):
+        for body in self.MAPS:
+            self.assertEqual(utils.transform_jms_map_xml(body), minidom_map_xml(body), body)
+
+    def test_empty_map_xml_values(self):
+        # minidom failed on empty values, leaving the whole body untouched.
+        body = '<map><entry><string>name</string><string></string></entry><entry><string>x</string><string/></entry></map>'
+        self.assertEqual(utils.transform(body, 'jms-map-xml'), {u'name': u'', u'x': u''})
+
+    def test_invalid_map_xml_entries(self):
+        body = '<map><entry><string>a</string><string>b</string><string>c</string></entry></map>'
+        self.assertRaises(ValueError, utils.transform_jms_map_xml, body)
+        self.assertRaises(ValueError, utils.transform_jms_map_xml, '<map><entry><string>a</string></entry></map>')
+        self.assertEqual(utils.transform(body, 'jms-map-xml'), body)
+        self.assertEqual(utils.transform('<map>', 'jms-map-xml'), '<map>')
+
+    def test_register_transformer(self):
+        self.assertEqual(utils.transform('a,b', 'csv'), 'a,b')
+        utils.register_transformer('csv', lambda body: body.split(','))
+        utils.register_transformer('broken', lambda body: 1 / 0)
+        try:
+            self.assertEqual(utils.transform('a,b', 'csv'), ['a', 'b'])
+            self.assertEqual(utils.transform('a,b', 'broken'), 'a,b')
+            (frame_type, headers, body) = utils.parse_frame('MESSAGE\ntransformation:csv\n\na,b')
+            self.assertEqual(body, ['a', 'b'])
+        finally:
+            del utils.TRANSFORMERS['csv']
+            del utils.TRANSFORMERS['broken']
+
+
+class SendManyTest(BrokerTestCase):
+    def test_headers_are_escaped(self):
+        value = 'a:b\nc\\d'
+        listener = CollectingListener(3)
+        consumer = self.connect(listener, version=1.1)
+        consumer.subscribe(destination='/queue/a', id='1', ack='auto')
+        producer = self.connect(version=1.1)
+        producer.send('single', destination='/queue/a', origin=value)
+        receipt = producer.send_many('/queue/a', ['first', 'second'], receipt='r:1', origin=value)
+        self.assertTrue(receipt.wait(5))
+        self.assertTrue(listener.done.wait(5))
+        self.assertEqual(
+            [(headers['origin'], body) for headers, body in listener.messages],
+            [(value, 'single'), (value, 'first'), (value, 'second')])
+
+
+class SwappingListener(CollectingListener):
+    # Replaces itself with the next listener while handling its first message.
+    def __init__(self, connection, replacement):
+        CollectingListener.__init__(self, 1)
+        self.connection = connection
+        self.replacement = replacement
+
+    def on_message(self, headers, body):
+        if not self.messages:
+            self.connection.set_listener('replacement', self.replacement)
+            self.connection.remove_listener('swapping')
+        CollectingListener.on_message(self, headers, body)
+
+
+class ListenerTableTest(unittest.TestCase):
+    def test_listeners_changed_during_dispatch(self):
+        connection = stomppy.Connection([('127.0.0.1', 61613)])
+        notify = connection._Connection__notify
+        replacement = CollectingListener(1)
+        swapping = SwappingListener(connection, replacement)
+        other = CollectingListener(2)
+        connection.set_listener('swapping', swapping)
+        connection.set_listener('other', other)
+
+        # The frame being dispatched goes to the listeners set when it arrived.
+        notify('message', {'message-id': '1'}, 'first')
+        self.assertEqual(len(swapping.messages), 1)
+        self.assertEqual(len(other.messages), 1)
+        self.assertEqual(replacement.messages, [])
+
+        notify('message', {'message-id': '2'}, 'second')
+        self.assertEqual(len(swapping.messages), 1)
+        self.assertEqual([body for headers, body in replacement.messages], ['second'])
+        self.assertEqual([body for headers, body in other.messages], ['first', 'second'])
+        self.assertEqual(connection.get_listener('swapping'), None)
+
+    def test_missing_methods_are_skipped(self):
+        connection = stomppy.Connection([('127.0.0.1', 61613)])
+        listener = CollectingListener(1)
+        connection.set_listener('', listener)
+        notify = connection._Connection__notify
+        notify('connecting')
+        notify('error', {'message': 'ignored'}, '')
+        notify('disconnected')
+        notify('message', {'message-id': '1'}, 'body')
+        self.assertEqual(listener.messages, [({'message-id': '1'}, 'body')])
+
+
+class ListenerSwapTest(BrokerTestCase):
+    def test_receiver_loop_uses_the_replaced_table(self):
+        replacement = CollectingListener(2)
+        consumer = self.connect()
+        swapping = SwappingListener(consumer, replacement)
+        consumer.set_listener('swapping', swapping)
+        consumer.subscribe(destination='/queue/a', id='1', ack='auto')
+        producer = self.connect()
+        for body in ['first', 'second', 'third']:
+            producer.send(body, destination='/queue/a')
+        self.assertTrue(replacement.done.wait(5))
+        self.assertEqual([body for headers, body in swapping.messages], ['first'])
+        self.assertEqual([body for headers, body in replacement.messages], ['second', 'third'])
+
+
+class ReceiptManagerTest(unittest.TestCase):
+    def test_receipt_received_before_wait(self):
+        manager = receipt.ReceiptManager()
+        future = manager.expect('r1')
+        manager.received('r1')
+        self.assertTrue(future.done())
+        self.assertTrue(future.wait(0))
+        # Received before even being expected.
+        manager.received('r2')
+        self.assertTrue(manager.expect('r2').wait(0))
+        self.assertEqual(len(manager), 0)
+
+    def test_unexpected_receipts_are_bounded(self):
+        manager = receipt.ReceiptManager(max_retained=3)
+        for i in range(5):
+            manager.received('r%d' % i)
+        self.assertEqual(len(manager), 3)
+        # The oldest ones were forgotten.
+        self.assertFalse(manager.expect('r0').done())
+        self.assertFalse(manager.expect('r1').done())
+        self.assertTrue(manager.expect('r2').done())
+
+    def test_pending_receipts_are_bounded(self):
+        manager = receipt.ReceiptManager(max_retained=2)
+        futures = [manager.expect('r%d' % i) for i in range(3)]
+        self.assertRaises(exception.ReceiptTimeoutException, futures[0].wait, 0)
+        self.assertRaises(exception.ReceiptTimeoutException, manager.wait_all, futures, 0)
+        self.assertFalse(futures[1].done())
+
+    def test_wait_all_times_out(self):
+        manager = receipt.ReceiptManager()
+        futures = [manager.expect('r%d' % i) for i in range(3)]
+        manager.received('r1')
+        start = time.time()
+        self.assertEqual(manager.wait_all(futures, 0.2), [futures[0], futures[2]])
+        self.assertTrue(0.2 <= time.time() - start < 1)
+
+    def test_fail_all_wakes_waiters(self):
+        manager = receipt.ReceiptManager()
+        future = manager.expect('r1')
+        errors = []
+
+        def wait():
+            try:
+                future.wait()
+            except Exception as e:
+                errors.append(e)
+        waiter = threading.Thread(target=wait)
+        waiter.start()
+        manager.fail_all(exception.ConnectionClosedException())
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual([type(error) for error in errors], [exception.ConnectionClosedException])
+        self.assertEqual(len(manager), 0)
+
+
+class DispatchExecutorTest(unittest.TestCase):
+    def setUp(self):
+        self.threads = []
+
+    def create_thread(self, callback):
+        thread = threading.Thread(target=callback)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    def executor(self, *args, **kwargs):
+        executor = dispatch.DispatchExecutor(*args, create_thread_fc=self.create_thread, **kwargs)
+        executor.start()
+        self.addCleanup(executor.shutdown)
+        return executor
+
+    def test_subscriptions_are_processed_in_order(self):
+        executor = self.executor(4)
+        processed = {}
+
+        def task(subscription, i):
+            processed.setdefault(subscription, []).append((i, threading.current_thread()))
+            time.sleep(0.001 * (i % 3))
+        for i in range(30):
+            for subscription in ('a', 'b', 'c', 'd', 'e'):
+                executor.submit({'subscription': subscription}, task, subscription, i)
+        executor.shutdown()
+        for thread in self.threads:
+            thread.join(5)
+        for subscription, tasks in processed.items():
+            self.assertEqual([i for i, thread in tasks], range(30))
+            # Always on the worker its crc32 bucket maps to.
+            self.assertEqual(len(set([thread for i, thread in tasks])), 1)
+
+    def test_groups_of_a_subscription(self):
+        executor = dispatch.DispatchExecutor(8, group_header='JMSXGroupID')
+        keys = set([executor.get_key({'subscription': 'a', 'JMSXGroupID': str(i)}) for i in range(10)])
+        self.assertEqual(len(keys), 10)
+        self.assertEqual(executor.get_key({'subscription': 'a'}), 'a')
+        self.assertEqual(executor.get_key({'destination': '/queue/a'}), '/queue/a')
+
+    def test_full_queue_blocks_submit(self):
+        executor = self.executor(1, queue_size=2)
+        release = threading.Event()
+        done = []
+        executor.submit({}, release.wait)
+        time.sleep(0.1)
+        # The worker is busy: two tasks fill its queue, a third one blocks.
+        executor.submit({}, done.append, 1)
+        executor.submit({}, done.append, 2)
+        submitter = threading.Thread(target=executor.submit, args=({}, done.append, 3))
+        submitter.start()
+        submitter.join(0.2)
+        self.assertTrue(submitter.is_alive())
+        release.set()
+        submitter.join(5)
+        self.assertFalse(submitter.is_alive())
+        executor.shutdown()
+        for thread in self.threads:
+            thread.join(5)
+        self.assertEqual(done, [1, 2, 3])
+
+    def test_shutdown_runs_queued_tasks(self):
+        executor = self.executor(2)
+        done = []
+        release = threading.Event()
+        executor.submit({'subscription': 'a'}, release.wait)
+        for i in range(20):
+            executor.submit({'subscription': 'a'}, done.append, i)
+        executor.shutdown()
+        release.set()
+        for thread in self.threads:
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(done, range(20))
+
+
+class DisconnectReceiptTest(BrokerTestCase):
+    def test_pending_receipts_fail_on_disconnect(self):
+        connection = self.connect(version=1.1)
+        future = connection._Connection__receipts.expect('never-sent')
+        connection.disconnect()
+        self.assertRaises(exception.ConnectionClosedException, future.wait, 5)
+
+
+class AckCoalescingTest(BrokerTestCase):
+    def test_queued_acks_are_written_before_disconnect(self):
+        for version in (1.0, 1.2):
+            destination = '/queue/acks-%s' % version
+            producer = self.connect()
+            for i in range(3):
+                producer.send('message %d' % i, destination=destination)
+            listener = CollectingListener(3)
+            # ACKs are queued for a minute, unless written before another frame.
+            consumer = self.connect(listener, version=version, ack_coalesce_interval=60)
+            consumer.subscribe(destination=destination, id='1', ack='client-individual')
+            self.assertTrue(listener.done.wait(5))
+            for headers, body in listener.messages:
+                consumer.ack(consumer.get_ack_headers(headers))
+            consumer.stop()
+
+            # Nothing is redelivered.
+            listener = CollectingListener(1)
+            consumer = self.connect(listener, version=version)
+            consumer.subscribe(destination=destination, id='1', ack='auto')
+            producer.send('last', destination=destination)
+            self.assertTrue(listener.done.wait(5))
+            self.assertEqual([body for headers, body in listener.messages], ['last'])
+
+
+class BrokerStopTest(unittest.TestCase):
+    def test_stop_joins_broker_threads(self):
+        server = broker.Broker(heartbeat=50).start()
+        connection = stomppy.Connection([server.address], version=1.1, heartbeats=(0, 50))
+        try:
+            connection.start()
+            connection.connect(wait=True)
+            connection.send('queued', destination='/queue/a')
+            clients = list(server._clients)
+            self.assertEqual(len(clients[0].threads), 3)
+        finally:
+            server.stop()
+            try:
+                connection.stop()
+            except exception.NotConnectedException:
+                pass
+        threads = [server._thread] + [thread for client in clients for thread in client.threads]
+        self.assertEqual([thread for thread in threads if thread.is_alive()], [])
+
+
+class ConnectorTest(BrokerTestCase):
+    def test_latencies_survive_reconnections(self):
+        first = self.connect()
+        latencies = first.get_connect_latencies()
+        self.assertTrue(latencies)
+        first.disconnect()
+        # Connections are recreated when reconnecting (e.g. by stomp.py).
+        second = stomppy.Connection([self.broker.address])
+        self.assertEqual(second.get_connect_latencies(), latencies)
+        self.assertEqual(connector.Connector().latencies, connector.DEFAULT_LATENCIES)
+        self.assertEqual(connector.Connector(latencies={}).latencies, {})
+
+
+class RecordingTLSConfig(object):
+    '''
+    Stands in for a connector.TLSConfig, recording the server names used
+    (without encrypting anything).
+    '''
+    def __init__(self):
+        self.wrapped = []
+
+    def wrap(self, sock, host_and_port):
+        self.wrapped.append(host_and_port)
+        return (sock, 0.0)
+
+
+class LoopbackTLSTest(BrokerTestCase):
+    def test_loopback_keeps_server_name(self):
+        tls = RecordingTLSConfig()
+        # A name of the local host (other than localhost), replaced by the
+        # loopback address when connecting.
+        host_and_port = (socket.gethostname(), self.broker.address[1])
+        if host_and_port[0] == 'localhost':
+            self.skipTest('The host name is localhost')
+        connection = stomppy.Connection([host_and_port], tls=tls)
+        connection.start()
+        connection.connect(wait=True)
+        self.assertEqual(connection.get_host_and_port(), ('127.0.0.1', self.broker.address[1]))
+        self.assertEqual(tls.wrapped, [host_and_port])
+        connection.disconnect()
+
+
+if __name__ == '__main__':
+    unittest.main()